@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of report queries over a synthetic database.
+
+Compares the current report implementation with the previous one (LIKE on the start_date text
+column, full table scans). Reports are rendered from scratch, the report cache is cleared before
+each repetition, except for the "(cached)" one.
+"""
+
+import sqlite3
+import time
+from typing import Callable
+
+import click
+from synthetic import synthetic_activities
+from synthetic import synthetic_bikes
+
+from strava_offline import reports
+from strava_offline import sqlite
+from strava_offline import sync
+
+
+def yearly_like(db: sqlite3.Connection, year: int) -> str:
+    return reports.tabulate_execute(db, """
+        SELECT
+            a.type AS "Activity type",
+            CAST(SUM(a.distance) / 1000 AS INT) AS "Distance (km)",
+            CAST(SUM(a.moving_time) / 3600 AS INT) AS "Moving time (hour)"
+        FROM activity a
+        WHERE start_date LIKE ?
+        GROUP BY 1
+        ORDER BY 2 DESC
+    """, f"{year}-%")
+
+
+def yearly_bikes_like(db: sqlite3.Connection, year: int) -> str:
+    return reports.tabulate_execute(db, """
+        SELECT
+            b.name AS "Bike",
+            CAST(SUM(a.distance) / 1000 AS INT) AS "Distance (km)",
+            CAST(SUM(a.moving_time) / 3600 AS INT) AS "Moving time (hour)"
+        FROM activity a INNER JOIN bike b ON a.gear_id = b.id
+        WHERE start_date LIKE ?
+        GROUP BY 1
+        ORDER BY 2 DESC
+    """, f"{year}-%")
+
+
+def bench(name: str, db: sqlite3.Connection, report: Callable[[], str], repeat: int, cached: bool = False) -> None:
+    best = float('inf')
+    report()
+    for _ in range(repeat):
+        if not cached:
+            db.execute("DELETE FROM report_cache")
+        start = time.perf_counter()
+        report()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:>24}: {best * 1000:8.2f} ms")
+
+
+@click.command()
+@click.option('-n', '--rows', type=int, default=100_000, show_default=True, help="Number of activities")
+@click.option('-r', '--repeat', type=int, default=10, show_default=True, help="Number of repetitions (best is shown)")
+def main(rows: int, repeat: int) -> None:
+    with sqlite.database(":memory:", sync.schema) as db:
+        sync.table_bike.upsert(db, synthetic_bikes(5))
+        sync.table_activity.upsert(db, synthetic_activities(rows))
+
+        bench("yearly (LIKE)", db, lambda: yearly_like(db, 2020), repeat)
+        bench("yearly", db, lambda: reports.yearly(db, 2020), repeat)
+        bench("yearly_bikes (LIKE)", db, lambda: yearly_bikes_like(db, 2020), repeat)
+        bench("yearly_bikes", db, lambda: reports.yearly_bikes(db, 2020), repeat)
+        bench("bikes", db, lambda: reports.bikes(db), repeat)
+        bench("yearly (cached)", db, lambda: reports.yearly(db, 2020), repeat, cached=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of sqlite.Table.upsert throughput (full sync of synthetic activities).
+
+"per-row" and "batched" write the same rows using the same statement, one db.execute per row vs
+executemany in chunks. "upsert" is the whole Table.upsert path (hash lookups, deletion detection,
+statistics) into an empty table, "resync" the same with all rows already present and unchanged.
+"""
+
+from pathlib import Path
+import sqlite3
+import time
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import Mapping
+from typing import Optional
+
+import click
+from synthetic import synthetic_activities
+
+from strava_offline import config
+from strava_offline import sync
+
+table = sync.table_activity
+
+
+def upsert_per_row(db: sqlite3.Connection, data: List[Mapping[str, Any]]) -> None:
+    names = table._column_names()
+    sql = table._upsert_sql(db)
+    with db:
+        db.execute("BEGIN")
+        for row in (table._from_dict(datum) for datum in data):
+            db.execute(sql, [row.get(k) for k in names])
+
+
+def upsert_batched(db: sqlite3.Connection, data: List[Mapping[str, Any]]) -> None:
+    with db:
+        db.execute("BEGIN")
+        table.upsert_rows(db, (table._from_dict(datum) for datum in data))
+
+
+def upsert(db: sqlite3.Connection, data: List[Mapping[str, Any]]) -> None:
+    table.upsert(db, data)
+
+
+def bench(
+    name: str, run: Callable[[sqlite3.Connection, List[Mapping[str, Any]]], None],
+    data: List[Mapping[str, Any]], repeat: int, database: Optional[Path], prefill: bool = False,
+) -> None:
+    best = float('inf')
+    for _ in range(repeat):
+        if database:
+            for suffix in ("", "-wal", "-shm"):
+                Path(f"{database}{suffix}").unlink(missing_ok=True)
+        cfg = config.DatabaseConfig(strava_sqlite_database=database or ":memory:")  # type: ignore [arg-type]
+        with sync.database(cfg) as db:
+            if prefill:
+                upsert(db, data)
+            start = time.perf_counter()
+            run(db, data)
+            best = min(best, time.perf_counter() - start)
+    print(f"{name:>10}: {len(data) / best:10.0f} rows/s ({best:.3f} s)")
+
+
+@click.command()
+@click.option('-n', '--rows', type=int, default=20_000, show_default=True, help="Number of activities")
+@click.option('-r', '--repeat', type=int, default=3, show_default=True, help="Number of repetitions (best is shown)")
+@click.option(
+    '--database', type=click.Path(path_type=Path, dir_okay=False),
+    help="Database file (deleted before each repetition)  [default: in memory]")
+def main(rows: int, repeat: int, database: Optional[Path]) -> None:
+    data = synthetic_activities(rows)
+    bench("per-row", upsert_per_row, data, repeat, database)
+    bench("batched", upsert_batched, data, repeat, database)
+    bench("upsert", upsert, data, repeat, database)
+    bench("resync", upsert, data, repeat, database, prefill=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+from typing import Any
+from typing import List
+from typing import Mapping
+
+
+def synthetic_activities(n: int) -> List[Mapping[str, Any]]:
+    return [
+        {
+            'id': 1_000_000_000 + i,
+            'upload_id': 2_000_000_000 + i,
+            'name': f"Activity {i}",
+            'start_date': f"{2000 + i % 25}-{1 + i % 12:02}-{1 + i % 28:02}T08:00:00Z",
+            'start_date_local': f"{2000 + i % 25}-{1 + i % 12:02}-{1 + i % 28:02}T09:00:00Z",
+            'moving_time': 3600 + i % 600,
+            'elapsed_time': 4000 + i % 600,
+            'distance': 25000.0 + i % 1000,
+            'total_elevation_gain': 100.0 + i % 50,
+            'gear_id': f"b{i % 5}",
+            'type': ["Ride", "Run", "Walk"][i % 3],
+            'sport_type': ["Ride", "Run", "Walk"][i % 3],
+            'commute': i % 2 == 0,
+            'trainer': False,
+            'start_latlng': [51.5, -0.12],
+            'map': {'id': f"a{i}", 'summary_polyline': "_p~iF~ps|U_ulLnnqC_mqNvxq`@", 'resource_state': 2},
+        }
+        for i in range(n)
+    ]
+
+
+def synthetic_bikes(n: int) -> List[Mapping[str, Any]]:
+    return [{'id': f"b{i}", 'name': f"Bike {i}"} for i in range(n)]
@@ -0,0 +1,321 @@
+from array import array
+from dataclasses import dataclass
+from datetime import date
+from datetime import timedelta
+from itertools import groupby
+import math
+import re
+import sqlite3
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+# Activities are loaded once into columns (numpy arrays if numpy is available, stdlib arrays
+# otherwise), so that any number of reports can then be computed without scanning the database.
+
+DIMENSIONS = {
+    # dimension: sql expression (activity a, bike b)
+    'year': "a.start_year",
+    'month': "printf('%04d-%02d', a.start_year, a.start_month)",
+    'week': "a.start_week",
+    'type': "a.type",
+    'sport_type': "a.sport_type",
+    'gear': "COALESCE(b.name, a.gear_id)",
+    'commute': "a.commute",
+    'trainer': "a.trainer",
+}
+
+COLUMNS = {
+    # column: sql expression (activity a, bike b)
+    'distance': "a.distance / 1000",  # km
+    'moving_time': "a.moving_time / 3600.0",  # hours
+    'elapsed_time': "a.elapsed_time / 3600.0",  # hours
+    'elevation_gain': "a.total_elevation_gain",  # m
+    'speed': "a.distance / NULLIF(a.moving_time, 0) * 3.6",  # km/h
+}
+
+AGGREGATES = ['count', 'sum', 'mean', 'min', 'max']  # and pNN, the NNth percentile
+
+METRIC_RE = re.compile(r'(\w+)(?:\((\w+)\))?')
+
+
+class Metric(NamedTuple):
+    aggregate: str
+    column: Optional[str]
+    percentile: Optional[float] = None
+
+    def __str__(self) -> str:
+        return f"{self.aggregate}({self.column})" if self.column else self.aggregate
+
+
+def parse_metric(spec: str) -> Metric:
+    """
+    Parse a metric such as "count", "sum(distance)" or "p90(speed)".
+    """
+    m = METRIC_RE.fullmatch(spec.strip())
+    if not m:
+        raise ValueError(f"invalid metric: {spec}")
+    aggregate, column = m[1], m[2]
+
+    percentile = None
+    if re.fullmatch(r'p\d+(\.\d+)?', aggregate) and float(aggregate[1:]) <= 100:
+        percentile = float(aggregate[1:])
+    elif aggregate not in AGGREGATES:
+        raise ValueError(
+            f"unknown aggregate {aggregate} in metric {spec}, expected one of: {', '.join(AGGREGATES)}, pNN")
+
+    if column is None and aggregate != 'count':
+        raise ValueError(f"metric {spec} needs a column, e.g. {aggregate}(distance)")
+    if column is not None and column not in COLUMNS:
+        raise ValueError(f"unknown column {column} in metric {spec}, expected one of: {', '.join(COLUMNS)}")
+    return Metric(aggregate=aggregate, column=column, percentile=percentile)
+
+
+@dataclass
+class Dimension:
+    codes: Any  # index into labels, for each activity (numpy or stdlib array)
+    labels: List[Any]  # sorted
+
+
+@dataclass
+class Activities:
+    size: int
+    dimensions: Dict[str, Dimension]
+    columns: Dict[str, Any]  # numpy or stdlib arrays of floats, NaN where unknown
+    numpy: bool
+
+
+def _dimension(values: Sequence[Any]) -> Dimension:
+    labels = sorted(set(values), key=lambda v: (v is not None, v))
+    index = {v: i for i, v in enumerate(labels)}
+    return Dimension(codes=array('l', (index[v] for v in values)), labels=labels)
+
+
+def load(db: sqlite3.Connection, use_numpy: Optional[bool] = None) -> Activities:
+    """
+    Load all activities into columns, in a single scan. Uses numpy if available (unless use_numpy
+    says otherwise).
+    """
+    if use_numpy is None:
+        try:
+            import numpy  # noqa: F401
+            use_numpy = True
+        except ImportError:
+            use_numpy = False
+
+    expressions = [f"{e} AS {d}" for d, e in DIMENSIONS.items()] + [f"{e} AS {c}" for c, e in COLUMNS.items()]
+    rows = db.execute(f"""
+        SELECT {', '.join(expressions)}
+        FROM activity a LEFT JOIN bike b ON b.id = a.gear_id
+    """).fetchall()
+    values = dict(zip([*DIMENSIONS, *COLUMNS], zip(*rows))) if rows else {k: () for k in [*DIMENSIONS, *COLUMNS]}
+
+    dimensions = {d: _dimension(values[d]) for d in DIMENSIONS}
+    columns: Dict[str, Any] = {
+        c: array('d', (math.nan if v is None else v for v in values[c])) for c in COLUMNS
+    }
+    if use_numpy:
+        import numpy as np
+        for dimension in dimensions.values():
+            dimension.codes = np.asarray(dimension.codes)
+        columns = {c: np.asarray(v) for c, v in columns.items()}
+
+    return Activities(size=len(rows), dimensions=dimensions, columns=columns, numpy=use_numpy)
+
+
+def _group_numpy(activities: Activities, by: Sequence[str]) -> Tuple[Any, List[Tuple[int, ...]]]:
+    import numpy as np
+
+    if not by:
+        return np.zeros(activities.size, dtype=np.int_), [()] if activities.size else []
+
+    # combine codes of all dimensions into a single key; unique keys come out in the order of labels
+    sizes = [len(activities.dimensions[d].labels) for d in by]
+    keys = np.ravel_multi_index([activities.dimensions[d].codes for d in by], sizes)
+    unique, groups = np.unique(keys, return_inverse=True)
+    return groups, [tuple(int(c) for c in codes) for codes in zip(*np.unravel_index(unique, sizes))]
+
+
+def _aggregate_numpy(metric: Metric, groups: Any, n: int, values: Any) -> List[Optional[float]]:
+    import numpy as np
+
+    if values is None:  # plain count
+        return np.bincount(groups, minlength=n).tolist()
+
+    valid = ~np.isnan(values)
+    groups, values = groups[valid], values[valid]
+    count = np.bincount(groups, minlength=n)
+    result: Any
+    if metric.aggregate == 'count':
+        return count.tolist()
+    elif metric.aggregate == 'sum':
+        result = np.bincount(groups, weights=values, minlength=n)
+    elif metric.aggregate == 'mean':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = np.bincount(groups, weights=values, minlength=n) / count
+    else:
+        # min, max and percentiles from values sorted within groups
+        values = values[np.lexsort((values, groups))]
+        starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+        q = {'min': 0.0, 'max': 100.0}.get(metric.aggregate, metric.percentile)
+        assert q is not None
+        pos = starts + (q / 100) * np.maximum(count - 1, 0)
+        lo = np.minimum(np.floor(pos).astype(np.int_), max(len(values) - 1, 0))
+        hi = np.minimum(np.ceil(pos).astype(np.int_), max(len(values) - 1, 0))
+        if len(values):
+            result = values[lo] + (values[hi] - values[lo]) * (pos - lo)
+        else:
+            result = np.full(n, np.nan)
+    return [None if count[i] == 0 else float(v) for i, v in enumerate(result)]
+
+
+def _group_array(activities: Activities, by: Sequence[str]) -> Tuple[Sequence[int], List[Tuple[int, ...]]]:
+    keys = list(zip(*(activities.dimensions[d].codes for d in by))) if by else [() for _ in range(activities.size)]
+    unique = sorted(set(keys))
+    index = {k: i for i, k in enumerate(unique)}
+    return array('l', (index[k] for k in keys)), unique
+
+
+def _percentile(values: List[float], q: float) -> float:
+    # linear interpolation between closest ranks, same as numpy's default
+    pos = q / 100 * (len(values) - 1)
+    lo, hi = math.floor(pos), math.ceil(pos)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def _aggregate_array(
+    metric: Metric, groups: Sequence[int], n: int, values: Optional[Sequence[float]],
+) -> List[Optional[float]]:
+    if values is None:  # plain count
+        counts = [0] * n
+        for g in groups:
+            counts[g] += 1
+        return list(counts)
+
+    grouped: List[List[float]] = [[] for _ in range(n)]
+    for g, v in zip(groups, values):
+        if not math.isnan(v):
+            grouped[g].append(v)
+
+    def aggregate(vs: List[float]) -> Optional[float]:
+        if metric.aggregate == 'count':
+            return len(vs)
+        elif not vs:
+            return None
+        elif metric.aggregate == 'sum':
+            return math.fsum(vs)
+        elif metric.aggregate == 'mean':
+            return math.fsum(vs) / len(vs)
+        elif metric.aggregate == 'min':
+            return min(vs)
+        elif metric.aggregate == 'max':
+            return max(vs)
+        else:
+            assert metric.percentile is not None
+            return _percentile(sorted(vs), metric.percentile)
+
+    return [aggregate(vs) for vs in grouped]
+
+
+def _next_year(year: int) -> int:
+    return year + 1
+
+
+def _next_month(month: str) -> str:
+    year, m = int(month[0:4]), int(month[5:7])
+    return f"{year + m // 12:04}-{m % 12 + 1:02}"
+
+
+def _next_week(week: str) -> str:
+    year, w, _ = (date.fromisocalendar(int(week[0:4]), int(week[6:8]), 1) + timedelta(weeks=1)).isocalendar()
+    return f"{year:04}-W{w:02}"
+
+
+PERIODS: Dict[str, Callable[[Any], Any]] = {
+    # dimension: next period
+    'year': _next_year,
+    'month': _next_month,
+    'week': _next_week,
+}
+
+
+def _fill_periods(
+    group: List[List[Any]], dimensions: int, next_period: Callable[[Any], Any], fill: Sequence[Any],
+) -> List[List[Any]]:
+    """
+    Insert rows (with fill as metrics) for periods without activities between rows of a group.
+    """
+    result: List[List[Any]] = []
+    for row in group:
+        last = result[-1][dimensions - 1] if result else None
+        if last is not None and row[dimensions - 1] is not None:
+            period = next_period(last)
+            while period < row[dimensions - 1]:
+                result.append(row[:dimensions - 1] + [period] + list(fill))
+                period = next_period(period)
+        result.append(row)
+    return result
+
+
+def _rolling(
+    rows: List[List[Any]], dimensions: int, window: int,
+    next_period: Optional[Callable[[Any], Any]] = None, fill: Sequence[Any] = (),
+) -> List[List[Any]]:
+    """
+    Replace metrics with their mean over a trailing window of consecutive rows (values of the last
+    dimension) within groups of the other dimensions. If the last dimension is a calendar period
+    (see PERIODS), periods without activities are filled in first, so that windows span exactly
+    window periods.
+    """
+    result = []
+    for _, group_iter in groupby(rows, key=lambda row: row[:dimensions - 1]):
+        group = list(group_iter)
+        if next_period is not None:
+            group = _fill_periods(group, dimensions, next_period, fill)
+        for i, row in enumerate(group):
+            metrics = []
+            for m in range(dimensions, len(row)):
+                known = [r[m] for r in group[max(0, i - window + 1):i + 1] if r[m] is not None]
+                metrics.append(math.fsum(known) / len(known) if known else None)
+            result.append(row[:dimensions] + metrics)
+    return result
+
+
+def aggregate(
+    activities: Activities,
+    by: Sequence[str],
+    metrics: Sequence[Metric],
+    rolling: Optional[int] = None,
+) -> Tuple[List[str], List[List[Any]]]:
+    """
+    Group activities by the given dimensions and compute metrics of each group. If rolling is given,
+    metrics are averaged over that many consecutive groups of the last dimension (or calendar
+    periods, including those without activities, if it's year, month or week).
+    Returns headers and rows, ordered by dimensions.
+    """
+    if activities.numpy:
+        groups, keys = _group_numpy(activities, by)
+        aggregate = _aggregate_numpy
+    else:
+        groups, keys = _group_array(activities, by)
+        aggregate = _aggregate_array  # type: ignore[assignment]
+
+    columns = [
+        aggregate(m, groups, len(keys), activities.columns[m.column] if m.column else None)
+        for m in metrics
+    ]
+    rows = [
+        [activities.dimensions[d].labels[c] for d, c in zip(by, key)] + [column[i] for column in columns]
+        for i, key in enumerate(keys)
+    ]
+    if rolling and by:
+        # empty periods have zero count and sum, other aggregates are unknown
+        fill = [0 if m.aggregate in ('count', 'sum') else None for m in metrics]
+        rows = _rolling(rows, len(by), rolling, next_period=PERIODS.get(by[-1]), fill=fill)
+
+    return [*by, *(str(m) for m in metrics)], rows
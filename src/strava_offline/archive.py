@@ -0,0 +1,204 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+import csv
+from datetime import datetime
+from datetime import timezone
+import gzip
+import io
+import logging
+from pathlib import Path
+import shutil
+import sqlite3
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import TextIO
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+import zipfile
+
+from . import config
+from . import fit
+from .fit import Readable
+from .fit import TrackPoint
+from .gpx import index_gpx_files
+from .gpx import record_gpx_file
+from .sync import database
+from .sync import parse_datetime
+
+TCX_NS = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+
+
+class ArchiveActivity(NamedTuple):
+    id: int
+    name: str
+    filename: str  # zip member
+
+
+def read_activities_csv(archive: zipfile.ZipFile) -> List[ArchiveActivity]:
+    with archive.open("activities.csv") as f:
+        reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+        header = next(reader)
+        # there are duplicate column names, index() takes the first one
+        col_id, col_name, col_filename = (header.index(c) for c in ("Activity ID", "Activity Name", "Filename"))
+        return [
+            ArchiveActivity(id=int(row[col_id]), name=row[col_name], filename=row[col_filename])
+            for row in reader
+            if row[col_filename]
+        ]
+
+
+class _SkipLeadingWhitespace:
+    # Strava's tcx files start with whitespace before the xml declaration, which xml parsers reject
+    def __init__(self, f: Readable):
+        self._f = f
+        self._started = False
+
+    def read(self, n: int = -1) -> bytes:
+        data = self._f.read(n)
+        while not self._started and data:
+            data = data.lstrip()
+            if data:
+                self._started = True
+            else:
+                data = self._f.read(n)
+        return data
+
+
+def read_tcx_track_points(f: Readable) -> Iterator[TrackPoint]:
+    def text(elem: ElementTree.Element, path: str) -> Optional[str]:
+        child = elem.find(path)
+        return child.text if child is not None else None
+
+    def number(elem: ElementTree.Element, path: str) -> Optional[float]:
+        value = text(elem, path)
+        return float(value) if value else None
+
+    for _, elem in ElementTree.iterparse(_SkipLeadingWhitespace(f)):
+        if elem.tag == f"{TCX_NS}Trackpoint":
+            time = text(elem, f"{TCX_NS}Time")
+            hr = number(elem, f"{TCX_NS}HeartRateBpm/{TCX_NS}Value")
+            yield TrackPoint(
+                time=parse_datetime(time).timestamp() if time else None,
+                lat=number(elem, f"{TCX_NS}Position/{TCX_NS}LatitudeDegrees"),
+                lon=number(elem, f"{TCX_NS}Position/{TCX_NS}LongitudeDegrees"),
+                ele=number(elem, f"{TCX_NS}AltitudeMeters"),
+                hr=int(hr) if hr is not None else None,
+            )
+            elem.clear()
+
+
+def write_gpx(points: Iterable[TrackPoint], f: TextIO, name: str = "") -> None:
+    f.write(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<gpx version="1.1" creator="strava-offline" xmlns="http://www.topografix.com/GPX/1/1"'
+        ' xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n'
+        ' <trk>\n'
+        f'  <name>{escape(name)}</name>\n'
+        '  <trkseg>\n'
+    )
+    for p in points:
+        if p.lat is None or p.lon is None:
+            continue
+        f.write(f'   <trkpt lat="{p.lat:.7f}" lon="{p.lon:.7f}">\n')
+        if p.ele is not None:
+            f.write(f'    <ele>{p.ele:.1f}</ele>\n')
+        if p.time is not None:
+            time = datetime.fromtimestamp(p.time, tz=timezone.utc)
+            f.write(f'    <time>{time.strftime("%Y-%m-%dT%H:%M:%SZ")}</time>\n')
+        if p.hr is not None:
+            f.write(
+                '    <extensions><gpxtpx:TrackPointExtension>'
+                f'<gpxtpx:hr>{p.hr}</gpxtpx:hr>'
+                '</gpxtpx:TrackPointExtension></extensions>\n')
+        f.write('   </trkpt>\n')
+    f.write('  </trkseg>\n </trk>\n</gpx>\n')
+
+
+# archive opened once in each worker process
+_archive: Optional[zipfile.ZipFile] = None
+
+
+def _open_archive(path: Path) -> None:
+    global _archive
+    _archive = zipfile.ZipFile(path)
+
+
+def import_activity(activity: ArchiveActivity, dir_activities: Path) -> Path:
+    """
+    Write a track from the archive into dir_activities as gzipped gpx, converting it from fit/tcx if
+    necessary. Runs in a worker process.
+    """
+    assert _archive is not None
+
+    filename = Path(dir_activities, str(activity.id) + ".gpx.gz")
+    tmpfilename = Path(dir_activities, str(activity.id) + ".gpx.gz.tmp")
+    member = activity.filename
+    try:
+        with _archive.open(member) as src:
+            if member.endswith(".gpx.gz"):
+                with open(tmpfilename, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            elif member.endswith(".gpx"):
+                with gzip.open(tmpfilename, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            else:
+                track = gzip.open(src) if member.endswith(".gz") else src
+                if member.endswith((".fit", ".fit.gz")):
+                    points = fit.read_track_points(track)
+                elif member.endswith((".tcx", ".tcx.gz")):
+                    points = read_tcx_track_points(track)
+                else:
+                    raise ValueError(f"unsupported file type: {member}")
+                with gzip.open(tmpfilename, "wt", encoding="utf-8") as dst:
+                    write_gpx(points, dst, name=activity.name)
+        tmpfilename.replace(filename)
+    finally:
+        tmpfilename.unlink(missing_ok=True)
+    return filename
+
+
+def import_archive(
+    db: sqlite3.Connection,
+    archive: Path,
+    dir_activities: Path,
+    processes: Optional[int] = None,
+) -> None:
+    """
+    Import tracks of activities from Strava bulk export archive into dir_activities, skipping those
+    already present. Expects gpx_file to be up to date (see gpx.index_gpx_files).
+    """
+    with zipfile.ZipFile(archive) as zf:
+        members = set(zf.namelist())
+        activities = read_activities_csv(zf)
+
+    present = set(row['activity_id'] for row in db.execute("SELECT activity_id FROM gpx_file"))
+    todo = [a for a in activities if a.id not in present and a.filename in members]
+
+    imported, failed = 0, 0
+    with ProcessPoolExecutor(max_workers=processes, initializer=_open_archive, initargs=(archive,)) as executor:
+        futures = {executor.submit(import_activity, activity, dir_activities): activity for activity in todo}
+        with db:  # transaction
+            db.execute("BEGIN")
+            for future in as_completed(futures):
+                activity = futures[future]
+                try:
+                    record_gpx_file(db, activity.id, future.result(), source='archive')
+                    imported += 1
+                except Exception as e:
+                    logging.error(f"failed to import {activity.filename} (activity {activity.id}): {e}")
+                    failed += 1
+
+    logging.info(f"imported gpx for {imported} activities from archive")
+    if failed:
+        logging.warning(f"failed to import gpx for {failed} activities")
+
+
+def sync(config: config.ArchiveConfig, archive: Path):
+    config.dir_activities.mkdir(parents=True, exist_ok=True)
+
+    with database(config) as db:
+        index_gpx_files(db=db, dir_activities=config.dir_activities)
+        import_archive(db=db, archive=archive, dir_activities=config.dir_activities, processes=config.processes)
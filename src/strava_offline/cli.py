@@ -1,18 +1,25 @@
 import datetime
+from pathlib import Path
+from typing import BinaryIO
+from typing import List
+from typing import Optional
 from typing import TextIO
+from typing import Tuple
 
 import click
 
+# Only modules needed to build the command line interface are imported here, everything else is
+# imported by the individual commands, so that e.g. reports don't pay for importing the http stack.
+from . import analytics
 from . import config
-from . import gpx
-from . import reports
-from . import sync
-from .strava import StravaAPI
-from .strava import StravaWeb
+from . import export
 
 
 @click.group(context_settings={'max_content_width': 120})
-@config.yaml_config_sample_option(sample_hidden={'output'})
+@config.yaml_config_sample_option(sample_hidden={
+    # per-invocation options of individual commands
+    'output', 'bbox', 'within', 'by', 'metrics', 'rolling', 'format', 'sql', 'batch_size',
+})
 def cli() -> None:
     pass
 
@@ -24,9 +31,15 @@ def cli_sqlite(config: config.SyncConfig) -> None:
     Synchronize bikes and activities metadata to local sqlite3 database.
     Unless --full is given, the sync is incremental, i.e. only new activities
     are synchronized and deletions aren't detected.
+    Summary polylines of activities are then decoded into the activity_geometry table.
     """
+    from . import geometry
+    from . import sync
+    from .strava import StravaAPI
+
     strava = StravaAPI(config=config)
     sync.sync(config=config, strava=strava)
+    geometry.sync(config=config)
 
 
 @cli.command(name='gpx', short_help="Download gpx for your activities")
@@ -38,10 +51,110 @@ def cli_gpx(config: config.GpxConfig) -> None:
     or week, and download the bulk of your historic activities directly from Strava.
     Use --dir-activities-backup to avoid downloading activities already downloaded in the bulk.
     """
-    strava = StravaWeb(config=config)
+    from . import gpx
+    from .strava import StravaWeb
+
+    strava = StravaWeb(config=config, pool_size=config.download_concurrency)
     gpx.sync(config=config, strava=strava)
 
 
+@cli.command(name='daemon', short_help="Keep syncing bikes/activities/gpx periodically")
+@config.DaemonConfig.options()
+def cli_daemon(config: config.DaemonConfig) -> None:
+    """
+    Run in the foreground, synchronizing bikes and activities (like the "sqlite" command) and
+    downloading gpx (like the "gpx" command) every --bikes-interval, --activities-interval and
+    --gpx-interval seconds. A single database connection and Strava sessions are kept open for the
+    lifetime of the daemon, so that periodic syncs don't pay for reconnecting.
+
+    Use the "daemon-ctl" command to sync immediately or query the status of the daemon.
+    """
+    from . import daemon
+    from .strava import StravaAPI
+    from .strava import StravaWeb
+
+    api = StravaAPI(config=config)
+    web = StravaWeb(config=config, pool_size=config.download_concurrency)
+    try:
+        daemon.run(config=config, api=api, web=web)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+
+@cli.command(name='daemon-ctl', short_help="Control a running daemon")
+@config.ControlSocketConfig.options()
+@click.argument('command', type=click.Choice(['status', 'sync']), metavar='COMMAND')
+@click.argument('jobs', nargs=-1, type=click.Choice(['bikes', 'activities', 'gpx']), metavar='[JOB]...')
+def cli_daemon_ctl(config: config.ControlSocketConfig, command: str, jobs: Tuple[str, ...]) -> None:
+    """
+    Send a COMMAND to a daemon started by the "daemon" command and print its reply (json).
+    "status" shows when jobs last ran and when they're due next,
+    "sync [JOB]..." runs the given jobs (bikes, activities, gpx; all by default) as soon as possible.
+    """
+    if command == 'status' and jobs:
+        raise click.UsageError("status doesn't take any jobs")
+
+    import json
+
+    from . import daemon
+
+    try:
+        reply = daemon.control(config.control_socket, " ".join([command, *jobs]))
+    except OSError as e:
+        raise click.ClickException(f"cannot connect to daemon at {config.control_socket}: {e}")
+    if 'error' in reply:
+        raise click.ClickException(reply['error'])
+    print(json.dumps(reply, indent=2))
+
+
+@cli.command(name='import-archive', short_help="Import gpx from Strava bulk export")
+@config.ArchiveConfig.options()
+@click.argument('archive_file', metavar='ARCHIVE', type=click.Path(path_type=Path, dir_okay=False, exists=True))
+def cli_import_archive(config: config.ArchiveConfig, archive_file: Path) -> None:
+    """
+    Import activity tracks from the zip ARCHIVE obtained using the Bulk Export feature of Strava
+    into --dir-activities, without extracting it. Tracks in fit/tcx format are converted to gpx.
+    Activities that already have a gpx file are skipped.
+    """
+    from . import archive
+
+    archive.sync(config=config, archive=archive_file)
+
+
+@cli.command(name='tracks', short_help="Load track points from gpx into sqlite")
+@config.TracksConfig.options()
+def cli_tracks(config: config.TracksConfig) -> None:
+    """
+    Parse gpx files in --dir-activities (downloaded using the "gpx" command or imported using the
+    "import-archive" command) and store their track points in the sqlite database in a compact
+    binary format. Only new and changed files are parsed.
+    """
+    from . import tracks
+
+    tracks.sync(config=config)
+
+
+@cli.command(name='track-stats', short_help="Compute activity stats from tracks")
+@config.TrackStatsConfig.options()
+def cli_track_stats(config: config.TrackStatsConfig) -> None:
+    """
+    Compute stats (bounding box, start/end points, distance, max speed, smoothed elevation gain,
+    moving time, time in heart rate zones) of tracks loaded using the "tracks" command into the
+    activity_track_stats table. Only new and changed tracks are processed. Requires numpy.
+    """
+    try:
+        from . import stats
+    except ModuleNotFoundError as e:
+        raise click.ClickException(f"{e} (install strava-offline[numpy])")
+
+    try:
+        stats.parse_hr_zones(config.hr_zones)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--hr-zones")
+
+    stats.sync(config=config)
+
+
 option_output = click.option('-o', '--output', type=click.File('w'), default='-', help="Output file")
 option_year = click.argument('year', type=int, default=datetime.datetime.now().year)
 
@@ -52,6 +165,9 @@ option_year = click.argument('year', type=int, default=datetime.datetime.now().y
 @option_year
 def cli_report_yearly(config: config.DatabaseConfig, output: TextIO, year: int) -> None:
     "Show yearly report by activity type"
+    from . import reports
+    from . import sync
+
     with sync.database(config) as db:
         print(reports.yearly(db, year), file=output)
 
@@ -62,6 +178,9 @@ def cli_report_yearly(config: config.DatabaseConfig, output: TextIO, year: int)
 @option_year
 def cli_report_yearly_bikes(config: config.DatabaseConfig, output: TextIO, year: int) -> None:
     "Show yearly report by bike"
+    from . import reports
+    from . import sync
+
     with sync.database(config) as db:
         print(reports.yearly_bikes(db, year), file=output)
 
@@ -71,5 +190,113 @@ def cli_report_yearly_bikes(config: config.DatabaseConfig, output: TextIO, year:
 @option_output
 def cli_report_bikes(config: config.DatabaseConfig, output: TextIO) -> None:
     "Show all-time report by bike"
+    from . import reports
+    from . import sync
+
     with sync.database(config) as db:
         print(reports.bikes(db), file=output)
+
+
+def parse_metrics(ctx: click.Context, param: click.Parameter, value: Tuple[str, ...]) -> List[analytics.Metric]:
+    try:
+        return [analytics.parse_metric(m) for m in value]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@cli.command(name='report', short_help="Show custom report")
+@config.DatabaseConfig.options()
+@option_output
+@click.option(
+    '--by', type=click.Choice(list(analytics.DIMENSIONS)), multiple=True,
+    help="Group by dimension (repeatable)")
+@click.option(
+    '--metric', 'metrics', multiple=True, callback=parse_metrics, metavar='METRIC',
+    default=["count", "sum(distance)", "sum(moving_time)"], show_default=True,
+    help="Metric to compute (repeatable)")
+@click.option(
+    '--rolling', type=click.IntRange(min=1), metavar='N',
+    help="Average metrics over N consecutive rows of the last --by dimension (N periods if year, month or week)")
+def cli_report(
+    config: config.DatabaseConfig, output: TextIO,
+    by: Tuple[str, ...], metrics: List[analytics.Metric], rolling: Optional[int],
+) -> None:
+    """
+    Show a report of activities grouped by any combination of dimensions.
+
+    \b
+    Metrics are AGGREGATE(COLUMN) or just count, where
+      AGGREGATE is one of: count, sum, mean, min, max, p50, p90 (any percentile)
+      COLUMN is one of: distance (km), moving_time (hours), elapsed_time (hours),
+        elevation_gain (m), speed (km/h)
+
+    Activities are loaded into memory once and aggregated there, using numpy if it's installed.
+    """
+    from . import reports
+    from . import sync
+
+    with sync.database(config) as db:
+        print(reports.custom(db, by, metrics, rolling), file=output)
+
+
+@cli.command(name='export', short_help="Export table or query to csv/ndjson/parquet/arrow")
+@config.DatabaseConfig.options()
+@click.option('-o', '--output', type=click.File('wb'), default='-', help="Output file")
+@click.option(
+    '-f', '--format', type=click.Choice(export.FORMATS), default='csv', show_default=True,
+    help="Output format (parquet and arrow need pyarrow)")
+@click.option('--sql', metavar='QUERY', help="Export the result of an sql query instead of a table")
+@click.option(
+    '--batch-size', type=click.IntRange(min=1), default=1000, show_default=True,
+    help="Number of rows fetched and written at once")
+@click.argument('table', type=click.Choice(export.TABLES), metavar='[TABLE]', required=False)
+def cli_export(
+    config: config.DatabaseConfig, output: BinaryIO, format: str,
+    sql: Optional[str], batch_size: int, table: Optional[str],
+) -> None:
+    """
+    Export a table (or the result of --sql QUERY) for use in other tools such as pandas or DuckDB.
+    TABLE is one of: activity, bike, activity_summary, activity_track_stats, gpx_file, gpx_download.
+    Rows are streamed in batches, so memory use stays constant regardless of the size of the export.
+    Raw json replies are exported as text even if stored compressed, blobs as base64 in csv and ndjson.
+    """
+    if (table is None) == (sql is None):
+        raise click.UsageError("Either TABLE or --sql must be given")
+
+    from . import sync
+
+    with sync.database(config) as db:
+        try:
+            export.export(db, output, format, table=table, sql=sql, batch_size=batch_size)
+        except ModuleNotFoundError as e:
+            raise click.ClickException(f"{e} (install strava-offline[arrow])")
+
+
+@cli.command(name='area')
+@config.DatabaseConfig.options()
+@option_output
+@click.option(
+    '--bbox', type=float, nargs=4, required=True,
+    metavar="MIN_LAT MIN_LON MAX_LAT MAX_LON",
+    help="Area to search for activities")
+@click.option(
+    '--within', is_flag=True,
+    help="Only activities entirely within the area, not just passing through it")
+def cli_area(
+    config: config.DatabaseConfig, output: TextIO, bbox: Tuple[float, float, float, float], within: bool,
+) -> None:
+    """
+    Show activities passing through an area
+
+    Uses track points loaded by the "tracks" command where available, summary polylines of
+    activities otherwise. The spatial index is updated first.
+    """
+    from . import geometry
+    from . import reports
+    from . import spatial
+    from . import sync
+
+    with sync.database(config) as db:
+        geometry.update_geometry(db)
+        spatial.update_index(db)
+        print(reports.area(db, spatial.BBox(*bbox), within), file=output)
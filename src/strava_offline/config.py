@@ -124,15 +124,54 @@ class StravaWebConfig(BaseConfig):
 @dataclass
 class DatabaseConfig(BaseConfig):
     strava_sqlite_database: Path = data_dir / 'strava.sqlite'
+    sqlite_journal_mode: str = 'wal'
+    sqlite_synchronous: str = 'normal'
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_cache_size: int = 64 * 1024
+    sqlite_temp_store: str = 'memory'
+    sqlite_busy_timeout: int = 5000
+    sqlite_compress_json: bool = False
 
     @classmethod
     def options(cls):
         group = OptionGroup("Database")
+        tuning_group = OptionGroup("Database tuning")
         return compose_decorators(
             group.option(
                 '--database', 'strava_sqlite_database', type=click.Path(path_type=Path, dir_okay=False),
                 default=cls.strava_sqlite_database, show_default=True,
                 help="Sqlite database file"),
+            tuning_group.option(
+                '--sqlite-journal-mode',
+                type=click.Choice(['delete', 'truncate', 'persist', 'memory', 'wal', 'off'], case_sensitive=False),
+                default=cls.sqlite_journal_mode, show_default=True,
+                help="Sqlite journal mode (wal lets reports run concurrently with sync)"),
+            tuning_group.option(
+                '--sqlite-synchronous',
+                type=click.Choice(['off', 'normal', 'full', 'extra'], case_sensitive=False),
+                default=cls.sqlite_synchronous, show_default=True,
+                help="Sqlite synchronous setting (how often to fsync)"),
+            tuning_group.option(
+                '--sqlite-mmap-size', type=int,
+                default=cls.sqlite_mmap_size, show_default=True,
+                help="Sqlite memory-mapped I/O size (bytes)"),
+            tuning_group.option(
+                '--sqlite-cache-size', type=int,
+                default=cls.sqlite_cache_size, show_default=True,
+                help="Sqlite page cache size (KiB)"),
+            tuning_group.option(
+                '--sqlite-temp-store',
+                type=click.Choice(['default', 'file', 'memory'], case_sensitive=False),
+                default=cls.sqlite_temp_store, show_default=True,
+                help="Sqlite temporary tables and indices storage"),
+            tuning_group.option(
+                '--sqlite-busy-timeout', type=int,
+                default=cls.sqlite_busy_timeout, show_default=True,
+                help="Sqlite busy timeout (milliseconds to wait for a lock)"),
+            tuning_group.option(
+                '--sqlite-compress-json / --no-sqlite-compress-json',
+                default=cls.sqlite_compress_json, show_default=True,
+                help="Store raw json replies compressed (needs json_text() to query them)"),
             super().options()
         )
 
@@ -140,6 +179,8 @@ class DatabaseConfig(BaseConfig):
 @dataclass
 class SyncConfig(StravaApiConfig, DatabaseConfig):
     full: bool = False
+    incremental_overlap: int = 7
+    page_concurrency: int = 4
 
     @classmethod
     def options(cls):
@@ -148,14 +189,21 @@ class SyncConfig(StravaApiConfig, DatabaseConfig):
             group.option(
                 '--full / --no-full', default=cls.full, show_default=True,
                 help="Perform full sync instead of incremental"),
+            group.option(
+                '--incremental-overlap', type=int, metavar='DAYS',
+                default=cls.incremental_overlap, show_default=True,
+                help="Incremental sync also refreshes activities up to this many days older than the latest one"),
+            group.option(
+                '--page-concurrency', type=click.IntRange(min=1),
+                default=cls.page_concurrency, show_default=True,
+                help="Number of activity pages requested concurrently during full sync"),
             super().options()
         )
 
 
 @dataclass
-class GpxConfig(StravaWebConfig, DatabaseConfig):
+class ActivitiesConfig(DatabaseConfig):
     dir_activities: Path = data_dir / 'activities'
-    dir_activities_backup: Optional[Path] = None
 
     @classmethod
     def options(cls):
@@ -165,9 +213,114 @@ class GpxConfig(StravaWebConfig, DatabaseConfig):
                 '--dir-activities', type=click.Path(path_type=Path, file_okay=False),
                 default=cls.dir_activities, show_default=True,
                 help="Directory to store gpx files indexed by activity id"),
+            super().options()
+        )
+
+
+@dataclass
+class ProcessesConfig(BaseConfig):
+    processes: Optional[int] = None
+
+    @classmethod
+    def options(cls):
+        group = OptionGroup("Parallelism")
+        return compose_decorators(
+            group.option(
+                '--processes', type=click.IntRange(min=1),
+                help="Number of worker processes  [default: number of CPUs]"),
+            super().options()
+        )
+
+
+@dataclass
+class GpxConfig(StravaWebConfig, ActivitiesConfig):
+    dir_activities_backup: Optional[Path] = None
+    download_concurrency: int = 4
+
+    @classmethod
+    def options(cls):
+        group = OptionGroup("GPX download")
+        return compose_decorators(
             group.option(
                 '--dir-activities-backup', type=click.Path(path_type=Path, file_okay=False),
                 help="Optional path to activities in Strava backup (no need to redownload these)"),
+            group.option(
+                '--download-concurrency', type=click.IntRange(min=1),
+                default=cls.download_concurrency, show_default=True,
+                help="Number of gpx files to download at the same time"),
+            super().options()
+        )
+
+
+@dataclass
+class ArchiveConfig(ProcessesConfig, ActivitiesConfig):
+    pass
+
+
+@dataclass
+class TracksConfig(ProcessesConfig, ActivitiesConfig):
+    pass
+
+
+@dataclass
+class TrackStatsConfig(ProcessesConfig, DatabaseConfig):
+    hr_zones: str = '123,153,169,184'
+
+    @classmethod
+    def options(cls):
+        group = OptionGroup("Track stats")
+        return compose_decorators(
+            group.option(
+                '--hr-zones', type=str,
+                default=cls.hr_zones, show_default=True,
+                help="Heart rate zones (4 comma-separated upper bounds of zones 1-4, bpm)"),
+            super().options()
+        )
+
+
+@dataclass
+class ControlSocketConfig(BaseConfig):
+    control_socket: Path = data_dir / 'daemon.sock'
+
+    @classmethod
+    def options(cls):
+        group = OptionGroup("Daemon control")
+        return compose_decorators(
+            group.option(
+                '--control-socket', type=click.Path(path_type=Path, dir_okay=False),
+                default=cls.control_socket, show_default=True,
+                help="Unix socket for controlling the daemon"),
+            super().options()
+        )
+
+
+@dataclass
+class DaemonConfig(ControlSocketConfig, GpxConfig, SyncConfig):
+    bikes_interval: int = 24 * 60 * 60
+    activities_interval: int = 60 * 60
+    gpx_interval: int = 60 * 60
+    jitter: int = 5 * 60
+
+    @classmethod
+    def options(cls):
+        group = OptionGroup("Daemon schedule")
+        return compose_decorators(
+            group.option(
+                '--bikes-interval', type=click.IntRange(min=0), metavar='SECONDS',
+                default=cls.bikes_interval, show_default=True,
+                help="Sync bikes this often (0 = only when asked to using daemon-ctl)"),
+            group.option(
+                '--activities-interval', type=click.IntRange(min=0), metavar='SECONDS',
+                default=cls.activities_interval, show_default=True,
+                help="Sync activities this often (0 = only when asked to using daemon-ctl)"),
+            group.option(
+                '--gpx-interval', type=click.IntRange(min=0), metavar='SECONDS',
+                default=cls.gpx_interval, show_default=True,
+                help="Download gpx this often (0 = only when asked to using daemon-ctl)"),
+            group.option(
+                '--jitter', type=click.IntRange(min=0), metavar='SECONDS',
+                default=cls.jitter, show_default=True,
+                help="Delay scheduled syncs by a random time up to this long"),
             super().options()
         )
 
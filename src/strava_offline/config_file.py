@@ -9,7 +9,6 @@ from typing import Set
 import click
 import click_config_file  # type: ignore [import]
 import platformdirs
-import yaml
 
 
 def yaml_config_option():
@@ -17,6 +16,8 @@ def yaml_config_option():
 
     def provider(file_path, _cmd_name):
         if os.path.isfile(file_path):
+            import yaml
+
             with open(file_path) as f:
                 return yaml.safe_load(f)
         else:
@@ -77,6 +78,8 @@ def yaml_config_sample(
                 return opt.make_metavar()  # type: ignore [call-arg]
 
     def sample_yaml(opt: click.Option):
+        import yaml
+
         sample = ""
 
         if opt.help:
@@ -0,0 +1,246 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from datetime import timezone
+import json
+import logging
+import os
+from pathlib import Path
+import random
+import signal
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import TYPE_CHECKING
+
+from . import config
+from . import geometry
+from . import gpx
+from . import sync
+
+if TYPE_CHECKING:
+    from .strava import StravaAPI
+    from .strava import StravaWeb
+
+# The daemon keeps a single database connection and http sessions (with their connection pools and
+# OAuth token) for its whole lifetime. Jobs run one at a time in the main thread, which is the only
+# one using the database; the control socket is served by other threads which only ever touch the
+# scheduler state under its lock.
+
+
+def _timestamp(t: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(t, tz=timezone.utc).isoformat(timespec='seconds') if t is not None else None
+
+
+@dataclass
+class Job:
+    name: str
+    run: Callable[[], None]
+    interval: int  # seconds, 0 = only when triggered
+    next_run: float = 0.0  # time.monotonic(), due immediately after start
+    pending: bool = False  # triggered (again) since last started
+    running: bool = False
+    runs: int = 0
+    last_started: Optional[float] = None  # time.time()
+    last_finished: Optional[float] = None
+    last_error: Optional[str] = None
+
+    def due(self, now: float) -> bool:
+        return self.pending or (self.interval > 0 and now >= self.next_run)
+
+    def status(self, now: float) -> Dict[str, Any]:
+        return {
+            'running': self.running,
+            'pending': self.pending,
+            'runs': self.runs,
+            'last_started': _timestamp(self.last_started),
+            'last_finished': _timestamp(self.last_finished),
+            'last_error': self.last_error,
+            'next_run_in': max(0, round(self.next_run - now)) if self.interval > 0 else None,
+        }
+
+
+class Scheduler:
+    """
+    Run jobs periodically (delayed by random jitter so that several instances don't hit Strava at
+    the same time) or when triggered. Jobs run one at a time in the order given, and triggering a
+    job that is already pending or running coalesces into a single (further) run.
+    """
+
+    def __init__(self, jobs: Sequence[Job], jitter: int = 0):
+        self.jobs = {job.name: job for job in jobs}
+        self.jitter = jitter
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def trigger(self, names: Sequence[str] = ()) -> List[str]:
+        """
+        Ask for jobs (all if none given) to run as soon as possible.
+        """
+        unknown = [name for name in names if name not in self.jobs]
+        if unknown:
+            raise ValueError(f"unknown job {', '.join(unknown)}, expected one of: {', '.join(self.jobs)}")
+
+        with self._cond:
+            for name in names or self.jobs:
+                self.jobs[name].pending = True
+            self._cond.notify_all()
+        return list(names or self.jobs)
+
+    def status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._cond:
+            return {name: job.status(now) for name, job in self.jobs.items()}
+
+    def command(self, line: str) -> Dict[str, Any]:
+        """
+        Handle a control command: "status" or "sync [JOB…]".
+        """
+        words = line.split()
+        if words == ['status']:
+            return {'status': self.status()}
+        elif words[:1] == ['sync']:
+            return {'triggered': self.trigger(words[1:])}
+        else:
+            raise ValueError(f"unknown command: {line.strip()}")
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def run_pending(self) -> bool:
+        """
+        Run the first job that is due. Returns False if there was none.
+        """
+        with self._cond:
+            job = next((j for j in self.jobs.values() if j.due(time.monotonic())), None)
+            if job is None:
+                return False
+            job.pending, job.running, job.last_started = False, True, time.time()
+
+        logging.info(f"daemon: running {job.name}")
+        error = None
+        try:
+            job.run()
+        except Exception as e:
+            logging.exception(f"daemon: {job.name} failed")
+            error = f"{type(e).__name__}: {e}"
+
+        with self._cond:
+            job.running, job.runs, job.last_finished, job.last_error = False, job.runs + 1, time.time(), error
+            job.next_run = time.monotonic() + job.interval + random.uniform(0, self.jitter)
+        return True
+
+    def run_forever(self) -> None:
+        while not self._stopped:
+            if self.run_pending():
+                continue
+
+            with self._cond:
+                if self._stopped or any(j.pending for j in self.jobs.values()):
+                    continue
+                scheduled = [j.next_run for j in self.jobs.values() if j.interval > 0]
+                timeout = max(0.0, min(scheduled) - time.monotonic()) if scheduled else None
+                self._cond.wait(timeout)
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    server: "ControlServer"
+
+    def handle(self) -> None:
+        line = self.rfile.readline().decode('utf-8', errors='replace')
+        try:
+            reply = self.server.scheduler.command(line)
+        except ValueError as e:
+            reply = {'error': str(e)}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b"\n")
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: Path, scheduler: Scheduler):
+        self.scheduler = scheduler
+        super().__init__(str(path), _ControlHandler)
+
+
+@contextmanager
+def control_server(scheduler: Scheduler, path: Path) -> Iterator[ControlServer]:
+    """
+    Serve control commands on a unix socket at path (accessible only to the current user) in
+    a background thread.
+    """
+    if path.exists():
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(str(path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                path.unlink(missing_ok=True)  # left behind by a daemon that didn't exit cleanly
+            else:
+                raise RuntimeError(f"another daemon is already listening on {path}")
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    old_umask = os.umask(0o177)
+    try:
+        server = ControlServer(path, scheduler)
+    finally:
+        os.umask(old_umask)
+
+    thread = threading.Thread(target=server.serve_forever, name="control", daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        path.unlink(missing_ok=True)
+
+
+def control(path: Path, command: str, timeout: float = 10.0) -> Dict[str, Any]:
+    """
+    Send a control command to a running daemon and return its reply.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(str(path))
+        s.sendall(command.encode('utf-8') + b"\n")
+        with s.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+def jobs(config: config.DaemonConfig, db: sqlite3.Connection, api: "StravaAPI", web: "StravaWeb") -> List[Job]:
+    def activities() -> None:
+        sync.update_activities(config, api, db)
+        geometry.update_geometry(db)
+
+    return [
+        Job(name='bikes', run=lambda: sync.sync_bikes(api, db), interval=config.bikes_interval),
+        Job(name='activities', run=activities, interval=config.activities_interval),
+        Job(name='gpx', run=lambda: gpx.update_gpx(config, web, db), interval=config.gpx_interval),
+    ]
+
+
+def run(config: config.DaemonConfig, api: "StravaAPI", web: "StravaWeb") -> None:
+    config.dir_activities.mkdir(parents=True, exist_ok=True)
+
+    with sync.database(config) as db:
+        for table in sync.schema.tables:
+            table.convert_json(db)
+
+        scheduler = Scheduler(jobs(config, db, api, web), jitter=config.jitter)
+        with control_server(scheduler, config.control_socket):
+            signal.signal(signal.SIGTERM, lambda _signum, _frame: scheduler.stop())
+            try:
+                scheduler.run_forever()
+            except KeyboardInterrupt:
+                pass
@@ -0,0 +1,193 @@
+import base64
+import csv
+import io
+import json
+import sqlite3
+from typing import Any
+from typing import BinaryIO
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+FORMATS = ['csv', 'ndjson', 'parquet', 'arrow']
+
+# tables that can be exported by name (others either hold binary data or are internal)
+TABLES = ['activity', 'bike', 'activity_summary', 'activity_track_stats', 'gpx_file', 'gpx_download']
+
+
+def table_query(db: sqlite3.Connection, table: str) -> str:
+    if table not in TABLES:
+        raise ValueError(f"unknown table: {table}")
+    columns = [row['name'] for row in db.execute(f"PRAGMA table_info({table})")]
+    # raw json replies may be stored compressed
+    return f"SELECT {', '.join('json_text(json) AS json' if c == 'json' else c for c in columns)} FROM {table}"
+
+
+def batches(cursor: sqlite3.Cursor, batch_size: int) -> Iterator[List[Tuple[Any, ...]]]:
+    cursor.arraysize = batch_size
+    while batch := cursor.fetchmany():
+        yield batch
+
+
+def _json_value(v: Any) -> Any:
+    # blobs (e.g. track data) as base64, as neither csv nor json can hold binary data
+    return base64.b64encode(v).decode('ascii') if isinstance(v, bytes) else v
+
+
+def _write_csv(names: Sequence[str], rows: Iterator[List[Tuple[Any, ...]]], f: BinaryIO) -> None:
+    text = io.TextIOWrapper(f, encoding='utf-8', newline='', write_through=True)
+    try:
+        writer = csv.writer(text)
+        writer.writerow(names)
+        for batch in rows:
+            writer.writerows([_json_value(v) for v in row] for row in batch)
+    finally:
+        text.detach()
+
+
+def _write_ndjson(names: Sequence[str], rows: Iterator[List[Tuple[Any, ...]]], f: BinaryIO) -> None:
+    for batch in rows:
+        f.write("".join(
+            json.dumps({n: _json_value(v) for n, v in zip(names, row)}, ensure_ascii=False) + "\n" for row in batch
+        ).encode('utf-8'))
+
+
+def _arrow_type(types: Set[type]) -> Any:
+    import pyarrow as pa
+
+    # sqlite is dynamically typed, so the type of a column is the widest type of its values
+    types = types - {type(None)}
+    if not types:
+        return pa.string()
+    elif types <= {int}:
+        return pa.int64()
+    elif types <= {int, float}:
+        return pa.float64()
+    elif bytes in types:  # anything can be stored as bytes
+        return pa.binary()
+    else:
+        return pa.string()
+
+
+def _guess_arrow_types(rows: Iterator[List[Tuple[Any, ...]]], columns: int) -> List[Any]:
+    """
+    Guess arrow types of query results by looking at all rows (an extra pass over the query, but
+    guessing from the first batch only fails on columns that are e.g. NULL or integer at first).
+    """
+    types: List[Set[type]] = [set() for _ in range(columns)]
+    for batch in rows:
+        for t, column in zip(types, zip(*batch)):
+            t.update(map(type, column))
+    return [_arrow_type(t) for t in types]
+
+
+def _arrow_values(values: Sequence[Any], type: Any) -> List[Any]:
+    import pyarrow as pa
+
+    def convert(v: Any) -> Any:
+        if v is None:
+            return None
+        elif type == pa.bool_():  # sqlite stores booleans as 0/1
+            return bool(v)
+        elif type == pa.float64():
+            return float(v)
+        elif type == pa.string() and not isinstance(v, str):
+            return str(v)
+        elif type == pa.binary() and not isinstance(v, bytes):
+            return str(v).encode('utf-8')
+        return v
+
+    return [convert(v) for v in values]
+
+
+def _write_arrow(
+    names: Sequence[str], rows: Iterator[List[Tuple[Any, ...]]], f: BinaryIO, format: str, types: Sequence[Any],
+) -> None:
+    import pyarrow as pa
+    import pyarrow.parquet
+
+    schema = pa.schema(list(zip(names, types)))
+
+    def record_batch(batch: List[Tuple[Any, ...]]) -> Any:
+        columns = list(zip(*batch))
+        return pa.record_batch(
+            [pa.array(_arrow_values(c, t), type=t) for c, t in zip(columns, schema.types)], schema=schema)
+
+    if format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(f, schema)
+    else:
+        writer = pa.ipc.new_file(f, schema)
+    with writer:
+        for batch in rows:
+            writer.write_batch(record_batch(batch))
+
+
+def _declared_arrow_types(db: sqlite3.Connection, table: str) -> List[Optional[Any]]:
+    """
+    Arrow types of table columns by their declared types, None for columns declared without any
+    (e.g. those of rollups, whose type is that of the summarized columns).
+    """
+    import pyarrow as pa
+
+    def arrow_type(declared: str) -> Optional[Any]:
+        # see https://www.sqlite.org/datatype3.html#determination_of_column_affinity
+        declared = declared.upper()
+        if not declared:
+            return None
+        elif declared == "BOOLEAN":
+            return pa.bool_()
+        elif "INT" in declared:
+            return pa.int64()
+        elif any(t in declared for t in ("CHAR", "CLOB", "TEXT")):
+            return pa.string()
+        elif any(t in declared for t in ("REAL", "FLOA", "DOUB")):
+            return pa.float64()
+        else:
+            return pa.binary()
+
+    return [
+        pa.string() if row['name'] == 'json' else arrow_type(row['type'])
+        for row in db.execute(f"PRAGMA table_info({table})")
+    ]
+
+
+def export(
+    db: sqlite3.Connection,
+    f: BinaryIO,
+    format: str,
+    table: Optional[str] = None,
+    sql: Optional[str] = None,
+    batch_size: int = 1000,
+) -> None:
+    """
+    Export a table or the result of a query to f, streaming it in batches of batch_size rows so that
+    memory use doesn't depend on the size of the result. Parquet and Arrow IPC (file) formats need
+    pyarrow, and query results (and tables with untyped columns) are read twice for these, as types
+    must be known before writing.
+    Blobs are written as base64 in csv and ndjson.
+    """
+    if (table is None) == (sql is None):
+        raise ValueError("exactly one of table and sql must be given")
+    if format not in FORMATS:
+        raise ValueError(f"unknown format: {format}")
+
+    query = table_query(db, table) if table is not None else sql
+    assert query is not None
+    cursor = db.execute(query)
+    names = [d[0] for d in cursor.description or ()]
+    rows = batches(cursor, batch_size)
+    if format == 'csv':
+        _write_csv(names, rows, f)
+    elif format == 'ndjson':
+        _write_ndjson(names, rows, f)
+    else:
+        types = _declared_arrow_types(db, table) if table is not None else [None] * len(names)
+        if None in types:
+            # types of query results and untyped table columns are guessed from their values
+            guessed = _guess_arrow_types(rows, len(names))
+            types = [t if t is not None else g for t, g in zip(types, guessed)]
+            rows = batches(db.execute(query), batch_size)
+        _write_arrow(names, rows, f, format, types)
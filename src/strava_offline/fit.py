@@ -0,0 +1,171 @@
+"""
+Minimal decoder of Garmin FIT activity files, extracting just the track points ("record" messages).
+See the FIT protocol description in the FIT SDK (https://developer.garmin.com/fit/protocol/).
+"""
+
+from dataclasses import dataclass
+import struct
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Protocol
+from typing import Tuple
+
+# FIT timestamps are seconds since 1989-12-31T00:00:00Z
+FIT_EPOCH = 631065600
+
+MESG_RECORD = 20
+
+FIELD_TIMESTAMP = 253
+FIELD_POSITION_LAT = 0
+FIELD_POSITION_LONG = 1
+FIELD_ALTITUDE = 2
+FIELD_HEART_RATE = 3
+FIELD_ENHANCED_ALTITUDE = 78
+
+# record fields we decode: struct format and invalid value
+RECORD_FIELDS = {
+    FIELD_TIMESTAMP: ('I', 0xFFFFFFFF),
+    FIELD_POSITION_LAT: ('i', 0x7FFFFFFF),
+    FIELD_POSITION_LONG: ('i', 0x7FFFFFFF),
+    FIELD_ALTITUDE: ('H', 0xFFFF),
+    FIELD_HEART_RATE: ('B', 0xFF),
+    FIELD_ENHANCED_ALTITUDE: ('I', 0xFFFFFFFF),
+}
+
+SEMICIRCLES = 180 / 2 ** 31
+
+
+class Readable(Protocol):
+    def read(self, n: int = -1, /) -> bytes:
+        pass
+
+
+class FitError(Exception):
+    pass
+
+
+class TrackPoint(NamedTuple):
+    time: Optional[float]  # epoch
+    lat: Optional[float]
+    lon: Optional[float]
+    ele: Optional[float]
+    hr: Optional[int]
+
+
+@dataclass
+class _Definition:
+    global_num: int
+    endian: str
+    fields: List[Tuple[int, int]]  # field number, size
+    size: int  # total size of data message, including developer fields
+
+
+def _read(f: Readable, n: int) -> bytes:
+    data = f.read(n)
+    if len(data) != n:
+        raise FitError("unexpected end of file")
+    return data
+
+
+def _decode_record(d: _Definition, data: bytes, timestamp: Optional[int]) -> TrackPoint:
+    values: Dict[int, int] = {}
+    offset = 0
+    for num, size in d.fields:
+        if num in RECORD_FIELDS:
+            fmt, invalid = RECORD_FIELDS[num]
+            if struct.calcsize(fmt) == size:
+                value = struct.unpack_from(d.endian + fmt, data, offset)[0]
+                if value != invalid:
+                    values[num] = value
+        offset += size
+
+    if FIELD_TIMESTAMP in values:
+        timestamp = values[FIELD_TIMESTAMP]
+    altitude = values.get(FIELD_ENHANCED_ALTITUDE, values.get(FIELD_ALTITUDE))
+    lat, lon = values.get(FIELD_POSITION_LAT), values.get(FIELD_POSITION_LONG)
+    return TrackPoint(
+        time=timestamp + FIT_EPOCH if timestamp is not None else None,
+        lat=lat * SEMICIRCLES if lat is not None else None,
+        lon=lon * SEMICIRCLES if lon is not None else None,
+        ele=altitude / 5 - 500 if altitude is not None else None,
+        hr=values.get(FIELD_HEART_RATE),
+    )
+
+
+def read_track_points(f: Readable) -> Iterator[TrackPoint]:
+    """
+    Decode track points from a FIT file, reading it sequentially (f needn't be seekable).
+    CRCs aren't checked.
+    """
+    header_size = _read(f, 1)[0]
+    header = _read(f, header_size - 1)
+    if header_size < 12 or header[7:11] != b".FIT":
+        raise FitError("not a FIT file")
+    data_size = struct.unpack_from('<I', header, 3)[0]
+
+    definitions: Dict[int, _Definition] = {}
+    last_timestamp: Optional[int] = None
+    read = 0
+    while read < data_size:
+        record_header = _read(f, 1)[0]
+        read += 1
+
+        if record_header & 0x80:
+            # compressed timestamp header: data message with a 5-bit time offset
+            local_num = (record_header >> 5) & 0x3
+            time_offset = record_header & 0x1F
+            if last_timestamp is not None:
+                timestamp = (last_timestamp & ~0x1F) + time_offset
+                if time_offset < last_timestamp & 0x1F:
+                    timestamp += 0x20
+                last_timestamp = timestamp
+            definition = definitions.get(local_num)
+            if definition is None:
+                raise FitError(f"data message for undefined local message type {local_num}")
+            data = _read(f, definition.size)
+            read += definition.size
+            if definition.global_num == MESG_RECORD:
+                yield _decode_record(definition, data, last_timestamp)
+        elif record_header & 0x40:
+            # definition message
+            local_num = record_header & 0xF
+            architecture = _read(f, 2)[1]
+            endian = '>' if architecture else '<'
+            global_num, num_fields = struct.unpack(endian + 'HB', _read(f, 3))
+            field_defs = _read(f, 3 * num_fields)
+            read += 5 + 3 * num_fields
+            fields = [(field_defs[i], field_defs[i + 1]) for i in range(0, 3 * num_fields, 3)]
+            size = sum(size for _, size in fields)
+            if record_header & 0x20:
+                # developer data fields: skipped, but they count towards the message size
+                num_dev_fields = _read(f, 1)[0]
+                dev_field_defs = _read(f, 3 * num_dev_fields)
+                read += 1 + 3 * num_dev_fields
+                size += sum(dev_field_defs[i + 1] for i in range(0, 3 * num_dev_fields, 3))
+            definitions[local_num] = _Definition(global_num=global_num, endian=endian, fields=fields, size=size)
+        else:
+            # normal data message
+            local_num = record_header & 0xF
+            definition = definitions.get(local_num)
+            if definition is None:
+                raise FitError(f"data message for undefined local message type {local_num}")
+            data = _read(f, definition.size)
+            read += definition.size
+            timestamp_field = _timestamp(definition, data)
+            if timestamp_field is not None:
+                last_timestamp = timestamp_field
+            if definition.global_num == MESG_RECORD:
+                yield _decode_record(definition, data, last_timestamp)
+
+
+def _timestamp(d: _Definition, data: bytes) -> Optional[int]:
+    offset = 0
+    for num, size in d.fields:
+        if num == FIELD_TIMESTAMP and size == 4:
+            value = struct.unpack_from(d.endian + 'I', data, offset)[0]
+            return value if value != 0xFFFFFFFF else None
+        offset += size
+    return None
@@ -0,0 +1,136 @@
+import logging
+import re
+import sqlite3
+import struct
+from typing import List
+from typing import Optional
+from typing import Sequence
+
+from . import config
+from . import polyline
+from .fit import TrackPoint
+from .sqlite import chunked
+from .sync import database
+from .tracks import LON_TURN
+from .tracks import TRACK_COLUMNS
+from .tracks import TRACK_FORMAT_V1
+from .tracks import TRACK_HEADER
+from .tracks import encode_track
+
+# polylines are stored at 1e5 precision, tracks at 1e7
+POLYLINE_SCALE = TRACK_COLUMNS['lat'] // 10 ** 5
+
+# values are chunks of 5 bits + 63, with 0x20 set on all but the last chunk, and come in lat/lon pairs
+POLYLINE_RE = re.compile(r'(?:[_-~]*[?-^][_-~]*[?-^])*')
+
+LAT_LON_MASK = 1 << list(TRACK_COLUMNS).index('lat') | 1 << list(TRACK_COLUMNS).index('lon')
+
+
+def _polyline_track(p: str) -> Optional[bytes]:
+    try:
+        return encode_track(
+            TrackPoint(time=None, lat=lat, lon=lon, ele=None, hr=None)
+            for lat, lon in polyline.decode(p))
+    except OverflowError:
+        return None
+
+
+def _polyline_tracks_numpy(polylines: Sequence[str]) -> List[Optional[bytes]]:
+    import numpy as np
+
+    lengths = np.fromiter(map(len, polylines), dtype=np.int64, count=len(polylines))
+    chunks = np.frombuffer("".join(polylines).encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    last = (chunks & 0x20) == 0  # chunk terminates a value
+
+    # decode all values at once: each value is the sum of its chunks shifted by 5 bits per position
+    ends = np.flatnonzero(last)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    value_of_chunk = np.cumsum(last) - last
+    position = np.arange(len(chunks)) - starts[value_of_chunk]
+    values = np.add.reduceat((chunks & 0x1F) << (5 * position), starts) if len(ends) else np.empty(0, np.int64)
+    values = np.where(values & 1, ~(values >> 1), values >> 1) * POLYLINE_SCALE
+
+    # polylines alternate lat and lon deltas (the first one being absolute)
+    value_offsets = np.concatenate(([0], np.cumsum(last)))[np.concatenate(([0], np.cumsum(lengths)))]
+    point_offsets = value_offsets // 2
+    lat, lon = values[0::2], (values[1::2] + LON_TURN // 2) % LON_TURN - LON_TURN // 2  # see wrap_lon
+    overflow = np.concatenate(([0], np.cumsum(np.abs(lat) > 2 ** 31 - 1)))
+    lat_bytes, lon_bytes = lat.astype('<i4').tobytes(), lon.astype('<i4').tobytes()
+
+    tracks: List[Optional[bytes]] = []
+    for i in range(len(polylines)):
+        a, b = point_offsets[i], point_offsets[i + 1]
+        if overflow[b] != overflow[a]:
+            tracks.append(None)
+        elif a == b:
+            tracks.append(TRACK_HEADER.pack(TRACK_FORMAT_V1, 0, 0))
+        else:
+            tracks.append(b"".join((
+                TRACK_HEADER.pack(TRACK_FORMAT_V1, b - a, LAT_LON_MASK),
+                struct.pack('<q', lat[a]), lat_bytes[4 * (a + 1):4 * b],
+                struct.pack('<q', lon[a]), lon_bytes[4 * (a + 1):4 * b],
+            )))
+    return tracks
+
+
+def polyline_tracks(polylines: Sequence[str]) -> List[Optional[bytes]]:
+    """
+    Decode a batch of polylines into encoded tracks (see tracks.encode_track) with lat and lon only.
+    Uses numpy, if available, to decode the whole batch at once. Malformed polylines (or those
+    too long to encode) give None.
+    """
+    valid = [POLYLINE_RE.fullmatch(p) is not None for p in polylines]
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return [_polyline_track(p) if ok else None for p, ok in zip(polylines, valid)]
+
+    decoded = iter(_polyline_tracks_numpy([p for p, ok in zip(polylines, valid) if ok]))
+    return [next(decoded) if ok else None for ok in valid]
+
+
+def update_geometry(db: sqlite3.Connection, batch_size: int = 1000) -> None:
+    """
+    Decode summary polylines of activities whose json changed since last time into the
+    activity_geometry table.
+    """
+    with db:  # transaction
+        db.execute("BEGIN")
+        deleted = db.execute("""
+            DELETE FROM activity_geometry
+            WHERE NOT EXISTS (SELECT 1 FROM activity a WHERE a.id = activity_geometry.activity_id)
+        """).rowcount
+        todo = db.execute("""
+            SELECT a.id, a.json_hash, json_extract(json_text(a.json), '$.map.summary_polyline') AS summary_polyline
+            FROM activity a LEFT JOIN activity_geometry g ON g.activity_id = a.id
+            WHERE g.json_hash IS NOT a.json_hash
+        """).fetchall()
+
+    decoded, failed = 0, 0
+    for chunk in chunked(todo, batch_size):
+        # decoded in batches to amortize numpy overhead while keeping memory use bounded
+        polylines = [row['summary_polyline'] or "" for row in chunk]
+        with db:  # transaction
+            db.execute("BEGIN")
+            for row, data in zip(chunk, polyline_tracks(polylines)):
+                if data is None:
+                    logging.error(f"failed to decode summary polyline of activity {row['id']}")
+                    failed += 1
+                db.execute(
+                    """
+                    INSERT OR REPLACE INTO activity_geometry (activity_id, json_hash, points, data)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    (row['id'], row['json_hash'], TRACK_HEADER.unpack_from(data)[1] if data else None, data))
+        decoded += len(chunk)
+        logging.info(f"activity_geometry: decoded {decoded}/{len(todo)} summary polylines")
+
+    if deleted:
+        logging.info(f"activity_geometry: deleted {deleted} rows whose activity is gone")
+    if failed:
+        logging.warning(f"failed to decode {failed} summary polylines")
+
+
+def sync(config: config.DatabaseConfig):
+    with database(config) as db:
+        update_geometry(db=db)
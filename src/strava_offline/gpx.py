@@ -1,71 +1,281 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 import gzip
 import logging
+import os
 from pathlib import Path
+import re
 import sqlite3
+import threading
+import time
+from typing import Dict
 from typing import Optional
+from typing import TYPE_CHECKING
 
 from . import config
-from .strava import StravaWeb
 from .sync import database
 
+if TYPE_CHECKING:
+    from .strava import StravaWeb
 
-def find_gpx(d: Path, i: int) -> Optional[Path]:
-    for suffix in [".gpx", ".gpx.gz"]:
-        p = Path(d, str(i) + suffix)
-        if p.exists():
-            return p
+GPX_SUFFIXES = [".gpx", ".gpx.gz"]  # in order of preference if there are several files for one id
+GPX_FILENAME_RE = re.compile(r'(\d+)(\.gpx(?:\.gz)?)')
 
-    return None
+# failed downloads are retried after 1 hour, 2 hours, 4 hours, ... and given up after several days
+DOWNLOAD_RETRY_DELAY = 60 * 60
+DOWNLOAD_MAX_ATTEMPTS = 8
+
+
+def scan_gpx(d: Path) -> Dict[int, str]:
+    """
+    Find gpx files named by (activity or upload) id in directory d, using a single directory listing
+    (no stat calls). Returns file names indexed by id.
+    """
+    found = []
+    with os.scandir(d) as entries:
+        for entry in entries:
+            if (m := GPX_FILENAME_RE.fullmatch(entry.name)) and entry.is_file():
+                found.append((int(m[1]), m[2], entry.name))
+
+    files: Dict[int, str] = {}
+    for i, _, name in sorted(found, key=lambda f: GPX_SUFFIXES.index(f[1])):
+        files.setdefault(i, name)
+    return files
+
+
+def record_gpx_file(db: sqlite3.Connection, activity_id: int, path: Path, source: str) -> None:
+    stat = path.stat()
+    db.execute(
+        """
+        INSERT OR REPLACE INTO gpx_file (activity_id, path, suffix, size, mtime, source)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (activity_id, path.name, "".join(path.suffixes), stat.st_size, stat.st_mtime, source))
+
+
+def index_gpx_files(db: sqlite3.Connection, dir_activities: Path, stat_all: bool = False) -> None:
+    """
+    Bring the gpx_file table up to date with gpx files in dir_activities. Unless stat_all, only
+    files not already indexed are stat-ed (so that modified files go unnoticed), which makes this
+    cheap even on network filesystems.
+    """
+    files = scan_gpx(dir_activities)
+
+    with db:  # transaction
+        db.execute("BEGIN")
+        db.execute("CREATE TEMP TABLE gpx_scan (activity_id INTEGER PRIMARY KEY, path TEXT)")
+        db.executemany("INSERT INTO temp.gpx_scan (activity_id, path) VALUES (?, ?)", files.items())
+
+        removed = db.execute("""
+            DELETE FROM gpx_file
+            WHERE NOT EXISTS (
+                SELECT 1 FROM temp.gpx_scan s WHERE s.activity_id = gpx_file.activity_id AND s.path = gpx_file.path
+            )
+        """).rowcount
+
+        added = db.execute("""
+            SELECT s.activity_id, s.path
+            FROM temp.gpx_scan s LEFT JOIN gpx_file f USING (activity_id)
+            WHERE f.activity_id IS NULL
+        """).fetchall()
+        for row in added:
+            record_gpx_file(db, row['activity_id'], Path(dir_activities, row['path']), source='existing')
+
+        modified = 0
+        if stat_all:
+            for row in db.execute("SELECT activity_id, path, size, mtime FROM gpx_file").fetchall():
+                stat = Path(dir_activities, row['path']).stat()
+                if (stat.st_size, stat.st_mtime) != (row['size'], row['mtime']):
+                    db.execute(
+                        "UPDATE gpx_file SET size = ?, mtime = ? WHERE activity_id = ?",
+                        (stat.st_size, stat.st_mtime, row['activity_id']))
+                    modified += 1
+
+        db.execute("DROP TABLE temp.gpx_scan")
+
+    if added or removed or modified:
+        logging.info(f"gpx_file: {len(added)} files added to index, {removed} removed, {modified} modified")
 
 
 def link_backup_activities(
         db: sqlite3.Connection,
         dir_activities: Path, dir_activities_backup: Path) -> None:
-    for activity in db.execute("SELECT id, upload_id FROM activity WHERE upload_id IS NOT NULL"):
-        activity_id = int(activity['id'])
-        upload_id = int(activity['upload_id'])
+    """
+    Hardlink gpx files from Strava backup (named by either activity or upload id) for activities
+    that don't have one yet. Expects gpx_file to be up to date (see index_gpx_files).
+    """
+    backup = scan_gpx(dir_activities_backup)
+
+    with db:  # transaction
+        db.execute("BEGIN")
+        db.execute("CREATE TEMP TABLE gpx_backup (id INTEGER PRIMARY KEY, path TEXT)")
+        db.executemany("INSERT INTO temp.gpx_backup (id, path) VALUES (?, ?)", backup.items())
 
-        if find_gpx(dir_activities, activity_id):
-            continue
+        missing = db.execute("""
+            SELECT a.id, IFNULL(b_activity.path, b_upload.path) AS path
+            FROM activity a
+            LEFT JOIN temp.gpx_backup b_activity ON b_activity.id = a.id
+            LEFT JOIN temp.gpx_backup b_upload ON b_upload.id = CAST(a.upload_id AS INTEGER)
+            WHERE a.upload_id IS NOT NULL
+            AND (b_activity.id IS NOT NULL OR b_upload.id IS NOT NULL)
+            AND NOT EXISTS (SELECT 1 FROM gpx_file f WHERE f.activity_id = a.id)
+        """).fetchall()
+        for activity in missing:
+            backup_path = Path(dir_activities_backup, activity['path'])
+            link = Path(dir_activities, str(activity['id']) + "".join(backup_path.suffixes))
+            link.hardlink_to(backup_path)
+            record_gpx_file(db, activity['id'], link, source='linked')
 
-        backup = find_gpx(dir_activities_backup, activity_id) or find_gpx(dir_activities_backup, upload_id)
-        if backup:
-            link = Path(dir_activities, str(activity_id) + "".join(backup.suffixes))
-            link.hardlink_to(backup)
+        db.execute("DROP TABLE temp.gpx_backup")
 
+    if missing:
+        logging.info(f"linked gpx for {len(missing)} activities from backup")
 
-def download_gpx(strava: StravaWeb, activity_id: int, path: Path) -> None:
-    gpx = strava.get_gpx(activity_id)
+
+def download_gpx(strava: "StravaWeb", activity_id: int, path: Path) -> Path:
     filename = Path(path, str(activity_id) + ".gpx.gz")
     tmpfilename = Path(path, str(activity_id) + ".gpx.gz.tmp")
-    with gzip.open(tmpfilename, "wb") as f:
-        f.write(gpx)
-    tmpfilename.replace(filename)
+    try:
+        with gzip.open(tmpfilename, "wb") as f:
+            strava.write_gpx(activity_id, f)
+        tmpfilename.replace(filename)
+    finally:
+        tmpfilename.unlink(missing_ok=True)
+    return filename
+
 
+def is_systemic_error(e: Exception) -> bool:
+    """
+    Whether a download failure would likely fail any other download as well (expired session,
+    network outage, rate limit, server error), as opposed to a problem with a single activity.
+    """
+    import requests
 
-def download_activities(db: sqlite3.Connection, strava: StravaWeb, dir_activities: Path) -> None:
-    new = 0
+    from .strava import NotLoggedIn
 
-    for activity in db.execute("SELECT id FROM activity WHERE upload_id IS NOT NULL AND has_location_data"):
-        activity_id = int(activity['id'])
-        if find_gpx(dir_activities, activity_id):
-            continue
+    if isinstance(e, (NotLoggedIn, requests.ConnectionError, requests.Timeout)):
+        return True
+    elif isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+        return status in (401, 403, 429) or status >= 500
+    return False
 
+
+def download_activities(
+    db: sqlite3.Connection,
+    strava: "StravaWeb",
+    dir_activities: Path,
+    concurrency: int = 1,
+    now: Optional[float] = None,
+) -> None:
+    """
+    Download gpx for activities that don't have one yet. Expects gpx_file to be up to date (see
+    index_gpx_files).
+
+    Progress is tracked in the gpx_download table: failed downloads are retried in later runs
+    with exponential backoff, and given up after DOWNLOAD_MAX_ATTEMPTS. Activities that haven't
+    failed yet go first, so that failures don't hold up the rest of the queue.
+
+    Systemic failures (see is_systemic_error) abort the run instead, without counting an attempt
+    against any activity, and are re-raised.
+    """
+    now = int(now if now is not None else time.time())
+
+    with db:  # transaction
+        db.execute("BEGIN")
+        db.execute("""
+            INSERT INTO gpx_download (activity_id, state, attempts)
+            SELECT a.id, 'pending', 0 FROM activity a
+            WHERE a.upload_id IS NOT NULL AND a.has_location_data
+            AND NOT EXISTS (SELECT 1 FROM gpx_file f WHERE f.activity_id = a.id)
+            ON CONFLICT (activity_id) DO UPDATE SET state = 'pending' WHERE state = 'done'
+        """)
+        activity_ids = [row['activity_id'] for row in db.execute("""
+            SELECT d.activity_id FROM gpx_download d JOIN activity a ON a.id = d.activity_id
+            WHERE (d.state = 'pending' OR (d.state = 'failed' AND d.attempts < ? AND d.next_retry <= ?))
+            AND NOT EXISTS (SELECT 1 FROM gpx_file f WHERE f.activity_id = d.activity_id)
+            ORDER BY d.attempts, a.start_time DESC
+        """, (DOWNLOAD_MAX_ATTEMPTS, now))]
+
+    abort = threading.Event()
+
+    def download(activity_id: int) -> Optional[Path]:
+        if abort.is_set():
+            return None
         logging.debug(f"downloading gpx for activity {activity_id}")
-        download_gpx(strava=strava, activity_id=activity_id, path=dir_activities)
-        new += 1
+        try:
+            return download_gpx(strava=strava, activity_id=activity_id, path=dir_activities)
+        except Exception as e:
+            if is_systemic_error(e):
+                abort.set()
+            raise
+
+    new, failed = 0, 0
+    aborted: Optional[Exception] = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(download, activity_id): activity_id for activity_id in activity_ids}
+        for future in as_completed(futures):
+            activity_id = futures[future]
+            try:
+                path = future.result()
+            except Exception as e:
+                if is_systemic_error(e):
+                    if aborted is None:
+                        logging.error(f"aborting gpx downloads: {e}")
+                        aborted = e
+                    continue
+
+                logging.error(f"failed to download gpx for activity {activity_id}: {e}")
+                db.execute("""
+                    UPDATE gpx_download
+                    SET state = 'failed', attempts = attempts + 1, last_error = ?,
+                        next_retry = ? + ? * (1 << MIN(attempts, 20))
+                    WHERE activity_id = ?
+                """, (str(e), now, DOWNLOAD_RETRY_DELAY, activity_id))
+                failed += 1
+                continue
+
+            if path is None:  # skipped after abort
+                continue
+            record_gpx_file(db, activity_id, path, source='downloaded')
+            db.execute("""
+                UPDATE gpx_download
+                SET state = 'done', attempts = attempts + 1, last_error = NULL, next_retry = NULL
+                WHERE activity_id = ?
+            """, (activity_id,))
+            new += 1
 
     logging.info(f"downloaded gpx for {new} new activities")
+    if failed:
+        logging.warning(f"failed to download gpx for {failed} activities, will retry later")
+
+    given_up = db.execute(
+        "SELECT COUNT(*) FROM gpx_download WHERE state = 'failed' AND attempts >= ?",
+        (DOWNLOAD_MAX_ATTEMPTS,)).fetchone()[0]
+    if given_up:
+        logging.info(f"gave up downloading gpx for {given_up} activities (see the gpx_download table)")
+
+    if aborted is not None:
+        raise aborted
+
 
+def update_gpx(config: config.GpxConfig, strava: "StravaWeb", db: sqlite3.Connection) -> None:
+    index_gpx_files(db=db, dir_activities=config.dir_activities)
 
-def sync(config: config.GpxConfig, strava: StravaWeb):
+    if config.dir_activities_backup:
+        link_backup_activities(
+            db=db,
+            dir_activities=config.dir_activities,
+            dir_activities_backup=config.dir_activities_backup)
+
+    download_activities(
+        db=db, strava=strava,
+        dir_activities=config.dir_activities,
+        concurrency=config.download_concurrency)
+
+
+def sync(config: config.GpxConfig, strava: "StravaWeb"):
     config.dir_activities.mkdir(parents=True, exist_ok=True)
 
     with database(config) as db:
-        if config.dir_activities_backup:
-            link_backup_activities(
-                db=db,
-                dir_activities=config.dir_activities,
-                dir_activities_backup=config.dir_activities_backup)
-
-        download_activities(db=db, strava=strava, dir_activities=config.dir_activities)
+        update_gpx(config, strava, db)
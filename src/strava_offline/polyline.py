@@ -0,0 +1,28 @@
+from typing import List
+from typing import Tuple
+
+
+def decode(polyline: str, precision: int = 5) -> List[Tuple[float, float]]:
+    """
+    Decode Google's encoded polyline format (as used by Strava's map.summary_polyline) into a list
+    of (lat, lon).
+    See https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    """
+    values = []
+    value, shift = 0, 0
+    for c in polyline:
+        chunk = ord(c) - 63
+        value |= (chunk & 0x1F) << shift
+        shift += 5
+        if not chunk & 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+
+    scale = 10 ** precision
+    points = []
+    lat, lon = 0, 0
+    for d_lat, d_lon in zip(values[0::2], values[1::2]):
+        lat += d_lat
+        lon += d_lon
+        points.append((lat / scale, lon / scale))
+    return points
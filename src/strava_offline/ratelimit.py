@@ -0,0 +1,200 @@
+from dataclasses import dataclass
+import logging
+import math
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from requests import PreparedRequest
+from requests import Response
+from requests.adapters import HTTPAdapter
+
+WINDOW_SHORT = 15 * 60
+WINDOW_DAILY = 24 * 60 * 60
+
+
+@dataclass
+class Quota:
+    window: int  # seconds, windows are aligned to multiples of this since epoch (UTC)
+    limit: int
+    usage: int
+    updated: float
+
+    def window_start(self, now: float) -> float:
+        return now - now % self.window
+
+    def reset(self, now: float) -> None:
+        if self.window_start(now) > self.updated:
+            self.usage = 0
+            self.updated = now
+
+    def exhausted(self) -> bool:
+        return self.usage >= self.limit
+
+    def time_left(self, now: float) -> float:
+        return self.window_start(now) + self.window - now
+
+    def pace(self, now: float, pace_after: float) -> float:
+        """
+        Minimum time between requests so that the rest of the quota lasts until the end of the
+        window. Requests aren't paced until pace_after (fraction) of the quota is used up, so that
+        small syncs aren't slowed down.
+        """
+        remaining = self.limit - self.usage
+        if self.usage < self.limit * pace_after or remaining <= 0:
+            return 0.0
+        return self.time_left(now) / remaining
+
+
+def parse_quotas(response: Response, now: float) -> List[Quota]:
+    """
+    Parse Strava rate limit headers (overall and read-only) into a list of quotas.
+    See http://developers.strava.com/docs/rate-limits/
+    """
+    quotas = []
+    for prefix in ("X-RateLimit", "X-ReadRateLimit"):
+        limit = response.headers.get(f"{prefix}-Limit")
+        usage = response.headers.get(f"{prefix}-Usage")
+        if not limit or not usage:
+            continue
+        try:
+            limits = [int(x) for x in limit.split(',')]
+            usages = [int(x) for x in usage.split(',')]
+        except ValueError:
+            continue
+        for window, lim, use in zip((WINDOW_SHORT, WINDOW_DAILY), limits, usages):
+            quotas.append(Quota(window=window, limit=lim, usage=use, updated=now))
+    return quotas
+
+
+class RateLimiter:
+    """
+    Keeps track of the remaining Strava API quota (15-minute and daily windows) using rate limit
+    headers of responses. Once more than pace_after of a 15-minute quota is used, requests are spread
+    evenly over the rest of its window, and whenever any quota is used up, requests are held back
+    until the next window. Thread-safe, so one limiter can be shared by concurrent requests (see
+    shared_limiter).
+    """
+
+    def __init__(
+        self,
+        clock: Callable[[], float] = time.time,
+        sleep: Callable[[float], None] = time.sleep,
+        pace_after: float = 0.5,
+    ):
+        self._clock = clock
+        self._sleep = sleep
+        self._pace_after = pace_after
+        self._lock = threading.Lock()
+        self._quotas: List[Quota] = []
+        self._blocked_until = 0.0
+        self._last_request = -math.inf
+
+    def _wait_time(self, now: float) -> Tuple[float, float]:
+        """
+        Time to wait for the next window (if any quota is used up), and for pacing.
+        """
+        window = max(0.0, self._blocked_until - now)
+        pace = 0.0
+        for quota in self._quotas:
+            quota.reset(now)
+            if quota.exhausted():
+                window = max(window, quota.time_left(now))
+            elif quota.window == WINDOW_SHORT:
+                # daily quotas aren't paced, spreading half of one over the rest of the day would
+                # hold every request back for a minute or so, long before the 15-minute quotas
+                # limit anything; if a daily quota does run out, requests wait for midnight
+                pace = max(pace, self._last_request + quota.pace(now, self._pace_after) - now)
+        return window, pace
+
+    def acquire(self) -> None:
+        """
+        Wait until a request can be made without exceeding any quota, and count it.
+        """
+        while True:
+            with self._lock:
+                now = self._clock()
+                window, pace = self._wait_time(now)
+                if not window and not pace:
+                    for quota in self._quotas:
+                        quota.usage += 1
+                    self._last_request = now
+                    return
+
+            if window:
+                logging.warning(f"rate limit reached, waiting {window:.0f} seconds")
+                # small margin so that we don't hit the window boundary before the server does
+                self._sleep(window + 1)
+            else:
+                logging.debug(f"rate limit nearly reached, pacing requests {pace:.1f} seconds apart")
+                self._sleep(pace)
+
+    def update(self, response: Response) -> None:
+        with self._lock:
+            now = self._clock()
+            quotas = parse_quotas(response, now)
+            if quotas:
+                self._quotas = quotas
+                usage = ", ".join(f"{q.usage}/{q.limit}" for q in quotas)
+                logging.debug(f"rate limit usage: {usage}")
+
+    def too_many_requests(self) -> None:
+        """
+        Handle HTTP 429: if the headers don't tell us which quota is used up, hold off requests
+        until the end of the current 15-minute window.
+        """
+        with self._lock:
+            now = self._clock()
+            if not any(quota.exhausted() for quota in self._quotas):
+                self._blocked_until = now - now % WINDOW_SHORT + WINDOW_SHORT
+
+    def backoff(self, attempt: int, base: float = 1.0) -> None:
+        self._sleep(base * 2 ** attempt)
+
+
+_shared_limiters: Dict[str, RateLimiter] = {}
+_shared_limiters_lock = threading.Lock()
+
+
+def shared_limiter(scope: str) -> RateLimiter:
+    """
+    Return the limiter of a quota scope (e.g. a Strava API application), shared by all sessions of
+    this process, so that e.g. sessions kept open by the daemon don't each assume the whole quota.
+    """
+    with _shared_limiters_lock:
+        return _shared_limiters.setdefault(scope, RateLimiter())
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    Transport adapter that makes requests through a RateLimiter and retries them on HTTP 429
+    (after the rate limit window resets) and 5xx (with exponential backoff).
+    """
+
+    def __init__(self, limiter: RateLimiter, retries: int = 5, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+        self.retries = retries
+
+    def send(self, request: PreparedRequest, *args, **kwargs) -> Response:  # type: ignore [override]
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            response = super().send(request, *args, **kwargs)
+            self.limiter.update(response)
+
+            if attempt >= self.retries:
+                return response
+            elif response.status_code == 429:
+                self.limiter.too_many_requests()
+            elif 500 <= response.status_code < 600 and request.method in ('GET', 'HEAD'):
+                self.limiter.backoff(attempt)
+            else:
+                return response
+
+            logging.info(f"HTTP {response.status_code} for {request.url}, retrying")
+            response.close()
+            attempt += 1
@@ -1,46 +1,121 @@
+import json
+import logging
 import sqlite3
+from typing import Any
+from typing import Callable
+from typing import Optional
+from typing import Sequence
+from typing import TYPE_CHECKING
 
 from tabulate import tabulate
 
+from . import analytics
+from . import sqlite
+
+if TYPE_CHECKING:
+    from .spatial import BBox
+
+
+def cached(db: sqlite3.Connection, key: Sequence[Any], render: Callable[[], str]) -> str:
+    """
+    Return a report rendered earlier and stored in the report_cache table, unless the database
+    changed since (see sqlite.generation), in which case it's rendered (and stored) again, unless
+    another connection holds the write lock.
+    """
+    generation = sqlite.generation(db)
+    key_json = json.dumps(key)
+    row = db.execute("SELECT generation, result FROM report_cache WHERE key = ?", (key_json,)).fetchone()
+    if row and row['generation'] == generation:
+        return row['result']
+
+    result = render()
+
+    # caching is best-effort: reports must not wait for a sync holding the write lock
+    busy_timeout = db.execute("PRAGMA busy_timeout").fetchone()[0]
+    db.execute("PRAGMA busy_timeout = 0")
+    try:
+        with db:  # transaction
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM report_cache WHERE generation IS NOT ?", (generation,))
+            db.execute(
+                "INSERT OR REPLACE INTO report_cache (key, generation, result) VALUES (?, ?, ?)",
+                (key_json, generation, result))
+    except sqlite3.OperationalError as e:  # database locked or read-only
+        logging.debug(f"failed to cache report: {e}")
+    finally:
+        db.execute(f"PRAGMA busy_timeout = {busy_timeout}")
+    return result
+
 
 def tabulate_execute(db: sqlite3.Connection, sql: str, *params) -> str:
-    table = (dict(row) for row in db.execute(sql, params))
-    return tabulate(table, headers='keys')
+    def render() -> str:
+        table = (dict(row) for row in db.execute(sql, params))
+        return tabulate(table, headers='keys')
+
+    return cached(db, [sql, params], render)
 
 
 def yearly(db: sqlite3.Connection, year: int) -> str:
     return tabulate_execute(db, """
         SELECT
-            a.type AS "Activity type",
-            CAST(SUM(a.distance) / 1000 AS INT) AS "Distance (km)",
-            CAST(SUM(a.moving_time) / 3600 AS INT) AS "Moving time (hour)"
-        FROM activity a
-        WHERE start_date LIKE ?
+            s.type AS "Activity type",
+            CAST(SUM(s.distance) / 1000 AS INT) AS "Distance (km)",
+            CAST(SUM(s.moving_time) / 3600 AS INT) AS "Moving time (hour)"
+        FROM activity_summary s
+        WHERE s.year = ?
         GROUP BY 1
         ORDER BY 2 DESC
-    """, f"{year}-%")
+    """, year)
 
 
 def yearly_bikes(db: sqlite3.Connection, year: int) -> str:
     return tabulate_execute(db, """
         SELECT
             b.name AS "Bike",
-            CAST(SUM(a.distance) / 1000 AS INT) AS "Distance (km)",
-            CAST(SUM(a.moving_time) / 3600 AS INT) AS "Moving time (hour)"
-        FROM activity a INNER JOIN bike b ON a.gear_id = b.id
-        WHERE start_date LIKE ?
+            CAST(SUM(s.distance) / 1000 AS INT) AS "Distance (km)",
+            CAST(SUM(s.moving_time) / 3600 AS INT) AS "Moving time (hour)"
+        FROM activity_summary s INNER JOIN bike b ON s.gear_id = b.id
+        WHERE s.year = ?
         GROUP BY 1
         ORDER BY 2 DESC
-    """, f"{year}-%")
+    """, year)
 
 
 def bikes(db: sqlite3.Connection) -> str:
     return tabulate_execute(db, """
         SELECT
             b.name AS "Bike",
-            CAST(SUM(a.distance) / 1000 AS INT) AS "Distance (km)",
-            CAST(SUM(a.moving_time) / 3600 AS INT) AS "Moving time (hour)"
-        FROM activity a INNER JOIN bike b ON a.gear_id = b.id
+            CAST(SUM(s.distance) / 1000 AS INT) AS "Distance (km)",
+            CAST(SUM(s.moving_time) / 3600 AS INT) AS "Moving time (hour)"
+        FROM activity_summary s INNER JOIN bike b ON s.gear_id = b.id
         GROUP BY 1
         ORDER BY 2 DESC
     """)
+
+
+def area(db: sqlite3.Connection, area: "BBox", within: bool = False) -> str:
+    from .spatial import area_sql
+
+    min_lat, min_lon, max_lat, max_lon = area
+    return tabulate_execute(db, f"""
+        SELECT
+            m.id AS "Activity",
+            a.start_date AS "Date",
+            a.type AS "Type",
+            a.name AS "Name"
+        FROM ({area_sql(within)}) m LEFT JOIN activity a USING (id)
+        ORDER BY a.start_time DESC, m.id DESC
+    """, min_lat, max_lat, min_lon, max_lon)
+
+
+def custom(
+    db: sqlite3.Connection,
+    by: Sequence[str],
+    metrics: Sequence[analytics.Metric],
+    rolling: Optional[int] = None,
+) -> str:
+    def render() -> str:
+        headers, rows = analytics.aggregate(analytics.load(db), by, metrics, rolling)
+        return tabulate(rows, headers=headers, floatfmt=".1f")
+
+    return cached(db, ['custom', by, [str(m) for m in metrics], rolling], render)
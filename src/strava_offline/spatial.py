@@ -0,0 +1,160 @@
+import logging
+import math
+import sqlite3
+from typing import List
+from typing import NamedTuple
+from typing import Sequence
+from typing import Tuple
+
+from .sqlite import bump_generation
+from .sqlite import chunked
+from .tracks import decode_track
+
+# Tracks are split into up to MAX_SEGMENTS segments of at least MIN_SEGMENT_POINTS points each.
+# Segment ids in the rtree are activity_id * MAX_SEGMENTS + segment number.
+MAX_SEGMENTS = 1024
+MIN_SEGMENT_POINTS = 32
+
+
+class BBox(NamedTuple):
+    min_lat: float
+    min_lon: float
+    max_lat: float
+    max_lon: float
+
+
+def bbox(lat: Sequence[float], lon: Sequence[float]) -> BBox:
+    return BBox(min(lat), min(lon), max(lat), max(lon))
+
+
+def segment_bboxes(lat: Sequence[float], lon: Sequence[float]) -> List[BBox]:
+    """
+    Bounding boxes of consecutive segments of a track. Neighbouring segments share their boundary
+    point so that the line between them is covered as well.
+    """
+    n = len(lat)
+    size = max(MIN_SEGMENT_POINTS, math.ceil(n / MAX_SEGMENTS))
+    return [
+        bbox(lat[i:i + size + 1], lon[i:i + size + 1])
+        for i in range(0, max(n - 1, 1), size)
+    ]
+
+
+def _geometry(row: sqlite3.Row) -> Tuple[List[float], List[float]]:
+    data = row['track'] if row['track'] is not None else row['geometry']
+    if data is None:
+        return [], []
+    track = decode_track(data)
+    return track.lat, track.lon
+
+
+def update_index(db: sqlite3.Connection, batch_size: int = 1000) -> None:
+    """
+    Update the activity_rtree (activity bounding boxes) and activity_segment_rtree (bounding boxes
+    of track segments) spatial indexes, using downloaded tracks or, if there's none, the decoded
+    summary polyline. Only activities whose source changed are reindexed.
+    Expects activity_geometry to be up to date (see geometry.update_geometry).
+    """
+    sources = """
+        WITH ids (id) AS (
+            SELECT activity_id FROM activity_geometry WHERE data IS NOT NULL
+            UNION SELECT activity_id FROM track WHERE data IS NOT NULL
+        )
+        SELECT ids.id, CASE
+            WHEN t.data IS NOT NULL THEN 'track:' || t.path || ':' || t.size || ':' || t.mtime
+            ELSE 'geometry:' || g.json_hash
+        END AS source
+        FROM ids
+        LEFT JOIN activity_geometry g ON g.activity_id = ids.id
+        LEFT JOIN track t ON t.activity_id = ids.id AND t.data IS NOT NULL
+    """
+
+    def delete(activity_ids: List[int]) -> None:
+        db.executemany("DELETE FROM activity_rtree WHERE id = ?", ((i,) for i in activity_ids))
+        db.executemany(
+            "DELETE FROM activity_segment_rtree WHERE id BETWEEN ? AND ?",
+            ((i * MAX_SEGMENTS, (i + 1) * MAX_SEGMENTS - 1) for i in activity_ids))
+        db.executemany("DELETE FROM activity_spatial WHERE activity_id = ?", ((i,) for i in activity_ids))
+
+    with db:  # transaction
+        db.execute("BEGIN")
+        gone = [row[0] for row in db.execute(f"""
+            SELECT activity_id FROM activity_spatial
+            WHERE activity_id NOT IN (SELECT id FROM ({sources}))
+        """)]
+        delete(gone)
+        todo = db.execute(f"""
+            SELECT s.id, s.source
+            FROM ({sources}) s LEFT JOIN activity_spatial sp ON sp.activity_id = s.id
+            WHERE sp.source IS NOT s.source
+        """).fetchall()
+        if gone or todo:
+            bump_generation(db, 'activity_rtree')  # invalidate cached area reports
+
+    indexed = 0
+    for chunk in chunked(todo, batch_size):
+        placeholders = ', '.join('?' for _ in chunk)
+        geometries = {row['id']: _geometry(row) for row in db.execute(f"""
+            SELECT s.id, t.data AS track, g.data AS geometry
+            FROM (SELECT activity_id AS id FROM activity_geometry UNION SELECT activity_id FROM track) s
+            LEFT JOIN activity_geometry g ON g.activity_id = s.id
+            LEFT JOIN track t ON t.activity_id = s.id AND t.data IS NOT NULL
+            WHERE s.id IN ({placeholders})
+        """, [row['id'] for row in chunk])}
+
+        with db:  # transaction
+            db.execute("BEGIN")
+            delete([row['id'] for row in chunk])
+            for row in chunk:
+                activity_id = row['id']
+                lat, lon = geometries.get(activity_id, ([], []))
+                if lat:
+                    db.execute(
+                        "INSERT INTO activity_rtree (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)",
+                        (activity_id, *_rtree_order(bbox(lat, lon))))
+                    db.executemany(
+                        """
+                        INSERT INTO activity_segment_rtree (id, min_lat, max_lat, min_lon, max_lon, activity_id)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        (
+                            (activity_id * MAX_SEGMENTS + i, *_rtree_order(b), activity_id)
+                            for i, b in enumerate(segment_bboxes(lat, lon))
+                        ))
+                db.execute(
+                    "INSERT INTO activity_spatial (activity_id, source) VALUES (?, ?)",
+                    (activity_id, row['source']))
+        indexed += len(chunk)
+        logging.info(f"activity_rtree: indexed {indexed}/{len(todo)} activities")
+
+
+def _rtree_order(b: BBox) -> Tuple[float, float, float, float]:
+    return b.min_lat, b.max_lat, b.min_lon, b.max_lon
+
+
+def area_sql(within: bool = False) -> str:
+    """
+    Query selecting ids of activities passing through an area (or entirely within it, if within),
+    given as parameters min_lat, max_lat, min_lon, max_lon.
+    """
+    if within:
+        return """
+            SELECT r.id AS id FROM activity_rtree r
+            WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lon >= ? AND r.max_lon <= ?
+        """
+    else:
+        return """
+            SELECT DISTINCT r.activity_id AS id FROM activity_segment_rtree r
+            WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+        """
+
+
+def activities_in_area(db: sqlite3.Connection, area: BBox, within: bool = False) -> List[int]:
+    """
+    Ids of activities passing through area (or entirely within it, if within), newest first.
+    Expects the spatial index to be up to date (see update_index).
+    """
+    return [row['id'] for row in db.execute(f"""
+        SELECT m.id FROM ({area_sql(within)}) m LEFT JOIN activity a USING (id)
+        ORDER BY a.start_time DESC, m.id DESC
+    """, _rtree_order(area))]
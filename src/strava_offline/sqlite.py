@@ -1,19 +1,73 @@
 from contextlib import contextmanager
 from dataclasses import dataclass
+from dataclasses import field
+import hashlib
 from itertools import chain
+from itertools import islice
 import json
 import logging
 from pathlib import Path
 import sqlite3
 from typing import Any
 from typing import Callable
+from typing import Dict
 from typing import Iterable
 from typing import Iterator
 from typing import List
 from typing import Mapping
+from typing import Optional
 from typing import Protocol
+from typing import Sequence
 from typing import Tuple
+from typing import TypeVar
 from typing import Union
+import zlib
+
+T = TypeVar('T')
+
+
+# Preset dictionary for zlib compression of raw json replies, contains common keys and values of
+# canonically serialized Strava bikes and activities. Never change this, add a new one instead
+# (compressed blobs are prefixed with a format byte).
+JSON_ZDICT_V1 = (
+    # SummaryGear
+    b'{"converted_distance":0.0,"distance":0,"id":"b","name":"","nickname":null,"primary":false,'
+    b'"resource_state":2,"retired":false}'
+    # SummaryActivity
+    b'{"achievement_count":0,"athlete":{"id":0,"resource_state":1},"athlete_count":1,'
+    b'"average_cadence":0.0,"average_heartrate":0.0,"average_speed":0.0,"average_temp":0,"average_watts":0.0,'
+    b'"comment_count":0,"commute":false,"device_watts":false,"display_hide_heartrate_option":true,'
+    b'"distance":0.0,"elapsed_time":0,"elev_high":0.0,"elev_low":0.0,"end_latlng":[0.0,0.0],'
+    b'"external_id":"garmin_push_","flagged":false,"from_accepted_tag":false,"gear_id":"b","has_heartrate":true,'
+    b'"has_kudoed":false,"heartrate_opt_out":false,"id":0,"kilojoules":0.0,"kudos_count":0,'
+    b'"location_city":null,"location_country":"","location_state":null,"manual":false,'
+    b'"map":{"id":"a0","resource_state":2,"summary_polyline":""},"max_heartrate":0.0,"max_speed":0.0,'
+    b'"max_watts":0,"moving_time":0,"name":"Morning Ride","photo_count":0,"pr_count":0,"private":false,'
+    b'"resource_state":2,"sport_type":"Ride","start_date":"T00:00:00Z","start_date_local":"T00:00:00Z",'
+    b'"start_latlng":[0.0,0.0],"suffer_score":null,"timezone":"(GMT+01:00) Europe/",'
+    b'"total_elevation_gain":0.0,"total_photo_count":0,"trainer":false,"type":"Ride","upload_id":0,'
+    b'"upload_id_str":"","utc_offset":0.0,"visibility":"everyone","weighted_average_watts":0,"workout_type":null}'
+)
+JSON_FORMAT_ZLIB_V1 = 1
+
+
+def json_compress(data_json: str) -> bytes:
+    c = zlib.compressobj(level=9, zdict=JSON_ZDICT_V1)
+    return bytes([JSON_FORMAT_ZLIB_V1]) + c.compress(data_json.encode()) + c.flush()
+
+
+def json_text(data: Union[None, str, bytes]) -> Optional[str]:
+    """
+    Raw json reply as text, whether it's stored compressed or not.
+    Available as a json_text() sql function in connections obtained using database().
+    """
+    if isinstance(data, bytes):
+        if data[0] != JSON_FORMAT_ZLIB_V1:
+            raise ValueError(f"unknown json compression format: {data[0]}")
+        d = zlib.decompressobj(zdict=JSON_ZDICT_V1)
+        return (d.decompress(data[1:]) + d.flush()).decode()
+    else:
+        return data
 
 
 class FromDict(Protocol):
@@ -21,29 +75,118 @@ class FromDict(Protocol):
         pass
 
 
+# canonical serialization so that unchanged data can be recognized by its hash (one encoder, as
+# json.dumps with non-default arguments creates a new one for every call)
+_canonical_json = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+
+
+def json_stored_as_text(db: sqlite3.Connection) -> bool:
+    """
+    Whether json_store() is the identity in this connection, i.e. raw json isn't compressed.
+    """
+    return db.execute("SELECT typeof(json_store('{}'))").fetchone()[0] == 'text'
+
+
+def json_hash(data_json: str) -> int:
+    digest = hashlib.blake2b(data_json.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, byteorder='big', signed=True)
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
 @dataclass(frozen=True)
 class Table:
     name: str
     columns: Mapping[str, str]
     from_dict: FromDict
+    indexes: Sequence[str] = ()
+    # Bump this whenever from_dict changes in a way other than just adding new columns, the table
+    # will be recreated using the stored json data. (Added columns are detected automatically.)
+    version: int = 1
+    batch_size: int = 1000
 
     def _columns(self) -> Iterable[Tuple[str, str]]:
-        return chain(self.columns.items(), (('json', "TEXT"),))
+        return chain(self.columns.items(), (('json', "TEXT"), ('json_hash', "INTEGER")))
+
+    def _column_names(self) -> List[str]:
+        return [name for name, _ in self._columns()]
 
     def _from_dict(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
-        return {'json': json.dumps(data), **self.from_dict(data)}
+        data_json = _canonical_json(data)
+        return {'json': data_json, 'json_hash': json_hash(data_json), **self.from_dict(data)}
 
     def create(self, db: sqlite3.Connection) -> None:
         columns = ', '.join(f"{name} {type}" for name, type in self._columns())
         db.execute(f"CREATE TABLE IF NOT EXISTS {self.name} ({columns})")
 
+    def create_indexes(self, db: sqlite3.Connection) -> None:
+        # indexes must be created after migrations, as existing indexes stay with the renamed table
+        for index in self.indexes:
+            index_name = '_'.join([self.name] + [c.strip() for c in index.split(',')])
+            db.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {self.name} ({index})")
+
+    def fingerprint(self) -> str:
+        return json.dumps({'version': self.version, 'columns': list(self._columns())})
+
     def migrate(self, db: sqlite3.Connection) -> None:
-        for row in db.execute(f"SELECT json FROM {self.name}_old"):
-            self.upsert_row(db, self._from_dict(json.loads(row['json'])))
+        total = db.execute(f"SELECT COUNT(*) FROM {self.name}_old").fetchone()[0]
+        migrated = 0
+        for chunk in chunked(db.execute(f"SELECT json_text(json) AS json FROM {self.name}_old"), self.batch_size):
+            self.upsert_rows(db, (self._from_dict(json.loads(row['json'])) for row in chunk))
+            migrated += len(chunk)
+            logging.info(f"{self.name}: migrated {migrated}/{total} rows")
         db.execute(f"DROP TABLE {self.name}_old")
+        bump_generation(db, self.name)
+
+    def backfill(self, db: sqlite3.Connection, columns: List[str]) -> None:
+        assignments = ', '.join(f"{name} = ?" for name in columns)
+        update_sql = f"UPDATE {self.name} SET {assignments} WHERE rowid = ?"
+        select_sql = f"""
+            SELECT rowid AS rowid, json_text(json) AS json FROM {self.name}
+            WHERE rowid > ? ORDER BY rowid LIMIT ?
+        """
+
+        total = db.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+        backfilled = 0
+        last_rowid = -1
+        while chunk := db.execute(select_sql, (last_rowid, self.batch_size)).fetchall():
+            updates = []
+            for row in chunk:
+                values = self._from_dict(json.loads(row['json'])) if row['json'] is not None else {}
+                updates.append((*(values.get(name) for name in columns), row['rowid']))
+            db.executemany(update_sql, updates)
+
+            last_rowid = chunk[-1]['rowid']
+            backfilled += len(chunk)
+            logging.info(f"{self.name}: backfilled {', '.join(columns)} in {backfilled}/{total} rows")
+        bump_generation(db, self.name)
+
+    def prepare_migration(self, db: sqlite3.Connection, fingerprint: Optional[str] = None) -> List[Callable]:
+        if fingerprint == self.fingerprint():
+            return []
+
+        # additive changes (new columns only) are migrated in place by backfilling the new columns
+        # from stored raw json replies
+        if fingerprint is not None:
+            old = json.loads(fingerprint)
+            old_columns = dict(old['columns'])
+            columns = dict(self._columns())
+            new_columns = {name: type for name, type in columns.items() if name not in old_columns}
+            additive = (
+                old['version'] == self.version
+                and all(columns.get(name) == type for name, type in old_columns.items())
+                and not any(c in type.upper() for type in new_columns.values() for c in ("PRIMARY", "UNIQUE"))
+            )
+            if additive:
+                for name, type in new_columns.items():
+                    db.execute(f"ALTER TABLE {self.name} ADD COLUMN {name} {type}")
+                return [lambda db: self.backfill(db, list(new_columns))]
 
-    def prepare_migration(self, db: sqlite3.Connection) -> List[Callable]:
-        # migrate table by re-syncing entries from stored raw json replies
+        # otherwise migrate table by re-syncing entries from stored raw json replies
         try:
             db.execute(f"DROP TABLE IF EXISTS {self.name}_old")
             db.execute(f"ALTER TABLE {self.name} RENAME TO {self.name}_old")
@@ -51,87 +194,326 @@ class Table:
         except sqlite3.DatabaseError:
             return []
 
-    def upsert_row(self, db: sqlite3.Connection, row: Mapping[str, Any]) -> None:
-        keys = ', '.join(row.keys())
-        placeholders = ', '.join('?' for k in row.keys())
-        db.execute(
-            f"INSERT OR REPLACE INTO {self.name} ({keys}) VALUES ({placeholders})",
-            tuple(row.values())
-        )
+    def _upsert_sql(self, db: sqlite3.Connection) -> str:
+        names = self._column_names()
+        keys = ', '.join(names)
+        # calling json_store() for every row costs more than executemany saves, skip it unless it compresses
+        json_placeholder = '?' if json_stored_as_text(db) else 'json_store(?)'
+        placeholders = ', '.join(json_placeholder if k == 'json' else '?' for k in names)
+        # not INSERT OR REPLACE, which deletes the old row without firing delete triggers
+        updates = ', '.join(f"{k} = excluded.{k}" for k in names if k != 'id')
+        return f"INSERT INTO {self.name} ({keys}) VALUES ({placeholders}) ON CONFLICT (id) DO UPDATE SET {updates}"
+
+    def upsert_rows(self, db: sqlite3.Connection, rows: Iterable[Mapping[str, Any]]) -> None:
+        # same statement (and thus same column order) for all rows, fed to executemany in batches
+        names = self._column_names()
+        sql = self._upsert_sql(db)
+        for chunk in chunked(rows, self.batch_size):
+            db.executemany(sql, [[row.get(k) for k in names] for row in chunk])
+
+    def convert_json(self, db: sqlite3.Connection) -> None:
+        """
+        Convert raw json replies stored in the other format after compression has been turned on/off.
+        """
+        with db:  # transaction
+            db.execute("BEGIN")
+            converted = db.execute(f"""
+                UPDATE {self.name} SET json = json_store(json_text(json))
+                WHERE typeof(json) NOT IN ('null', (SELECT typeof(json_store('{{}}'))))
+            """).rowcount
+            if converted:
+                logging.info(f"{self.name}: converted stored json of {converted} rows")
 
     def upsert(
         self,
         db: sqlite3.Connection,
         data: Iterable[Mapping[str, Any]],
-        incremental: bool = False
+        incremental: bool = False,
+        incremental_stop_after: Optional[int] = 10,
     ):
+        """
+        Insert/update rows from data. Unless incremental, delete rows not present in data.
+        If incremental, stop after seeing incremental_stop_after rows that were already present
+        (assumes data is ordered newest first).
+        """
         rows = (self._from_dict(datum) for datum in data)
-        with db:  # transaction
-            db.execute("BEGIN")
 
-            old_ids = set(r['id'] for r in db.execute(f"SELECT id FROM {self.name}"))
-            seen = 0
-            new = 0
-            deleted = 0
+        # data is typically fetched from Strava while being iterated, which can take hours when rate
+        # limited, so rather than holding the write lock (and making other commands fail with
+        # "database is locked") all that time, rows are written in batches, each in a transaction
+        # of its own, and existing rows are looked up outside of any.
+
+        # ids seen during a full sync are staged in a table so that deletions can be detected by
+        # sqlite itself, without holding all ids in memory. It's a table in the main database rather
+        # than a temporary one, which would be kept in memory with the default --sqlite-temp-store
+        # (one left behind by an interrupted sync is replaced).
+        if not incremental:
+            db.execute(f"DROP TABLE IF EXISTS main.{self.name}_seen")
+            db.execute(f"CREATE TABLE main.{self.name}_seen (id PRIMARY KEY) WITHOUT ROWID")
 
-            for row in rows:
-                logging.debug(f"{self.name}: {row['id']} {'seen' if row['id'] in old_ids else 'new'}")
+        new = 0
+        updated = 0
+        unchanged = 0
+        deleted = 0
+        batch: List[Mapping[str, Any]] = []
+        seen_ids: List[Tuple[Any]] = []
 
-                if row['id'] in old_ids:
-                    old_ids.discard(row['id'])
+        def flush() -> None:
+            with db:  # transaction
+                db.execute("BEGIN")
+                self.upsert_rows(db, batch)
+                if seen_ids:
+                    db.executemany(f"INSERT OR IGNORE INTO main.{self.name}_seen (id) VALUES (?)", seen_ids)
+                if batch:
+                    bump_generation(db, self.name)
+            batch.clear()
+            seen_ids.clear()
 
-                    seen += 1
-                    if incremental and seen > 10:
+        # hashes of existing rows are looked up for a whole chunk of rows at once, except when
+        # the sync may stop early, which mustn't consume (fetch) more data than needed
+        stop_early = incremental and incremental_stop_after is not None
+        stopped = False
+        for chunk in chunked(rows, 1 if stop_early else self.batch_size):
+            old_hashes = {
+                old['id']: old['json_hash'] for old in db.execute(
+                    f"SELECT id, json_hash FROM {self.name} WHERE id IN (SELECT value FROM json_each(?))",
+                    (json.dumps([row['id'] for row in chunk]),))
+            }
+
+            for row in chunk:
+                if row['id'] in old_hashes:
+                    if incremental and incremental_stop_after is not None \
+                            and updated + unchanged >= incremental_stop_after:
+                        stopped = True
                         break
+
+                    if old_hashes[row['id']] == row['json_hash']:
+                        logging.debug(f"{self.name}: {row['id']} unchanged")
+                        unchanged += 1
+                    else:
+                        logging.debug(f"{self.name}: {row['id']} updated")
+                        updated += 1
+                        batch.append(row)
                 else:
+                    logging.debug(f"{self.name}: {row['id']} new")
                     new += 1
+                    batch.append(row)
+
+                if not incremental:
+                    seen_ids.append((row['id'],))
+
+            if len(batch) >= self.batch_size or len(seen_ids) >= self.batch_size:
+                flush()
+            if stopped:
+                break
+
+        flush()
+
+        if not incremental:
+            with db:  # transaction
+                db.execute("BEGIN")
+                deleted = db.execute(
+                    f"DELETE FROM {self.name} WHERE id NOT IN (SELECT id FROM main.{self.name}_seen)"
+                ).rowcount
+                db.execute(f"DROP TABLE main.{self.name}_seen")
+                if deleted:
+                    bump_generation(db, self.name)
+
+        logging.info(
+            f"{self.name} upsert stats: "
+            f"{new} new, {updated} updated, {unchanged} unchanged, {deleted} deleted")
+
 
-                self.upsert_row(db, row)
+def bump_generation(db: sqlite3.Connection, name: str) -> None:
+    """
+    Record that contents of table name changed, invalidating anything derived from it (see generation).
+    """
+    db.execute(
+        """
+        INSERT INTO table_generation (name, generation) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET generation = generation + 1
+        """,
+        (name,))
 
-            if not incremental:
-                delete = ((i,) for i in old_ids)
-                db.executemany(f"DELETE FROM {self.name} WHERE id = ?", delete)
-                deleted += len(old_ids)
 
-            logging.info(f"{self.name} upsert stats: {new} new, {seen} seen, {deleted} deleted")
+def generation(db: sqlite3.Connection) -> int:
+    """
+    Counter that increases whenever contents of any Table change, e.g. to key caches of reports on.
+    Changes made by other means than Table.upsert and migrations aren't counted.
+    """
+    return db.execute("SELECT COALESCE(SUM(generation), 0) FROM table_generation").fetchone()[0]
+
+
+@dataclass(frozen=True)
+class LocalTable:
+    """
+    Table of local state, e.g. an index of downloaded files, that isn't backed by raw json replies
+    and thus can't be migrated from them. Recreated empty whenever its definition changes.
+    """
+    name: str
+    columns: Mapping[str, str]
+    indexes: Sequence[str] = ()
+    virtual: Optional[str] = None  # module of a virtual table, e.g. rtree
+
+    def create(self, db: sqlite3.Connection, fingerprint: Optional[str] = None) -> None:
+        if fingerprint != self.fingerprint():
+            db.execute(f"DROP TABLE IF EXISTS {self.name}")
+        columns = ', '.join(f"{name} {type}".strip() for name, type in self.columns.items())
+        if self.virtual:
+            db.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.name} USING {self.virtual} ({columns})")
+        else:
+            db.execute(f"CREATE TABLE IF NOT EXISTS {self.name} ({columns})")
+        for index in self.indexes:
+            index_name = '_'.join([self.name] + [c.strip() for c in index.split(',')])
+            db.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {self.name} ({index})")
+
+    def fingerprint(self) -> str:
+        fingerprint: Dict[str, Any] = {'columns': list(self.columns.items()), 'indexes': list(self.indexes)}
+        if self.virtual:
+            fingerprint['virtual'] = self.virtual
+        return json.dumps(fingerprint)
+
+
+@dataclass(frozen=True)
+class Rollup:
+    """
+    Summary table of a Table, grouped by key columns, with a count and sums of other columns.
+    Maintained incrementally by triggers on the source table.
+    """
+    name: str
+    table: str
+    keys: Mapping[str, str]  # rollup column: source column
+    sums: Mapping[str, str]  # rollup column: source column
+
+    def fingerprint(self) -> str:
+        return json.dumps({'table': self.table, 'keys': list(self.keys.items()), 'sums': list(self.sums.items())})
+
+    def _triggers(self) -> Mapping[str, str]:
+        def match(row: str) -> str:
+            return ' AND '.join(f"{k} IS {row}.{c}" for k, c in self.keys.items())
+
+        keys = ', '.join(self.keys)
+        add = f"""
+            INSERT INTO {self.name} ({keys}, count, {', '.join(self.sums)})
+            SELECT {', '.join(f"NEW.{c}" for c in self.keys.values())}, 0, {', '.join('0' for _ in self.sums)}
+            WHERE NOT EXISTS (SELECT 1 FROM {self.name} WHERE {match('NEW')});
+            UPDATE {self.name}
+            SET count = count + 1, {', '.join(f"{k} = {k} + IFNULL(NEW.{c}, 0)" for k, c in self.sums.items())}
+            WHERE {match('NEW')};
+        """
+        subtract = f"""
+            UPDATE {self.name}
+            SET count = count - 1, {', '.join(f"{k} = {k} - IFNULL(OLD.{c}, 0)" for k, c in self.sums.items())}
+            WHERE {match('OLD')};
+            DELETE FROM {self.name} WHERE count = 0 AND {match('OLD')};
+        """
+        return {
+            f"{self.name}_insert": f"AFTER INSERT ON {self.table} BEGIN {add} END",
+            f"{self.name}_delete": f"AFTER DELETE ON {self.table} BEGIN {subtract} END",
+            f"{self.name}_update": f"AFTER UPDATE ON {self.table} BEGIN {subtract} {add} END",
+        }
+
+    def create(self, db: sqlite3.Connection, fingerprint: Optional[str] = None) -> None:
+        triggers = self._triggers()
+        existing_triggers = set(r['name'] for r in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (self.table,)))
+        if fingerprint == self.fingerprint() and existing_triggers.issuperset(triggers):
+            return
+
+        # (re)build the summary from scratch (triggers are dropped together with the source table
+        # when it's recreated during migration)
+        logging.info(f"{self.name}: rebuilding")
+        for trigger in triggers:
+            db.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        db.execute(f"DROP TABLE IF EXISTS {self.name}")
+
+        keys = ', '.join(self.keys)
+        sums = ', '.join(self.sums)
+        db.execute(f"CREATE TABLE {self.name} ({keys}, count INTEGER, {sums})")
+        db.execute(f"CREATE INDEX {self.name}_keys ON {self.name} ({keys})")
+        db.execute(f"""
+            INSERT INTO {self.name} ({keys}, count, {sums})
+            SELECT
+                {', '.join(self.keys.values())},
+                COUNT(*),
+                {', '.join(f"IFNULL(SUM({c}), 0)" for c in self.sums.values())}
+            FROM {self.table}
+            GROUP BY {', '.join(self.keys.values())}
+        """)
+        for trigger, definition in triggers.items():
+            db.execute(f"CREATE TRIGGER {trigger} {definition}")
 
 
 @dataclass(frozen=True)
 class Schema:
     version: int
     tables: List[Table]
+    rollups: List[Rollup] = field(default_factory=list)
+    local_tables: List[LocalTable] = field(default_factory=list)
 
     def initialize(self, db: sqlite3.Connection) -> None:
         with db:  # transaction
             db.execute("BEGIN")
+            db.execute("CREATE TABLE IF NOT EXISTS schema_table (name TEXT PRIMARY KEY, fingerprint TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS table_generation (name TEXT PRIMARY KEY, generation INTEGER)")
+
+            fingerprints = {r['name']: r['fingerprint'] for r in db.execute("SELECT * FROM schema_table")}
 
-            migrations = self.prepare_migrations(db)
+            migrations = self.prepare_migrations(db, fingerprints)
             for table in self.tables:
                 table.create(db)
             for migration in migrations:
                 migration(db)
+            for table in self.tables:
+                table.create_indexes(db)
+            for rollup in self.rollups:
+                rollup.create(db, fingerprints.get(rollup.name))
+            for local_table in self.local_tables:
+                local_table.create(db, fingerprints.get(local_table.name))
+
+            objects: List[Union[Table, Rollup, LocalTable]] = [*self.tables, *self.rollups, *self.local_tables]
+            for t in objects:
+                if fingerprints.get(t.name) != t.fingerprint():
+                    db.execute(
+                        "INSERT OR REPLACE INTO schema_table (name, fingerprint) VALUES (?, ?)",
+                        (t.name, t.fingerprint()))
 
-    def prepare_migrations(self, db: sqlite3.Connection) -> List[Callable]:
+    def prepare_migrations(self, db: sqlite3.Connection, fingerprints: Mapping[str, str]) -> List[Callable]:
         db_version = db.execute("PRAGMA user_version").fetchone()[0]
-        if db_version >= self.version:
-            return []
 
         migrations: List[Callable] = []
-        for table in self.tables:
-            migrations += table.prepare_migration(db)
-        migrations.append(lambda db: db.execute(f"PRAGMA user_version = {self.version}"))
+        if db_version < self.version:
+            # recreate all tables
+            for table in self.tables:
+                migrations += table.prepare_migration(db)
+            migrations.append(lambda db: db.execute(f"PRAGMA user_version = {self.version}"))
+        else:
+            # migrate only tables that changed (tables without a fingerprint are either new or
+            # come from a database created before fingerprints were introduced)
+            for table in self.tables:
+                if table.name in fingerprints:
+                    migrations += table.prepare_migration(db, fingerprints[table.name])
 
         return migrations
 
 
 @contextmanager
-def database(path: Union[str, Path], schema: Schema) -> Iterator[sqlite3.Connection]:
+def database(
+    path: Union[str, Path],
+    schema: Schema,
+    pragmas: Mapping[str, Union[str, int]] = {},
+    compress_json: bool = False,
+) -> Iterator[sqlite3.Connection]:
     if isinstance(path, Path):
         path.parent.mkdir(parents=True, exist_ok=True)
 
     db = sqlite3.connect(path, isolation_level=None)
     db.row_factory = sqlite3.Row
+    db.create_function('json_text', 1, json_text, deterministic=True)
+    db.create_function('json_store', 1, json_compress if compress_json else lambda j: j, deterministic=True)
     try:
+        for pragma, value in pragmas.items():
+            db.execute(f"PRAGMA {pragma} = {value}")
         schema.initialize(db)
         yield db
     finally:
@@ -0,0 +1,192 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import sqlite3
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+
+from . import config
+from .sqlite import chunked
+from .sync import database
+from .tracks import TRACK_COLUMNS
+from .tracks import track_columns
+
+EARTH_RADIUS = 6371008.8  # mean radius, metres
+
+MOVING_SPEED = 0.5  # m/s, slower segments don't count towards moving time
+MAX_GAP = 30  # s, longer gaps between points (pauses) don't count towards heart rate zones
+SPEED_WINDOW = 5  # points, max speed is computed over this many segments to suppress gps noise
+ELEVATION_WINDOW = 5  # points, elevation is smoothed by a moving average of this many points
+
+HR_ZONES = 5
+
+
+def decode_column(first: int, deltas: memoryview, scale: int) -> np.ndarray:
+    values = np.empty(len(deltas) // 4 + 1, dtype=np.int64)
+    values[0] = first
+    np.cumsum(np.frombuffer(deltas, dtype='<i4'), dtype=np.int64, out=values[1:])
+    values[1:] += first
+    return values / scale
+
+
+def haversine(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """
+    Distances between consecutive points, in metres.
+    """
+    lat, lon = np.radians(lat), np.radians(lon)
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def moving_average(values: np.ndarray, window: int) -> np.ndarray:
+    if len(values) < window:
+        return values
+    return np.convolve(values, np.ones(window) / window, mode='valid')
+
+
+def track_stats(blob: bytes, hr_zones: Sequence[int]) -> Dict[str, Any]:
+    """
+    Compute stats of an encoded track (see tracks.encode_track). Runs in a worker process.
+    """
+    n, raw = track_columns(blob)
+    columns = {c: decode_column(first, deltas, TRACK_COLUMNS[c]) for c, (first, deltas) in raw.items()}
+    stats: Dict[str, Any] = {'points': n}
+    if not n:
+        return stats
+
+    lat, lon = columns['lat'], (columns['lon'] + 180) % 360 - 180  # see tracks.wrap_lon
+    stats.update({
+        'min_lat': lat.min(), 'min_lon': lon.min(), 'max_lat': lat.max(), 'max_lon': lon.max(),
+        'start_lat': lat[0], 'start_lon': lon[0], 'end_lat': lat[-1], 'end_lon': lon[-1],
+    })
+
+    dist = haversine(lat, lon)
+    stats['distance'] = dist.sum()
+
+    if (ele := columns.get('ele')) is not None:
+        stats['elevation_gain'] = np.clip(np.diff(moving_average(ele, ELEVATION_WINDOW)), 0, None).sum()
+
+    if (time := columns.get('time')) is not None:
+        dt = np.diff(time)
+        stats['elapsed_time'] = time[-1] - time[0]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.where(dt > 0, dist / dt, 0)
+            stats['moving_time'] = dt[speed >= MOVING_SPEED].sum()
+
+            if n > SPEED_WINDOW:
+                cum_dist = np.concatenate(([0], np.cumsum(dist)))
+                window_dist = cum_dist[SPEED_WINDOW:] - cum_dist[:-SPEED_WINDOW]
+                window_time = time[SPEED_WINDOW:] - time[:-SPEED_WINDOW]
+                window_speed = np.where(window_time > 0, window_dist / window_time, 0)
+                stats['max_speed'] = window_speed.max()
+
+        if (hr := columns.get('hr')) is not None:
+            # time spent in each zone, attributed by heart rate at the start of each segment
+            zone = np.searchsorted(np.asarray(hr_zones), hr[:-1], side='right')
+            in_zones = np.bincount(zone, weights=np.where(dt <= MAX_GAP, dt, 0), minlength=HR_ZONES)
+            for i, seconds in enumerate(in_zones, start=1):
+                stats[f'hr_zone{i}'] = seconds
+
+    # plain python types for sqlite
+    return {k: v.item() if isinstance(v, np.generic) else v for k, v in stats.items()}
+
+
+def _track_stats_or_error(blob: bytes, hr_zones: Sequence[int]) -> Dict[str, Any]:
+    try:
+        return track_stats(blob, hr_zones)
+    except Exception as e:
+        return {'error': str(e)}
+
+
+def parse_hr_zones(hr_zones: str) -> Sequence[int]:
+    zones = [int(z) for z in hr_zones.split(',')]
+    if len(zones) != HR_ZONES - 1 or zones != sorted(zones):
+        raise ValueError(f"expected {HR_ZONES - 1} ascending heart rate zone boundaries, got: {hr_zones}")
+    return zones
+
+
+def compute_stats(
+    db: sqlite3.Connection,
+    hr_zones: str,
+    processes: Optional[int] = None,
+    batch_size: int = 100,
+) -> None:
+    """
+    Compute activity_track_stats for tracks that changed since last time (or when heart rate zones
+    change). Tracks that fail are recorded in activity_track_stats_error and not retried until
+    they change.
+    """
+    zones = parse_hr_zones(hr_zones)
+
+    with db:  # transaction
+        db.execute("BEGIN")
+        deleted = 0
+        for table in ('activity_track_stats', 'activity_track_stats_error'):
+            deleted += db.execute(f"""
+                DELETE FROM {table} WHERE NOT EXISTS (
+                    SELECT 1 FROM track t
+                    WHERE t.activity_id = {table}.activity_id AND t.data IS NOT NULL
+                )
+            """).rowcount
+        todo = [row['activity_id'] for row in db.execute("""
+            SELECT t.activity_id
+            FROM track t
+            LEFT JOIN activity_track_stats s USING (activity_id)
+            LEFT JOIN activity_track_stats_error e USING (activity_id)
+            WHERE t.data IS NOT NULL AND (
+                s.activity_id IS NULL
+                OR s.path IS NOT t.path OR s.size IS NOT t.size OR s.mtime IS NOT t.mtime
+                OR s.hr_zones IS NOT ?
+            ) AND (
+                e.activity_id IS NULL
+                OR e.path IS NOT t.path OR e.size IS NOT t.size OR e.mtime IS NOT t.mtime
+                OR e.hr_zones IS NOT ?
+            )
+        """, (hr_zones, hr_zones))]
+
+    computed, failed = 0, 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for chunk in chunked(todo, batch_size):
+            # fetch blobs per chunk, so that memory use is bounded
+            placeholders = ', '.join('?' for _ in chunk)
+            tracks = db.execute(
+                f"SELECT activity_id, path, size, mtime, data FROM track WHERE activity_id IN ({placeholders})",
+                chunk).fetchall()
+            results = executor.map(_track_stats_or_error, (t['data'] for t in tracks), (zones for _ in tracks))
+
+            with db:  # transaction
+                db.execute("BEGIN")
+                for track, stats in zip(tracks, results):
+                    row = {
+                        'activity_id': track['activity_id'],
+                        'path': track['path'], 'size': track['size'], 'mtime': track['mtime'],
+                        'hr_zones': hr_zones,
+                        **stats,
+                    }
+                    # stats of a previous version of the track, or a previous failure, are replaced
+                    if 'error' in stats:
+                        logging.error(f"failed to compute stats of activity {track['activity_id']}: {stats['error']}")
+                        table, other = 'activity_track_stats_error', 'activity_track_stats'
+                        failed += 1
+                    else:
+                        table, other = 'activity_track_stats', 'activity_track_stats_error'
+                        computed += 1
+                    db.execute(f"DELETE FROM {other} WHERE activity_id = ?", (row['activity_id'],))
+                    db.execute(
+                        f"INSERT OR REPLACE INTO {table} ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+                        tuple(row.values()))
+            logging.info(f"activity_track_stats: computed {computed}/{len(todo)}")
+
+    if deleted:
+        logging.info(f"activity_track_stats: deleted {deleted} rows whose track is gone")
+    if failed:
+        logging.warning(f"failed to compute stats of {failed} tracks (see the activity_track_stats_error table)")
+
+
+def sync(config: config.TrackStatsConfig):
+    with database(config) as db:
+        compute_stats(db=db, hr_zones=config.hr_zones, processes=config.processes)
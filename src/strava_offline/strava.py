@@ -1,17 +1,32 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timezone
+from io import BufferedIOBase
+from io import BytesIO
+from itertools import count
+from itertools import islice
 import json
+from pathlib import Path
+import threading
+import time
 from typing import Any
 from typing import Iterable
 from typing import List
 from typing import Mapping
 from typing import Optional
+from urllib.parse import urlparse
 
+from requests import Response
 from requests import Session
+from requests.adapters import DEFAULT_POOLSIZE
 from requests_oauthlib import OAuth2Session
 
 from . import config
 from . import redirect_server
+from .ratelimit import RateLimitedAdapter
+from .ratelimit import RateLimiter
+from .ratelimit import shared_limiter
 
 
 class StravaAPI:
@@ -19,23 +34,28 @@ class StravaAPI:
         self,
         config: config.StravaApiConfig,
         scope: List[str] = ["read", "profile:read_all", "activity:read_all"],
+        limiter: Optional[RateLimiter] = None,
     ):
         self._config = config
 
         token = self._load_token()
 
+        # the token is refreshed by _refresh_token rather than automatically by OAuth2Session, which
+        # would let several threads fetching activity pages refresh (and save) it at the same time
+        self._token_lock = threading.Lock()
         self._session = OAuth2Session(
             client_id=config.strava_client_id,
             redirect_uri=redirect_server.redirect_uri(config),
             scope=scope,
             token=token,
-            auto_refresh_url="https://www.strava.com/oauth/token",
             auto_refresh_kwargs={
                 'client_id': config.strava_client_id,
                 'client_secret': config.strava_client_secret,
             },
-            token_updater=self._save_token,
         )
+        # the quota is per application
+        limiter = limiter or shared_limiter(f"api:{config.strava_client_id}")
+        self._session.mount("https://", RateLimitedAdapter(limiter))
 
         if not token:
             self._authorize()
@@ -48,9 +68,35 @@ class StravaAPI:
             return None
 
     def _save_token(self, token) -> None:
-        self._config.strava_token_filename.parent.mkdir(parents=True, exist_ok=True)
-        with self._config.strava_token_filename.open("w") as f:
-            json.dump(token, f)
+        filename = self._config.strava_token_filename
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        # written to a temporary file first so that a crash (or another process reading it) never
+        # sees a truncated token
+        tmpfilename = Path(filename.parent, filename.name + ".tmp")
+        try:
+            with tmpfilename.open("w") as f:
+                json.dump(token, f)
+            tmpfilename.replace(filename)
+        finally:
+            tmpfilename.unlink(missing_ok=True)
+
+    def _refresh_token(self, margin: int = 60) -> None:
+        """
+        Refresh the access token if it expires within margin seconds. Only the first of several
+        threads finding it expired refreshes it, the others wait and then use the new one.
+        """
+        with self._token_lock:
+            expires_at = self._session.token.get('expires_at')
+            if expires_at is None or expires_at > time.time() + margin:
+                return
+            token = self._session.refresh_token("https://www.strava.com/oauth/token")
+            self._save_token(token)
+
+    def _get(self, url: str, **kwargs) -> Response:
+        self._refresh_token()
+        r = self._session.get(url, **kwargs)
+        r.raise_for_status()
+        return r
 
     def _authorize(self) -> None:
         authorization_url, _ = self._session.authorization_url("https://www.strava.com/oauth/authorize")
@@ -64,66 +110,119 @@ class StravaAPI:
         self._save_token(token)
 
     def get_athlete(self) -> Mapping[str, Any]:
-        r = self._session.get("https://www.strava.com/api/v3/athlete")
-        r.raise_for_status()
-        return r.json()
+        return self._get("https://www.strava.com/api/v3/athlete").json()
 
     def get_bikes(self) -> Iterable[Mapping[str, Any]]:
         return self.get_athlete()['bikes']
 
-    def get_activities(self, before: Optional[datetime] = None) -> Iterable[Mapping[str, Any]]:
-        if not before:
+    def _get_activities_page(self, params: Mapping[str, int]) -> List[Mapping[str, Any]]:
+        return self._get("https://www.strava.com/api/v3/athlete/activities", params=params).json()
+
+    def get_activities(
+        self,
+        before: Optional[datetime] = None,
+        after: Optional[datetime] = None,
+        concurrency: int = 1,
+    ) -> Iterable[Mapping[str, Any]]:
+        """
+        Get activities, newest first. If after is given (and before isn't), get activities newer
+        than after, oldest first.
+
+        Up to concurrency pages are being fetched at the same time (a few pages past the last one
+        may thus be requested needlessly), activities are still yielded in order.
+        """
+        if not before and not after:
             before = datetime.now(timezone.utc)
-        params = {'before': int(before.timestamp()), 'per_page': 200, 'page': 0}
-        while True:
-            params['page'] += 1
-            r = self._session.get("https://www.strava.com/api/v3/athlete/activities", params=params)
-            r.raise_for_status()
-            activities = r.json()
-            if activities:
-                yield from activities
-            else:
-                break
+        params = {'per_page': 200}
+        if before:
+            params['before'] = int(before.timestamp())
+        if after:
+            params['after'] = int(after.timestamp())
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pages = (executor.submit(self._get_activities_page, {**params, 'page': page}) for page in count(1))
+            in_flight = deque(islice(pages, concurrency))
+            try:
+                while activities := in_flight.popleft().result():
+                    yield from activities
+                    in_flight.append(next(pages))
+            finally:
+                executor.shutdown(cancel_futures=True)
 
 
 class NotGpx(Exception):
     pass
 
 
+class NotLoggedIn(Exception):
+    pass
+
+
 class StravaWeb:
-    def __init__(self, config: config.StravaWebConfig):
+    def __init__(
+        self,
+        config: config.StravaWebConfig,
+        pool_size: int = DEFAULT_POOLSIZE,
+        limiter: Optional[RateLimiter] = None,
+    ):
         self._config = config
         self._session = Session()
+        limiter = limiter or shared_limiter("web")
+        self._session.mount("https://", RateLimitedAdapter(limiter, pool_maxsize=pool_size))
         self._session.cookies.set(
             '_strava4_session', config.strava_cookie_strava4_session,
             domain="www.strava.com", secure=True,
         )
 
-    def _get_gpx(self, what: str, activity_id: int) -> bytes:
-        r = self._session.get(f"https://www.strava.com/activities/{activity_id}/export_{what}")
-        r.raise_for_status()
+    def _get_gpx(self, what: str, activity_id: int) -> Response:
+        """
+        Request the gpx export and check the headers, leaving the body to be streamed by the caller.
+        """
+        r = self._session.get(f"https://www.strava.com/activities/{activity_id}/export_{what}", stream=True)
+        try:
+            r.raise_for_status()
 
-        content_type_ok = r.headers.get('Content-Type') == "application/octet-stream"
+            # an expired or invalid session cookie gets redirected to the login page
+            if r.history and urlparse(r.url).path == "/login":
+                raise NotLoggedIn("redirected to login page, is the _strava4_session cookie still valid?")
 
-        content_disposition, content_disposition_params = _parse_content_disposition_header(
-            r.headers.get('Content-Disposition', ""))
-        content_disposition_ok = (
-            content_disposition == "attachment"
-            and content_disposition_params['filename'].endswith(".gpx"))
+            content_type_ok = r.headers.get('Content-Type') == "application/octet-stream"
 
-        if content_type_ok and content_disposition_ok:
-            return r.content
-        else:
-            raise NotGpx(f"expected gpx attachment, got:\n{r.headers}")
+            content_disposition, content_disposition_params = _parse_content_disposition_header(
+                r.headers.get('Content-Disposition', ""))
+            content_disposition_ok = (
+                content_disposition == "attachment"
+                and content_disposition_params['filename'].endswith(".gpx"))
 
-    def get_gpx(self, activity_id: int) -> bytes:
+            if content_type_ok and content_disposition_ok:
+                return r
+            else:
+                raise NotGpx(f"expected gpx attachment, got:\n{r.headers}")
+        except Exception:
+            r.close()
+            raise
+
+    def write_gpx(self, activity_id: int, f: BufferedIOBase, chunk_size: int = 64 * 1024) -> None:
+        """
+        Download gpx of an activity and write it to f in chunks, without holding the whole file in
+        memory.
+        """
         try:
             # Try to obtain the original gpx as the export_gpx endpoint always returns a processed
             # and stripped gpx. The original gpx may contain a longer track than shown on Strava as
             # it's not filtered and cropped.
-            return self._get_gpx("original", activity_id)
+            r = self._get_gpx("original", activity_id)
         except NotGpx:
-            return self._get_gpx("gpx", activity_id)
+            r = self._get_gpx("gpx", activity_id)
+
+        with r:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+    def get_gpx(self, activity_id: int) -> bytes:
+        f = BytesIO()
+        self.write_gpx(activity_id, f)
+        return f.getvalue()
 
 
 def _parse_content_disposition_header(header):
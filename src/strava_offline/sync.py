@@ -1,12 +1,31 @@
 from contextlib import contextmanager
+from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 import sqlite3
+from typing import Dict
 from typing import Iterator
 from typing import Optional
+from typing import TYPE_CHECKING
+from typing import Union
 
 from . import config
 from . import sqlite
-from .strava import StravaAPI
+
+if TYPE_CHECKING:
+    from .strava import StravaAPI
+
+
+def parse_datetime(d: str) -> datetime:
+    # fromisoformat only understands the Z suffix since Python 3.11
+    return datetime.fromisoformat(d.replace('Z', '+00:00'))
+
+
+def iso_week(d: str) -> str:
+    year, week, _ = date.fromisoformat(d[0:10]).isocalendar()
+    return f"{year:04}-W{week:02}"
+
 
 table_bike = sqlite.Table(
     name='bike',
@@ -27,6 +46,10 @@ table_activity = sqlite.Table(
         'upload_id': "TEXT",
         'name': "TEXT",
         'start_date': "TEXT",
+        'start_time': "INTEGER",
+        'start_year': "INTEGER",
+        'start_month': "INTEGER",
+        'start_week': "TEXT",  # ISO week, e.g. 2020-W05
         'moving_time': "INTEGER",
         'elapsed_time': "INTEGER",
         'distance': "REAL",
@@ -43,6 +66,10 @@ table_activity = sqlite.Table(
         'upload_id': activity['upload_id'],
         'name': activity['name'],
         'start_date': activity['start_date'],
+        'start_time': int(parse_datetime(activity['start_date']).timestamp()),
+        'start_year': int(activity['start_date_local'][0:4]),
+        'start_month': int(activity['start_date_local'][5:7]),
+        'start_week': iso_week(activity['start_date_local']),
         'moving_time': activity['moving_time'],
         'elapsed_time': activity['elapsed_time'],
         'distance': activity['distance'],
@@ -54,40 +81,256 @@ table_activity = sqlite.Table(
         'trainer': activity['trainer'],
         'has_location_data': isinstance(activity['start_latlng'], list) and len(activity['start_latlng']) >= 2,
     },
+    indexes=[
+        'start_time',
+        'start_year, start_month',
+        'gear_id',
+        'type',
+        'sport_type',
+    ],
+)
+
+rollup_activity_summary = sqlite.Rollup(
+    name='activity_summary',
+    table='activity',
+    keys={
+        'year': 'start_year',
+        'month': 'start_month',
+        'type': 'type',
+        'gear_id': 'gear_id',
+    },
+    sums={
+        'distance': 'distance',
+        'moving_time': 'moving_time',
+        'elevation_gain': 'total_elevation_gain',
+    },
+)
+
+# index of gpx files in dir_activities, see gpx.index_gpx_files
+table_gpx_file = sqlite.LocalTable(
+    name='gpx_file',
+    columns={
+        'activity_id': "INTEGER PRIMARY KEY",
+        'path': "TEXT",  # relative to dir_activities
+        'suffix': "TEXT",
+        'size': "INTEGER",
+        'mtime': "REAL",
+        'source': "TEXT",  # downloaded, linked (from backup), archive (bulk export), existing (found in dir)
+    },
+)
+
+# queue of gpx downloads with retry state, see gpx.download_activities
+table_gpx_download = sqlite.LocalTable(
+    name='gpx_download',
+    columns={
+        'activity_id': "INTEGER PRIMARY KEY",
+        'state': "TEXT",  # pending, done, failed
+        'attempts': "INTEGER",
+        'last_error': "TEXT",
+        'next_retry': "INTEGER",  # epoch time
+    },
+)
+
+# track points parsed from gpx files, see tracks.load_tracks
+table_track = sqlite.LocalTable(
+    name='track',
+    columns={
+        'activity_id': "INTEGER PRIMARY KEY",
+        # path, size and mtime of the gpx file the track was parsed from
+        'path': "TEXT",
+        'size': "INTEGER",
+        'mtime': "REAL",
+        'points': "INTEGER",
+        'data': "BLOB",  # see tracks.encode_track
+    },
+)
+
+# stats computed from tracks, see stats.compute_stats
+table_activity_track_stats = sqlite.LocalTable(
+    name='activity_track_stats',
+    columns={
+        'activity_id': "INTEGER PRIMARY KEY",
+        # path, size and mtime of the gpx file the track was parsed from, and heart rate zones used
+        'path': "TEXT",
+        'size': "INTEGER",
+        'mtime': "REAL",
+        'hr_zones': "TEXT",
+        'points': "INTEGER",
+        'min_lat': "REAL",
+        'min_lon': "REAL",
+        'max_lat': "REAL",
+        'max_lon': "REAL",
+        'start_lat': "REAL",
+        'start_lon': "REAL",
+        'end_lat': "REAL",
+        'end_lon': "REAL",
+        'distance': "REAL",  # m
+        'elevation_gain': "REAL",  # m, smoothed
+        'elapsed_time': "REAL",  # s
+        'moving_time': "REAL",  # s
+        'max_speed': "REAL",  # m/s
+        'hr_zone1': "REAL",  # s
+        'hr_zone2': "REAL",
+        'hr_zone3': "REAL",
+        'hr_zone4': "REAL",
+        'hr_zone5': "REAL",
+    },
+)
+
+# tracks whose stats failed to compute, skipped until the track or hr zones change, see stats.compute_stats
+table_activity_track_stats_error = sqlite.LocalTable(
+    name='activity_track_stats_error',
+    columns={
+        'activity_id': "INTEGER PRIMARY KEY",
+        'path': "TEXT",
+        'size': "INTEGER",
+        'mtime': "REAL",
+        'hr_zones': "TEXT",
+        'error': "TEXT",
+    },
+)
+
+# summary polylines decoded from activity json, see geometry.update_geometry
+table_activity_geometry = sqlite.LocalTable(
+    name='activity_geometry',
+    columns={
+        'activity_id': "INTEGER PRIMARY KEY",
+        'json_hash': "INTEGER",  # of the activity json the polyline was decoded from
+        'points': "INTEGER",
+        'data': "BLOB",  # see tracks.encode_track, lat and lon only
+    },
+)
+
+# spatial index of activities, see spatial.update_index
+table_activity_spatial = sqlite.LocalTable(
+    name='activity_spatial',
+    columns={
+        'activity_id': "INTEGER PRIMARY KEY",
+        'source': "TEXT",  # track (path, size, mtime) or geometry (json hash) the index was built from
+    },
+)
+
+table_activity_rtree = sqlite.LocalTable(
+    name='activity_rtree',
+    virtual='rtree',
+    columns={
+        'id': "",  # activity id
+        'min_lat': "",
+        'max_lat': "",
+        'min_lon': "",
+        'max_lon': "",
+    },
+)
+
+table_activity_segment_rtree = sqlite.LocalTable(
+    name='activity_segment_rtree',
+    virtual='rtree',
+    columns={
+        'id': "",  # activity_id * spatial.MAX_SEGMENTS + segment number
+        'min_lat': "",
+        'max_lat': "",
+        'min_lon': "",
+        'max_lon': "",
+        '+activity_id': "",  # auxiliary column
+    },
+)
+
+# rendered reports, see reports.cached
+table_report_cache = sqlite.LocalTable(
+    name='report_cache',
+    columns={
+        'key': "TEXT PRIMARY KEY",  # json of report query and parameters
+        'generation': "INTEGER",  # see sqlite.generation
+        'result': "TEXT",
+    },
 )
 
 schema = sqlite.Schema(
-    # Version of database schema. Bump this whenever the schema changes,
-    # tables will be recreated using the stored json data and the new schema.
-    version=4,
+    # Version of database schema. Bump this to recreate all tables using the stored json data and
+    # the new schema. Changes to individual tables are detected using their fingerprints, see
+    # sqlite.Table.version.
+    version=5,
 
     tables=[
         table_bike,
         table_activity,
     ],
+
+    rollups=[
+        rollup_activity_summary,
+    ],
+
+    local_tables=[
+        table_gpx_file,
+        table_gpx_download,
+        table_track,
+        table_activity_track_stats,
+        table_activity_track_stats_error,
+        table_activity_geometry,
+        table_activity_spatial,
+        table_activity_rtree,
+        table_activity_segment_rtree,
+        table_report_cache,
+    ],
 )
 
 
 @contextmanager
 def database(config: config.DatabaseConfig) -> Iterator[sqlite3.Connection]:
-    with sqlite.database(config.strava_sqlite_database, schema) as db:
+    pragmas: Dict[str, Union[str, int]] = {
+        # set busy_timeout first so that changing journal_mode waits for other connections
+        'busy_timeout': config.sqlite_busy_timeout,
+        'journal_mode': config.sqlite_journal_mode,
+        'synchronous': config.sqlite_synchronous,
+        'mmap_size': config.sqlite_mmap_size,
+        'cache_size': -config.sqlite_cache_size,  # negative means KiB rather than pages
+        'temp_store': config.sqlite_temp_store,
+    }
+    with sqlite.database(
+        config.strava_sqlite_database, schema,
+        pragmas=pragmas, compress_json=config.sqlite_compress_json,
+    ) as db:
         yield db
 
 
-def sync_bikes(strava: StravaAPI, db: sqlite3.Connection) -> None:
+def sync_bikes(strava: "StravaAPI", db: sqlite3.Connection) -> None:
     table_bike.upsert(db, strava.get_bikes())
 
 
 def sync_activities(
-    strava: StravaAPI,
+    strava: "StravaAPI",
     db: sqlite3.Connection,
     before: Optional[datetime] = None,
+    after: Optional[datetime] = None,
     incremental: bool = False,
+    concurrency: int = 1,
 ) -> None:
-    table_activity.upsert(db, strava.get_activities(before=before), incremental=incremental)
+    table_activity.upsert(
+        db, strava.get_activities(before=before, after=after, concurrency=concurrency),
+        incremental=incremental,
+        # activities newer than after come oldest first, so we can't stop early
+        incremental_stop_after=None if after else 10,
+    )
+
+
+def latest_activity_start(db: sqlite3.Connection) -> Optional[datetime]:
+    start_time = db.execute("SELECT MAX(start_time) FROM activity").fetchone()[0]
+    return datetime.fromtimestamp(start_time, tz=timezone.utc) if start_time is not None else None
+
+
+def update_activities(config: config.SyncConfig, strava: "StravaAPI", db: sqlite3.Connection) -> None:
+    if config.full:
+        sync_activities(strava, db, concurrency=config.page_concurrency)
+    elif latest := latest_activity_start(db):
+        after = latest - timedelta(days=config.incremental_overlap)
+        sync_activities(strava, db, after=after, incremental=True)
+    else:
+        sync_activities(strava, db, incremental=True)
 
 
-def sync(config: config.SyncConfig, strava: StravaAPI):
+def sync(config: config.SyncConfig, strava: "StravaAPI"):
     with database(config) as db:
+        for table in schema.tables:
+            table.convert_json(db)
         sync_bikes(strava, db)
-        sync_activities(strava, db, incremental=(not config.full))
+        update_activities(config, strava, db)
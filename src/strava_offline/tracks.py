@@ -0,0 +1,262 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import gzip
+from itertools import accumulate
+import logging
+from pathlib import Path
+import sqlite3
+import struct
+import sys
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from xml.parsers import expat
+
+from . import config
+from .fit import Readable
+from .fit import TrackPoint
+from .gpx import index_gpx_files
+from .sqlite import chunked
+from .sync import database
+from .sync import parse_datetime
+
+# Track points are stored as one blob per activity: a header followed by delta-encoded int32 columns
+# of fixed-point values, so that they can be decoded (or handed to numpy) without any parsing.
+TRACK_FORMAT_V1 = 1
+TRACK_HEADER = struct.Struct('<BIB')  # format, number of points, bitmask of present columns
+TRACK_COLUMNS = {
+    # column: scale (stored value = round(value * scale))
+    'time': 1,
+    'lat': 10 ** 7,
+    'lon': 10 ** 7,
+    'ele': 10,
+    'hr': 1,
+}
+# longitude deltas are stored the short way round, so that tracks crossing the antimeridian don't
+# overflow int32 (decoded longitudes must thus be wrapped into [-180°, 180°), see wrap_lon)
+LON_TURN = 360 * TRACK_COLUMNS['lon']
+
+
+def wrap_lon(value: int) -> int:
+    """
+    Wrap fixed-point longitude (or difference of longitudes) into [-180°, 180°).
+    """
+    return (value + LON_TURN // 2) % LON_TURN - LON_TURN // 2
+
+
+@dataclass
+class Track:
+    time: Optional[List[float]]
+    lat: List[float]
+    lon: List[float]
+    ele: Optional[List[float]]
+    hr: Optional[List[float]]
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+
+def encode_track(points: Iterable[TrackPoint]) -> bytes:
+    """
+    Encode track points (those with a position). Columns present in some points only have the gaps
+    filled with the nearest known value.
+    """
+    columns: Dict[str, List[Optional[int]]] = {c: [] for c in TRACK_COLUMNS}
+    for p in points:
+        if p.lat is None or p.lon is None:
+            continue
+        for c, scale in TRACK_COLUMNS.items():
+            value = getattr(p, c)
+            columns[c].append(round(value * scale) if value is not None else None)
+
+    n = len(columns['lat'])
+    mask = 0
+    data = []
+    for i, (c, values) in enumerate(columns.items()):
+        known = [v for v in values if v is not None]
+        if not known:
+            continue
+        mask |= 1 << i
+
+        filled = []
+        last = known[0]
+        for v in values:
+            last = v if v is not None else last
+            filled.append(last)
+
+        wrap = wrap_lon if c == 'lon' else int
+        deltas = array('i', (wrap(b - a) for a, b in zip(filled, filled[1:])))
+        if sys.byteorder != 'little':
+            deltas.byteswap()
+        data.append(struct.pack('<q', wrap(filled[0])) + deltas.tobytes())
+
+    return TRACK_HEADER.pack(TRACK_FORMAT_V1, n, mask) + b"".join(data)
+
+
+def track_columns(blob: bytes) -> Tuple[int, Dict[str, Tuple[int, memoryview]]]:
+    """
+    Raw columns of an encoded track: number of points and, for each present column, its first
+    (fixed-point) value and a memoryview of little-endian int32 deltas. Useful for vectorised
+    decoding, e.g. using numpy.frombuffer and cumsum (followed by wrapping of longitudes).
+    """
+    format, n, mask = TRACK_HEADER.unpack_from(blob)
+    if format != TRACK_FORMAT_V1:
+        raise ValueError(f"unknown track format: {format}")
+
+    columns = {}
+    offset = TRACK_HEADER.size
+    view = memoryview(blob)
+    for i, c in enumerate(TRACK_COLUMNS):
+        if mask & (1 << i) and n:
+            first = struct.unpack_from('<q', blob, offset)[0]
+            offset += 8
+            columns[c] = (first, view[offset:offset + 4 * (n - 1)])
+            offset += 4 * (n - 1)
+    return n, columns
+
+
+def decode_track(blob: bytes) -> Track:
+    n, columns = track_columns(blob)
+
+    def decode(c: str) -> Optional[List[float]]:
+        if c not in columns:
+            return None
+        first, deltas = columns[c]
+        values = array('i')
+        values.frombytes(deltas)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        scale = TRACK_COLUMNS[c]
+        wrap = wrap_lon if c == 'lon' else int
+        return [wrap(v) / scale for v in accumulate(values, initial=first)]
+
+    return Track(
+        time=decode('time'),
+        lat=decode('lat') or [],
+        lon=decode('lon') or [],
+        ele=decode('ele'),
+        hr=decode('hr'),
+    )
+
+
+def parse_gpx(f: Readable, chunk_size: int = 64 * 1024) -> Iterator[TrackPoint]:
+    """
+    Parse track points from gpx, including heart rate from Garmin's TrackPointExtension, using expat
+    so that no element tree is built.
+    """
+    points: List[TrackPoint] = []
+    point: Dict[str, Optional[float]] = {}
+    text: List[str] = []
+
+    def start(name: str, attrs: Dict[str, str]) -> None:
+        nonlocal point
+        tag = name.rpartition(' ')[2]
+        if tag == 'trkpt':
+            point = {'lat': float(attrs['lat']), 'lon': float(attrs['lon'])}
+        text.clear()
+
+    def end(name: str) -> None:
+        tag = name.rpartition(' ')[2]
+        if not point:
+            return
+        elif tag == 'trkpt':
+            points.append(TrackPoint(
+                time=point.get('time'), lat=point['lat'], lon=point['lon'], ele=point.get('ele'),
+                hr=int(hr) if (hr := point.get('hr')) is not None else None,
+            ))
+            point.clear()
+        elif tag in ('ele', 'hr'):
+            point[tag] = float("".join(text))
+        elif tag == 'time':
+            point['time'] = parse_datetime("".join(text).strip()).timestamp()
+
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text.append
+
+    while chunk := f.read(chunk_size):
+        parser.Parse(chunk, False)
+        yield from points
+        points.clear()
+    parser.Parse(b"", True)
+    yield from points
+
+
+def read_gpx_track(path: Path) -> bytes:
+    """
+    Parse and encode a (possibly gzipped) gpx file. Runs in a worker process.
+    """
+    with (gzip.open(path) if path.suffix == ".gz" else open(path, "rb")) as f:
+        return encode_track(parse_gpx(f))
+
+
+def load_tracks(
+    db: sqlite3.Connection,
+    dir_activities: Path,
+    processes: Optional[int] = None,
+    batch_size: int = 100,
+) -> None:
+    """
+    Parse gpx files that changed since last time (according to gpx_file) into the track table.
+    Expects gpx_file to be up to date (see gpx.index_gpx_files).
+    """
+    with db:  # transaction
+        db.execute("BEGIN")
+        deleted = db.execute("""
+            DELETE FROM track WHERE NOT EXISTS (SELECT 1 FROM gpx_file f WHERE f.activity_id = track.activity_id)
+        """).rowcount
+        todo = db.execute("""
+            SELECT f.activity_id, f.path, f.size, f.mtime
+            FROM gpx_file f LEFT JOIN track t USING (activity_id)
+            WHERE t.activity_id IS NULL OR t.path IS NOT f.path OR t.size IS NOT f.size OR t.mtime IS NOT f.mtime
+        """).fetchall()
+
+    loaded, failed = 0, 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # commit in batches, so that an interrupted run keeps most of its work
+        for chunk in chunked(todo, batch_size):
+            paths = [Path(dir_activities, row['path']) for row in chunk]
+            results = executor.map(_read_gpx_track_or_error, paths)
+            with db:  # transaction
+                db.execute("BEGIN")
+                for row, (data, error) in zip(chunk, results):
+                    if data is None:
+                        # recorded without data, so that it's not parsed again until the file changes
+                        logging.error(f"failed to parse {row['path']}: {error}")
+                        failed += 1
+                    else:
+                        loaded += 1
+                    db.execute(
+                        """
+                        INSERT OR REPLACE INTO track (activity_id, path, size, mtime, points, data)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        (row['activity_id'], row['path'], row['size'], row['mtime'],
+                         TRACK_HEADER.unpack_from(data)[1] if data is not None else None, data))
+            logging.info(f"track: loaded {loaded}/{len(todo)} tracks")
+
+    if deleted:
+        logging.info(f"track: deleted {deleted} tracks whose gpx is gone")
+    if failed:
+        logging.warning(f"failed to parse {failed} gpx files")
+
+
+def _read_gpx_track_or_error(path: Path) -> Tuple[Optional[bytes], Optional[str]]:
+    try:
+        return read_gpx_track(path), None
+    except Exception as e:
+        return None, str(e)
+
+
+def sync(config: config.TracksConfig):
+    config.dir_activities.mkdir(parents=True, exist_ok=True)
+
+    with database(config) as db:
+        # stat all files to notice modified ones too, the parsing is way more expensive anyway
+        index_gpx_files(db=db, dir_activities=config.dir_activities, stat_all=True)
+        load_tracks(db=db, dir_activities=config.dir_activities, processes=config.processes)
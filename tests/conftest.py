@@ -1,8 +1,50 @@
 import pytest
 
+from strava_offline import config
+from strava_offline import sync
+
+# https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+POLYLINE = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+
 
 @pytest.fixture(scope="session")
 def vcr_config():
     return {
         'match_on': ('method', 'scheme', 'host', 'port', 'path', 'query', 'body')
     }
+
+
+def database(**options):
+    """
+    In-memory database, options are those of config.DatabaseConfig.
+    """
+    return sync.database(config.DatabaseConfig(strava_sqlite_database=":memory:", **options))
+
+
+def activity(
+    id, start_date, start_date_local=None, *,
+    name=None, type="Ride", gear_id="b1", distance=10000.0, moving_time=3600, commute=False, summary_polyline=None,
+):
+    """
+    Activity as returned by the Strava API (only the fields we use).
+    """
+    activity = {
+        'id': id,
+        'upload_id': id + 1,
+        'name': name or f"activity {id}",
+        'start_date': start_date,
+        'start_date_local': start_date_local or start_date,
+        'moving_time': moving_time,
+        'elapsed_time': moving_time,
+        'distance': distance,
+        'total_elevation_gain': 0.0,
+        'gear_id': gear_id,
+        'type': type,
+        'sport_type': type,
+        'commute': commute,
+        'trainer': False,
+        'start_latlng': [],
+    }
+    if summary_polyline is not None:
+        activity['map'] = {'summary_polyline': summary_polyline}
+    return activity
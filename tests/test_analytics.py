@@ -0,0 +1,113 @@
+from conftest import activity
+from conftest import database
+import pytest
+
+from strava_offline import analytics
+from strava_offline import sync
+
+
+def sample_data(db):
+    sync.table_bike.upsert(db, [
+        {'id': "b1", 'name': "bike1"},
+    ])
+    sync.table_activity.upsert(db, [
+        activity(1, "2020-12-28T08:00:00Z", distance=20000.0),
+        activity(2, "2021-01-01T08:00:00Z", gear_id="b2", commute=True),
+        activity(3, "2021-01-04T08:00:00Z", distance=30000.0, moving_time=7200),
+        activity(4, "2021-01-05T08:00:00Z", type="Run", gear_id=None, distance=None),
+        activity(5, "2021-01-12T08:00:00Z", type="Run", gear_id=None, distance=5000.0, moving_time=1800),
+    ])
+
+
+def metrics(*specs):
+    return [analytics.parse_metric(s) for s in specs]
+
+
+@pytest.fixture(params=[True, False], ids=["numpy", "array"])
+def use_numpy(request):
+    if request.param:
+        pytest.importorskip("numpy")
+    return request.param
+
+
+def test_aggregate(use_numpy):
+    with database() as db:
+        sample_data(db)
+        activities = analytics.load(db, use_numpy=use_numpy)
+
+    headers, rows = analytics.aggregate(
+        activities, ['type', 'gear'],
+        metrics('count', 'count(distance)', 'sum(distance)', 'mean(speed)', 'min(distance)', 'p50(distance)'))
+    assert headers == [
+        'type', 'gear', 'count', 'count(distance)', 'sum(distance)', 'mean(speed)', 'min(distance)', 'p50(distance)']
+    assert rows == [
+        ['Ride', "b2", 1, 1, 10.0, 10.0, 10.0, 10.0],
+        ['Ride', "bike1", 2, 2, 50.0, 17.5, 20.0, 25.0],
+        ['Run', None, 2, 1, 5.0, 10.0, 5.0, 5.0],
+    ]
+
+    # ISO weeks; 2021-01-01 is in the last week of 2020
+    _, rows = analytics.aggregate(activities, ['week'], metrics('count', 'max(moving_time)'))
+    assert rows == [['2020-W53', 2, 1.0], ['2021-W01', 2, 2.0], ['2021-W02', 1, 0.5]]
+
+    _, rows = analytics.aggregate(activities, ['commute'], metrics('p90(moving_time)'))
+    assert rows == [[0, pytest.approx(1.7)], [1, 1.0]]
+
+    _, rows = analytics.aggregate(activities, [], metrics('count', 'sum(distance)'))
+    assert rows == [[5, 65.0]]
+
+
+def test_rolling(use_numpy):
+    with database() as db:
+        sample_data(db)
+        activities = analytics.load(db, use_numpy=use_numpy)
+
+    _, rows = analytics.aggregate(activities, ['type', 'week'], metrics('sum(distance)'), rolling=2)
+    assert rows == [
+        ['Ride', '2020-W53', 30.0],
+        ['Ride', '2021-W01', 30.0],
+        ['Run', '2021-W01', None],
+        ['Run', '2021-W02', 5.0],
+    ]
+
+
+def test_rolling_gap(use_numpy):
+    with database() as db:
+        sync.table_activity.upsert(db, [
+            activity(1, "2020-12-21T08:00:00Z", distance=40000.0),  # 2020-W52
+            activity(2, "2021-01-11T08:00:00Z", distance=20000.0),  # 2021-W02
+            activity(3, "2021-02-01T08:00:00Z", distance=20000.0),
+        ])
+        activities = analytics.load(db, use_numpy=use_numpy)
+
+    # weeks without activities are part of the window, with zero distance but no mean
+    _, rows = analytics.aggregate(activities, ['week'], metrics('sum(distance)', 'mean(distance)'), rolling=2)
+    assert rows[:4] == [
+        ['2020-W52', 40.0, 40.0],
+        ['2020-W53', 20.0, 40.0],
+        ['2021-W01', 0.0, None],
+        ['2021-W02', 10.0, 20.0],
+    ]
+    assert len(rows) == 7 and rows[-1][0] == '2021-W05'
+
+    _, rows = analytics.aggregate(activities, ['month'], metrics('count'), rolling=3)
+    assert rows == [['2020-12', 1.0], ['2021-01', 1.0], ['2021-02', 1.0]]
+    _, rows = analytics.aggregate(activities, ['year'], metrics('count'), rolling=2)
+    assert rows == [[2020, 1.0], [2021, 1.5]]
+
+
+def test_empty(use_numpy):
+    with database() as db:
+        activities = analytics.load(db, use_numpy=use_numpy)
+
+    assert analytics.aggregate(activities, ['year'], metrics('count')) == (['year', 'count'], [])
+    assert analytics.aggregate(activities, [], metrics('p50(distance)')) == (['p50(distance)'], [])
+
+
+def test_parse_metric():
+    assert analytics.parse_metric("count") == analytics.Metric('count', None)
+    assert analytics.parse_metric("p95(speed)") == analytics.Metric('p95', 'speed', 95.0)
+    assert str(analytics.parse_metric("sum(distance)")) == "sum(distance)"
+    for invalid in ["sum", "median(distance)", "sum(foo)", "p101(distance)", "sum(distance"]:
+        with pytest.raises(ValueError):
+            analytics.parse_metric(invalid)
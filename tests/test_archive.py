@@ -0,0 +1,135 @@
+import gzip
+import io
+import struct
+from xml.etree import ElementTree
+import zipfile
+
+from strava_offline import archive
+from strava_offline import config
+from strava_offline import fit
+from strava_offline import gpx
+from strava_offline import sync
+
+GPX_NS = "{http://www.topografix.com/GPX/1/1}"
+
+GPX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+ <trk><trkseg><trkpt lat="49.1" lon="16.1"><time>2020-10-26T08:00:00Z</time></trkpt></trkseg></trk>
+</gpx>
+"""
+
+TCX = b"""
+     <?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+ <Activities><Activity Sport="Biking"><Lap><Track>
+  <Trackpoint>
+   <Time>2020-10-26T08:00:00Z</Time>
+   <Position><LatitudeDegrees>49.2</LatitudeDegrees><LongitudeDegrees>16.2</LongitudeDegrees></Position>
+   <AltitudeMeters>200.5</AltitudeMeters>
+   <HeartRateBpm><Value>120</Value></HeartRateBpm>
+  </Trackpoint>
+  <Trackpoint>
+   <Time>2020-10-26T08:00:01Z</Time>
+  </Trackpoint>
+ </Track></Lap></Activity></Activities>
+</TrainingCenterDatabase>
+"""
+
+
+def fit_file() -> bytes:
+    # definition of local message 0 as record: timestamp, lat, lon, altitude, heart rate
+    fields = [(253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84), (3, 1, 0x02)]
+    definition = bytes([0x40, 0, 0]) + struct.pack('<HB', fit.MESG_RECORD, len(fields)) + \
+        b"".join(bytes(f) for f in fields)
+
+    def semicircles(degrees: float) -> int:
+        return round(degrees / fit.SEMICIRCLES)
+
+    timestamp = 1603699200 - fit.FIT_EPOCH  # 2020-10-26T08:00:00Z
+    record = bytes([0x00]) + struct.pack(
+        '<IiiHB', timestamp, semicircles(49.3), semicircles(16.3), (300 + 500) * 5, 130)
+    # compressed timestamp header, 2 seconds later, without heart rate
+    offset = (timestamp + 2) & 0x1F
+    record_compressed = bytes([0x80 | offset]) + struct.pack(
+        '<IiiHB', 0xFFFFFFFF, semicircles(49.4), semicircles(16.4), (301 + 500) * 5, 0xFF)
+
+    data = definition + record + record_compressed
+    header = struct.pack('<BBHI4sH', 14, 0x10, 2132, len(data), b".FIT", 0)
+    return header + data + b"\0\0"
+
+
+def make_archive(path):
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("activities.csv", (
+            "Activity ID,Activity Date,Activity Name,Activity Type,Elapsed Time,Distance,Filename,Distance\n"
+            "1,\"Oct 26, 2020, 8:00:00 AM\",Morning Ride,Ride,60,1.0,activities/101.gpx,1000.0\n"
+            "2,\"Oct 26, 2020, 8:00:00 AM\",Morning Ride,Ride,60,1.0,activities/102.gpx.gz,1000.0\n"
+            "3,\"Oct 26, 2020, 8:00:00 AM\",Tcx & Ride,Ride,60,1.0,activities/103.tcx.gz,1000.0\n"
+            "4,\"Oct 26, 2020, 8:00:00 AM\",Fit Ride,Ride,60,1.0,activities/104.fit.gz,1000.0\n"
+            "5,\"Oct 26, 2020, 8:00:00 AM\",Manual,Ride,60,1.0,,1000.0\n"
+            "6,\"Oct 26, 2020, 8:00:00 AM\",Broken,Ride,60,1.0,activities/106.fit.gz,1000.0\n"
+            "7,\"Oct 26, 2020, 8:00:00 AM\",Present,Ride,60,1.0,activities/107.gpx,1000.0\n"
+        ))
+        zf.writestr("activities/101.gpx", GPX)
+        zf.writestr("activities/102.gpx.gz", gzip.compress(GPX))
+        zf.writestr("activities/103.tcx.gz", gzip.compress(TCX))
+        zf.writestr("activities/104.fit.gz", gzip.compress(fit_file()))
+        zf.writestr("activities/106.fit.gz", gzip.compress(b"garbage"))
+        zf.writestr("activities/107.gpx", GPX)
+
+
+def read_gpx(path):
+    with gzip.open(path) as f:
+        root = ElementTree.parse(f).getroot()
+    return [
+        (
+            trkpt.get('lat'), trkpt.get('lon'),
+            trkpt.findtext(f"{GPX_NS}ele"), trkpt.findtext(f"{GPX_NS}time"),
+            trkpt.findtext(f"{GPX_NS}extensions/*/*"),
+        )
+        for trkpt in root.iter(f"{GPX_NS}trkpt")
+    ]
+
+
+def test_read_fit():
+    points = list(fit.read_track_points(io.BytesIO(fit_file())))
+    assert [(p.time, round(p.lat, 5), round(p.lon, 5), p.ele, p.hr) for p in points] == [
+        (1603699200, 49.3, 16.3, 300, 130),
+        (1603699202, 49.4, 16.4, 301, None),
+    ]
+
+
+def test_import_archive(tmp_path):
+    make_archive(tmp_path / "export.zip")
+    activities = tmp_path / "activities"
+    activities.mkdir()
+    (activities / "7.gpx").write_bytes(b"")
+
+    with sync.database(config.DatabaseConfig(strava_sqlite_database=":memory:")) as db:
+        gpx.index_gpx_files(db=db, dir_activities=activities)
+        archive.import_archive(db=db, archive=tmp_path / "export.zip", dir_activities=activities, processes=2)
+
+        files = [list(row) for row in db.execute("SELECT activity_id, path, source FROM gpx_file ORDER BY 1")]
+        assert files == [
+            [1, "1.gpx.gz", "archive"],
+            [2, "2.gpx.gz", "archive"],
+            [3, "3.gpx.gz", "archive"],
+            [4, "4.gpx.gz", "archive"],
+            [7, "7.gpx", "existing"],
+        ]
+
+    assert sorted(p.name for p in activities.iterdir()) == [
+        "1.gpx.gz", "2.gpx.gz", "3.gpx.gz", "4.gpx.gz", "7.gpx"]
+
+    # gpx copied or recompressed as is
+    assert gzip.decompress((activities / "1.gpx.gz").read_bytes()) == GPX
+    assert gzip.decompress((activities / "2.gpx.gz").read_bytes()) == GPX
+
+    # tcx and fit converted
+    assert read_gpx(activities / "3.gpx.gz") == [
+        ("49.2000000", "16.2000000", "200.5", "2020-10-26T08:00:00Z", "120"),
+    ]
+    assert read_gpx(activities / "4.gpx.gz") == [
+        ("49.3000000", "16.3000000", "300.0", "2020-10-26T08:00:00Z", "130"),
+        ("49.4000000", "16.4000000", "301.0", "2020-10-26T08:00:02Z", None),
+    ]
@@ -0,0 +1,17 @@
+from pathlib import Path
+import subprocess
+import sys
+
+import pytest
+
+BENCHMARKS = Path(__file__).parent.parent / "benchmarks"
+
+
+# benchmarks aren't imported by anything else, make sure they keep working as the code they measure changes
+@pytest.mark.parametrize('args', [
+    ["bench_upsert.py", "--rows", "50", "--repeat", "1"],
+    ["bench_reports.py", "--rows", "50", "--repeat", "1"],
+])
+def test_benchmark_runs(args):
+    p = subprocess.run([sys.executable, BENCHMARKS / args[0], *args[1:]], capture_output=True, text=True)
+    assert p.returncode == 0, p.stderr
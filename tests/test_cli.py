@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# network stack, only needed by commands that talk to Strava
+HTTP_MODULES = {'requests', 'urllib3', 'requests_oauthlib', 'oauthlib', 'bottle', 'strava_offline.strava'}
+
+
+def imported_modules(args, env):
+    # -X importtime lists every module imported, including those imported by click before the command runs
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import sys; from strava_offline.cli import cli; cli(sys.argv[1:])",
+         *args],
+        env=env, capture_output=True, text=True)
+    assert p.returncode == 0, p.stderr
+    return {
+        line.split("|")[-1].strip()
+        for line in p.stderr.splitlines() if line.startswith("import time:")
+    }
+
+
+@pytest.mark.parametrize('args', [
+    ["--help"],
+    ["report-yearly", "2020"],
+    ["report-yearly-bikes", "2020"],
+    ["report-bikes"],
+    ["report", "--by", "year"],
+    ["export", "bike"],
+])
+def test_report_imports(tmp_path, args):
+    env = {**os.environ, 'XDG_CONFIG_HOME': str(tmp_path / "config"), 'XDG_DATA_HOME': str(tmp_path / "data")}
+    modules = imported_modules(args, env)
+    assert 'strava_offline.cli' in modules
+    assert not modules & HTTP_MODULES
@@ -0,0 +1,110 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from strava_offline import daemon
+
+
+@pytest.fixture
+def running():
+    started = []
+
+    def run(scheduler):
+        thread = threading.Thread(target=scheduler.run_forever)
+        thread.start()
+        started.append((scheduler, thread))
+
+    yield run
+
+    for scheduler, thread in started:
+        scheduler.stop()
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+
+
+def wait_for(condition):
+    for _ in range(1000):
+        if condition():
+            return
+        time.sleep(0.01)
+    assert False, "timed out"
+
+
+def test_scheduler():
+    runs = []
+    scheduler = daemon.Scheduler([
+        daemon.Job(name='a', run=lambda: runs.append('a'), interval=3600),
+        daemon.Job(name='b', run=lambda: runs.append('b'), interval=0),
+        daemon.Job(name='c', run=lambda: 1 / 0, interval=3600),
+    ], jitter=60)
+
+    # jobs with an interval are due immediately after start, in order
+    while scheduler.run_pending():
+        pass
+    assert runs == ['a']
+    status = scheduler.status()
+    assert status['a']['runs'] == 1 and 3600 <= status['a']['next_run_in'] <= 3660
+    assert status['b']['runs'] == 0 and status['b']['next_run_in'] is None
+    assert status['c']['last_error'] == "ZeroDivisionError: division by zero"
+
+    assert scheduler.trigger(['b']) == ['b']
+    while scheduler.run_pending():
+        pass
+    assert runs == ['a', 'b']
+
+    with pytest.raises(ValueError):
+        scheduler.trigger(['x'])
+
+
+def test_coalesce(running):
+    started, release = threading.Event(), threading.Event()
+    runs = []
+
+    def slow():
+        runs.append(len(runs))
+        started.set()
+        release.wait(timeout=10)
+
+    scheduler = daemon.Scheduler([daemon.Job(name='slow', run=slow, interval=0)])
+    running(scheduler)
+
+    scheduler.trigger()
+    assert started.wait(timeout=10)
+    # triggers while running coalesce into a single further run
+    for _ in range(5):
+        scheduler.trigger(['slow'])
+    assert scheduler.status()['slow']['pending']
+    release.set()
+
+    wait_for(lambda: scheduler.status()['slow']['runs'] == 2 and not scheduler.status()['slow']['pending'])
+    assert runs == [0, 1]
+
+
+def test_control_socket(tmp_path, running):
+    path = tmp_path / "daemon.sock"
+    ran = threading.Event()
+    scheduler = daemon.Scheduler([daemon.Job(name='sync', run=ran.set, interval=0)])
+
+    with daemon.control_server(scheduler, path):
+        assert path.stat().st_mode & 0o077 == 0
+
+        with pytest.raises(RuntimeError):
+            with daemon.control_server(scheduler, path):
+                pass
+
+        running(scheduler)
+        assert daemon.control(path, "status")['status']['sync']['runs'] == 0
+        assert daemon.control(path, "sync") == {'triggered': ['sync']}
+        assert ran.wait(timeout=10)
+        assert 'error' in daemon.control(path, "sync foo")
+        assert 'error' in daemon.control(path, "restart")
+
+    assert not path.exists()
+
+    # stale socket of a daemon that didn't exit cleanly
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.bind(str(path))
+    with daemon.control_server(scheduler, path):
+        assert daemon.control(path, "status")['status']['sync']['runs'] == 1
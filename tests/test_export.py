@@ -0,0 +1,118 @@
+import csv
+import io
+import json
+
+from conftest import activity
+from conftest import database
+import pytest
+
+from strava_offline import export
+from strava_offline import sync
+
+
+def sample_data(db):
+    sync.table_bike.upsert(db, [{'id': "b1", 'name': "bike1"}])
+    sync.table_activity.upsert(db, [
+        activity(
+            i, f"2020-06-{i:02}T08:00:00Z", name=f"activity {i} ✓", commute=i % 2 == 0,
+            distance=None if i == 3 else 1000.0 * i)
+        for i in range(1, 8)
+    ])
+
+
+def run_export(db, format, **kwargs):
+    f = io.BytesIO()
+    export.export(db, f, format, batch_size=3, **kwargs)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('compress_json', [False, True])
+def test_export_csv(compress_json):
+    with database(sqlite_compress_json=compress_json) as db:
+        sample_data(db)
+        rows = list(csv.DictReader(io.StringIO(run_export(db, 'csv', table='activity').decode())))
+
+    assert [r['id'] for r in rows] == [str(i) for i in range(1, 8)]
+    assert rows[0]['name'] == "activity 1 ✓"
+    assert rows[2]['distance'] == ""
+    assert json.loads(rows[0]['json'])['upload_id'] == 2
+
+
+def test_export_ndjson():
+    with database() as db:
+        sample_data(db)
+        lines = run_export(db, 'ndjson', sql="SELECT id, distance FROM activity WHERE id > 4 ORDER BY id DESC")
+
+    assert [json.loads(line) for line in lines.decode().splitlines()] == [
+        {'id': 7, 'distance': 7000.0},
+        {'id': 6, 'distance': 6000.0},
+        {'id': 5, 'distance': 5000.0},
+    ]
+
+
+@pytest.mark.parametrize('format', ['parquet', 'arrow'])
+def test_export_arrow(format):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    def read(data):
+        if format == 'parquet':
+            return pyarrow.parquet.read_table(pa.BufferReader(data))
+        else:
+            return pa.ipc.open_file(pa.BufferReader(data)).read_all()
+
+    with database() as db:
+        sample_data(db)
+        activities = read(run_export(db, format, table='activity'))
+        assert activities.num_rows == 7
+        assert activities.schema.field('id').type == pa.int64()
+        assert activities.schema.field('commute').type == pa.bool_()
+        assert activities.column('distance').to_pylist()[:4] == [1000.0, 2000.0, None, 4000.0]
+
+        # types of query results are guessed from the first batch
+        query = read(run_export(db, format, sql="SELECT id, id / 2.0 AS half, NULL AS empty FROM activity"))
+        assert [f.type for f in query.schema] == [pa.int64(), pa.float64(), pa.string()]
+        assert query.column('half').to_pylist() == [0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5]
+
+        # types are derived from all rows, not just the first batch
+        late = read(run_export(db, format, sql="""
+            SELECT id, CASE WHEN id > 3 THEN id / 2.0 END AS late, CASE WHEN id > 3 THEN id / 2.0 ELSE id END AS mixed,
+                CASE WHEN id > 3 THEN x'00ff' END AS blob
+            FROM activity
+        """))
+        assert [f.type for f in late.schema] == [pa.int64(), pa.float64(), pa.float64(), pa.binary()]
+        assert late.column('late').to_pylist() == [None, None, None, 2.0, 2.5, 3.0, 3.5]
+        assert late.column('mixed').to_pylist() == [1.0, 2.0, 3.0, 2.0, 2.5, 3.0, 3.5]
+        assert late.column('blob').to_pylist()[2:4] == [None, b"\x00\xff"]
+
+        # untyped columns of rollups are guessed from their values
+        summary = read(run_export(db, format, table='activity_summary'))
+        assert [f.type for f in summary.schema] == [
+            pa.int64(), pa.int64(), pa.string(), pa.string(), pa.int64(), pa.float64(), pa.int64(), pa.float64()]
+        assert summary.to_pylist() == [{
+            'year': 2020, 'month': 6, 'type': "Ride", 'gear_id': "b1", 'count': 7,
+            'distance': 25000.0, 'moving_time': 7 * 3600, 'elevation_gain': 0.0,
+        }]
+
+        empty = read(run_export(db, format, table='gpx_file'))
+        assert empty.num_rows == 0
+        assert empty.schema.field('path').type == pa.string()
+
+
+@pytest.mark.parametrize('format', ['csv', 'ndjson'])
+def test_export_blob(format):
+    with database() as db:
+        data = run_export(db, format, sql="SELECT x'00ff' AS blob, NULL AS empty").decode()
+
+    if format == 'csv':
+        assert list(csv.DictReader(io.StringIO(data))) == [{'blob': "AP8=", 'empty': ""}]
+    else:
+        assert json.loads(data) == {'blob': "AP8=", 'empty': None}
+
+
+def test_export_invalid():
+    with database() as db:
+        with pytest.raises(ValueError):
+            run_export(db, 'csv', table='track')
+        with pytest.raises(ValueError):
+            run_export(db, 'csv')
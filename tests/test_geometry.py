@@ -0,0 +1,84 @@
+import random
+import sys
+
+from conftest import POLYLINE
+from conftest import activity
+from conftest import database
+import pytest
+
+from strava_offline import geometry
+from strava_offline import sync
+from strava_offline import tracks
+
+
+def encode_polyline(points):
+    def encode_value(v):
+        v = ~(v << 1) if v < 0 else v << 1
+        chunks = []
+        while v >= 0x20:
+            chunks.append(chr((0x20 | (v & 0x1F)) + 63))
+            v >>= 5
+        return "".join(chunks) + chr(v + 63)
+
+    encoded, last_lat, last_lon = [], 0, 0
+    for lat, lon in points:
+        lat, lon = round(lat * 1e5), round(lon * 1e5)
+        encoded.append(encode_value(lat - last_lat) + encode_value(lon - last_lon))
+        last_lat, last_lon = lat, lon
+    return "".join(encoded)
+
+
+def random_polylines(n):
+    rng = random.Random(42)
+    polylines = []
+    for _ in range(n):
+        lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        points = [(lat + rng.uniform(-1, 1), lon + rng.uniform(-1, 1)) for _ in range(rng.randrange(0, 50))]
+        polylines.append(encode_polyline(points))
+    return polylines
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_polyline_tracks(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setitem(sys.modules, 'numpy', None)
+
+    polylines = ["", POLYLINE, "bad!", "_p~iF", *random_polylines(100), ""]
+    decoded = geometry.polyline_tracks(polylines)
+    assert tracks.decode_track(decoded[0]) == tracks.Track(time=None, lat=[], lon=[], ele=None, hr=None)
+    assert tracks.decode_track(decoded[1]) == tracks.Track(
+        time=None, lat=[38.5, 40.7, 43.252], lon=[-120.2, -120.95, -126.453], ele=None, hr=None)
+    assert decoded[2:4] == [None, None]
+    assert decoded[4:] == [geometry._polyline_track(p) for p in polylines[4:]]
+
+    # crossing the antimeridian
+    crossing = geometry.polyline_tracks([encode_polyline([(0, -179), (0, 179), (0, -179.5)])])
+    assert tracks.decode_track(crossing[0]).lon == [-179, 179, -179.5]
+
+    # values that don't fit the track format
+    assert geometry.polyline_tracks([encode_polyline([(0, 0), (300, 0)])]) == [None]
+
+
+def test_update_geometry():
+    with database() as db:
+        def update():
+            geometry.update_geometry(db, batch_size=2)
+            return {row['activity_id']: row['points'] for row in db.execute("SELECT * FROM activity_geometry")}
+
+        sync.table_activity.upsert(db, [
+            activity(1, "2020-06-01T08:00:00Z", summary_polyline=POLYLINE),
+            activity(2, "2020-06-02T08:00:00Z"),
+            activity(3, "2020-06-03T08:00:00Z", summary_polyline="bad!"),
+        ])
+        assert update() == {1: 3, 2: 0, 3: None}
+        assert db.execute("SELECT DISTINCT typeof(json_hash) FROM activity_geometry").fetchone()[0] == 'integer'
+
+        # unchanged activities aren't decoded again
+        db.execute("UPDATE activity_geometry SET points = 42 WHERE activity_id = 1")
+        sync.table_activity.upsert(db, [
+            activity(1, "2020-06-01T08:00:00Z", summary_polyline=POLYLINE),
+            activity(3, "2020-06-03T08:00:00Z", summary_polyline="??"),
+        ])
+        assert update() == {1: 42, 3: 1}
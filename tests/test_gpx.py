@@ -1,13 +1,14 @@
+import gzip
+import io
+
+from conftest import database
 import pytest
+import requests
 
 from strava_offline import config
 from strava_offline import gpx
+from strava_offline.strava import NotLoggedIn
 from strava_offline.strava import StravaWeb
-from strava_offline import sync
-
-
-def database():
-    return sync.database(config.DatabaseConfig(strava_sqlite_database=":memory:"))
 
 
 def test_link_backup_activities(tmp_path):
@@ -31,19 +32,208 @@ def test_link_backup_activities(tmp_path):
             [7, 8],
         ])
 
+        gpx.index_gpx_files(db=db, dir_activities=activities)
         gpx.link_backup_activities(
             db=db, dir_activities=activities, dir_activities_backup=backup)
 
+        files = [list(row) for row in db.execute("SELECT activity_id, path, source FROM gpx_file ORDER BY activity_id")]
+        assert files == [
+            [1, "1.gpx", "linked"],
+            [3, "3.gpx", "linked"],
+            [5, "5.gpx", "existing"],
+            [7, "7.gpx.gz", "linked"],
+        ]
+
     assert (activities / "1.gpx").samefile(backup / "1.gpx")
     assert (activities / "3.gpx").samefile(backup / "4.gpx")
     assert not (activities / "5.gpx").samefile(backup / "6.gpx")
     assert (activities / "7.gpx.gz").samefile(backup / "7.gpx.gz")
 
 
+def test_index_gpx_files(tmp_path):
+    (tmp_path / "1.gpx").write_text("<gpx/>")
+    (tmp_path / "2.gpx.gz").touch()
+    (tmp_path / "3.gpx.gz.tmp").touch()
+    (tmp_path / "notes.txt").touch()
+
+    with database() as db:
+        gpx.index_gpx_files(db=db, dir_activities=tmp_path)
+        files = [list(row) for row in db.execute("SELECT activity_id, path, suffix, size FROM gpx_file ORDER BY 1")]
+        assert files == [
+            [1, "1.gpx", ".gpx", 6],
+            [2, "2.gpx.gz", ".gpx.gz", 0],
+        ]
+
+        # removed and renamed files are detected
+        (tmp_path / "1.gpx").unlink()
+        (tmp_path / "2.gpx.gz").rename(tmp_path / "2.gpx")
+        gpx.index_gpx_files(db=db, dir_activities=tmp_path)
+        files = [list(row) for row in db.execute("SELECT activity_id, path, suffix, size FROM gpx_file ORDER BY 1")]
+        assert files == [
+            [2, "2.gpx", ".gpx", 0],
+        ]
+
+
 @pytest.mark.vcr
 def test_download_gpx(tmp_path):
     cfg = config.StravaWebConfig(strava_cookie_strava4_session="TEST")
     strava = StravaWeb(config=cfg)
     gpx.download_gpx(strava=strava, activity_id=123, path=tmp_path)
 
-    assert (tmp_path / "123.gpx.gz").exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["123.gpx.gz"]
+    with gzip.open(tmp_path / "123.gpx.gz") as f:
+        content = f.read()
+    assert content.startswith(b"<?xml")
+    assert content.endswith(b"</gpx>\n")
+
+
+def test_download_activities(tmp_path, monkeypatch):
+    def write_gpx(self, activity_id, f):
+        f.write(b"<gpx>")
+        if activity_id == 2:
+            raise RuntimeError("download failed")
+        f.write(b"</gpx>")
+
+    monkeypatch.setattr(StravaWeb, 'write_gpx', write_gpx)
+
+    cfg = config.StravaWebConfig(strava_cookie_strava4_session="TEST")
+    strava = StravaWeb(config=cfg, pool_size=3)
+
+    (tmp_path / "4.gpx").touch()
+
+    with database() as db:
+        db.executemany("INSERT INTO activity (id, upload_id, has_location_data) VALUES (?, ?, ?)", [
+            [1, 1, True],
+            [2, 2, True],
+            [3, 3, True],
+            [4, 4, True],
+            [5, 5, False],
+            [6, None, True],
+        ])
+
+        # one failing activity doesn't stop the others
+        gpx.index_gpx_files(db=db, dir_activities=tmp_path)
+        gpx.download_activities(db=db, strava=strava, dir_activities=tmp_path, concurrency=3)
+
+        files = [list(row) for row in db.execute("SELECT activity_id, path, source FROM gpx_file ORDER BY activity_id")]
+        assert files == [
+            [1, "1.gpx.gz", "downloaded"],
+            [3, "3.gpx.gz", "downloaded"],
+            [4, "4.gpx", "existing"],
+        ]
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["1.gpx.gz", "3.gpx.gz", "4.gpx"]
+    with gzip.open(tmp_path / "1.gpx.gz") as f:
+        assert f.read() == b"<gpx></gpx>"
+
+
+def test_download_activities_retry(tmp_path, monkeypatch):
+    failing = {2, 3}
+
+    def write_gpx(self, activity_id, f):
+        if activity_id in failing:
+            raise RuntimeError("download failed")
+        f.write(b"<gpx/>")
+
+    monkeypatch.setattr(StravaWeb, 'write_gpx', write_gpx)
+
+    cfg = config.StravaWebConfig(strava_cookie_strava4_session="TEST")
+    strava = StravaWeb(config=cfg)
+
+    def download_activities(now):
+        gpx.download_activities(db=db, strava=strava, dir_activities=tmp_path, now=now)
+        return [list(row) for row in db.execute(
+            "SELECT activity_id, state, attempts, last_error, next_retry FROM gpx_download ORDER BY 1")]
+
+    with database() as db:
+        db.executemany("INSERT INTO activity (id, upload_id, has_location_data) VALUES (?, ?, ?)", [
+            [1, 1, True],
+            [2, 2, True],
+            [3, 3, True],
+        ])
+        gpx.index_gpx_files(db=db, dir_activities=tmp_path)
+
+        assert download_activities(now=0) == [
+            [1, "done", 1, None, None],
+            [2, "failed", 1, "download failed", 3600],
+            [3, "failed", 1, "download failed", 3600],
+        ]
+
+        # not retried until next_retry, then with exponential backoff
+        failing.remove(3)
+        assert download_activities(now=3599)[1:] == [
+            [2, "failed", 1, "download failed", 3600],
+            [3, "failed", 1, "download failed", 3600],
+        ]
+        assert download_activities(now=3600)[1:] == [
+            [2, "failed", 2, "download failed", 3600 + 7200],
+            [3, "done", 2, None, None],
+        ]
+
+        # given up after DOWNLOAD_MAX_ATTEMPTS
+        for now in range(10000, 1000000, 10000):
+            download_activities(now=now)
+        assert download_activities(now=10000000)[1][:3] == [2, "failed", gpx.DOWNLOAD_MAX_ATTEMPTS]
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=response)
+
+
+@pytest.mark.parametrize('error', [
+    NotLoggedIn("redirected to login page"),
+    requests.ConnectionError("network is unreachable"),
+    http_error(503),
+], ids=lambda e: type(e).__name__)
+def test_download_activities_systemic_failure(tmp_path, monkeypatch, error):
+    requested = []
+
+    def write_gpx(self, activity_id, f):
+        requested.append(activity_id)
+        raise error
+
+    monkeypatch.setattr(StravaWeb, 'write_gpx', write_gpx)
+
+    cfg = config.StravaWebConfig(strava_cookie_strava4_session="TEST")
+    strava = StravaWeb(config=cfg)
+
+    with database() as db:
+        db.executemany("INSERT INTO activity (id, upload_id, has_location_data) VALUES (?, ?, ?)", [
+            [i, i, True] for i in range(1, 21)
+        ])
+        gpx.index_gpx_files(db=db, dir_activities=tmp_path)
+
+        # the run is aborted without using up attempts, no matter how many times it happens
+        for _ in range(gpx.DOWNLOAD_MAX_ATTEMPTS + 1):
+            with pytest.raises(type(error)):
+                gpx.download_activities(db=db, strava=strava, dir_activities=tmp_path)
+
+        # and the rest of the queue isn't requested in vain
+        assert len(requested) == gpx.DOWNLOAD_MAX_ATTEMPTS + 1
+        assert [list(row) for row in db.execute("SELECT DISTINCT state, attempts FROM gpx_download")] == [
+            ["pending", 0],
+        ]
+
+    # per-activity errors still count
+    assert not gpx.is_systemic_error(http_error(404))
+    assert not gpx.is_systemic_error(RuntimeError("download failed"))
+
+
+def test_not_logged_in(monkeypatch):
+    def get(url, **kwargs):
+        redirect = requests.Response()
+        redirect.status_code = 302
+        response = requests.Response()
+        response.status_code = 200
+        response.url = "https://www.strava.com/login"
+        response.history = [redirect]
+        response.headers['Content-Type'] = "text/html"
+        response.raw = io.BytesIO(b"<html>")
+        return response
+
+    strava = StravaWeb(config=config.StravaWebConfig(strava_cookie_strava4_session="EXPIRED"))
+    monkeypatch.setattr(strava._session, 'get', get)
+    with pytest.raises(NotLoggedIn):
+        strava.get_gpx(123)
@@ -0,0 +1,161 @@
+import io
+from typing import List
+
+import pytest
+from requests import Request
+from requests import Response
+from requests.adapters import HTTPAdapter
+
+from strava_offline import config
+from strava_offline.ratelimit import RateLimitedAdapter
+from strava_offline.ratelimit import RateLimiter
+from strava_offline.ratelimit import parse_quotas
+from strava_offline.ratelimit import shared_limiter
+from strava_offline.strava import StravaWeb
+
+
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+        self.sleeps: List[float] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def request(method='GET'):
+    return Request(method, "https://www.strava.com/api/v3/athlete").prepare()
+
+
+def response(status_code=200, limit="100,1000", usage="0,0"):
+    r = Response()
+    r.status_code = status_code
+    r.raw = io.BytesIO()
+    if limit and usage:
+        r.headers['X-RateLimit-Limit'] = limit
+        r.headers['X-RateLimit-Usage'] = usage
+    return r
+
+
+def test_parse_quotas():
+    r = response(limit="200,2000", usage="10,500")
+    r.headers['X-ReadRateLimit-Limit'] = "100,1000"
+    r.headers['X-ReadRateLimit-Usage'] = "5,250"
+    quotas = [(q.window, q.limit, q.usage) for q in parse_quotas(r, now=0)]
+    assert quotas == [(900, 200, 10), (86400, 2000, 500), (900, 100, 5), (86400, 1000, 250)]
+
+    assert parse_quotas(Response(), now=0) == []
+
+
+def test_acquire_waits_for_next_window():
+    clock = FakeClock(now=1000 * 900 + 100)
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep, pace_after=1.0)  # no pacing
+
+    limiter.update(response(limit="100,1000", usage="98,500"))
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == []
+
+    # 15-minute quota used up, wait until the next window (plus a margin)
+    limiter.acquire()
+    assert clock.sleeps == [801]
+
+    # daily quota used up, wait until midnight UTC
+    clock.sleeps.clear()
+    limiter.update(response(limit="100,1000", usage="1,1000"))
+    limiter.acquire()
+    assert clock.now % 86400 == 1
+
+
+def test_acquire_paces_requests():
+    clock = FakeClock(now=1000 * 900 + 100)
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+
+    # bursts are fine while most of the quota is left
+    limiter.update(response(limit="100,1000", usage="10,10"))
+    for _ in range(40):
+        limiter.acquire()
+    assert clock.sleeps == []
+
+    # then the rest of it is spread over the rest of the window: 800 s left for 50 requests
+    limiter.acquire()
+    assert clock.sleeps == [16]
+    limiter.acquire()
+    assert clock.sleeps == [16, pytest.approx(784 / 49)]
+
+    # the next window starts afresh
+    clock.now = 1001 * 900
+    limiter.acquire()
+    assert len(clock.sleeps) == 2
+
+
+def test_acquire_doesnt_pace_daily_quota():
+    clock = FakeClock(now=1000 * 86400 + 12 * 3600)
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+
+    # more than half of the daily quota used up at noon, requests still go out at full speed
+    limiter.update(response(limit="200,2000", usage="5,1100"))
+    for _ in range(20):
+        limiter.acquire()
+    assert clock.sleeps == []
+
+
+def test_shared_limiter():
+    assert shared_limiter("api:1") is shared_limiter("api:1")
+    assert shared_limiter("api:1") is not shared_limiter("api:2")
+
+    cfg = config.StravaWebConfig(strava_cookie_strava4_session="TEST")
+    adapters = [StravaWeb(config=cfg)._session.get_adapter("https://www.strava.com/") for _ in range(2)]
+    assert adapters[0].limiter is adapters[1].limiter is shared_limiter("web")
+
+
+@pytest.fixture
+def fake_send(monkeypatch) -> List[Response]:
+    responses: List[Response] = []
+
+    def send(self, request, *args, **kwargs):
+        return responses.pop(0)
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    return responses
+
+
+def test_retry_too_many_requests(fake_send):
+    clock = FakeClock(now=1000 * 900 + 100)
+    adapter = RateLimitedAdapter(RateLimiter(clock=clock, sleep=clock.sleep))
+
+    fake_send.extend([response(429, usage="100,100"), response(200, usage="1,101")])
+    r = adapter.send(request())
+    assert r.status_code == 200
+    assert clock.sleeps == [801]
+
+    # 429 without exhausted quota (e.g. missing headers) holds off until the next window too
+    clock.sleeps.clear()
+    fake_send.extend([response(429, limit=None, usage=None), response(200, usage="1,102")])
+    r = adapter.send(request())
+    assert r.status_code == 200
+    assert len(clock.sleeps) == 1 and clock.now % 900 == 1
+
+
+def test_retry_server_error(fake_send):
+    clock = FakeClock(now=0)
+    adapter = RateLimitedAdapter(RateLimiter(clock=clock, sleep=clock.sleep), retries=2)
+
+    fake_send.extend([response(503), response(502), response(200)])
+    assert adapter.send(request()).status_code == 200
+    assert clock.sleeps == [1, 2]
+
+    # gives up after retries
+    clock.sleeps.clear()
+    fake_send.extend([response(503), response(503), response(503)])
+    assert adapter.send(request()).status_code == 503
+    assert clock.sleeps == [1, 2]
+
+    # non-idempotent requests aren't retried
+    fake_send.extend([response(503)])
+    assert adapter.send(request(method='POST')).status_code == 503
+    assert fake_send == []
@@ -0,0 +1,168 @@
+import sqlite3
+import time
+
+from conftest import activity
+from conftest import database
+import pytest
+
+from strava_offline import analytics
+from strava_offline import config
+from strava_offline import reports
+from strava_offline import sqlite
+from strava_offline import sync
+
+
+def sample_data(db):
+    sync.table_bike.upsert(db, [
+        {'id': "b1", 'name': "bike1"},
+        {'id': "b2", 'name': "bike2"},
+    ])
+    sync.table_activity.upsert(db, [
+        activity(1, "2020-06-01T08:00:00Z", "2020-06-01T10:00:00Z", distance=20000.0),
+        activity(2, "2020-12-31T23:30:00Z", "2021-01-01T00:30:00Z", gear_id="b2"),
+        activity(
+            3, "2021-03-01T08:00:00Z", "2021-03-01T09:00:00Z",
+            type="Run", gear_id=None, distance=5000.0, moving_time=7200),
+    ])
+
+
+def test_yearly():
+    with database() as db:
+        sample_data(db)
+
+        assert reports.yearly(db, 2020).splitlines() == [
+            "Activity type      Distance (km)    Moving time (hour)",
+            "---------------  ---------------  --------------------",
+            "Ride                          20                     1",
+        ]
+        assert reports.yearly(db, 2021).splitlines() == [
+            "Activity type      Distance (km)    Moving time (hour)",
+            "---------------  ---------------  --------------------",
+            "Ride                          10                     1",
+            "Run                            5                     2",
+        ]
+
+
+def test_yearly_bikes():
+    with database() as db:
+        sample_data(db)
+
+        assert reports.yearly_bikes(db, 2021).splitlines() == [
+            "Bike      Distance (km)    Moving time (hour)",
+            "------  ---------------  --------------------",
+            "bike2                10                     1",
+        ]
+
+
+def test_bikes():
+    with database() as db:
+        sample_data(db)
+
+        assert reports.bikes(db).splitlines() == [
+            "Bike      Distance (km)    Moving time (hour)",
+            "------  ---------------  --------------------",
+            "bike1                20                     1",
+            "bike2                10                     1",
+        ]
+
+
+def test_activity_summary():
+    def summary(db):
+        return [list(row) for row in db.execute("SELECT * FROM activity_summary ORDER BY 1, 2, 3, 4")]
+
+    def summary_from_scratch(db):
+        return [list(row) for row in db.execute("""
+            SELECT
+                start_year, start_month, type, gear_id,
+                COUNT(*), SUM(distance), SUM(moving_time), SUM(total_elevation_gain)
+            FROM activity
+            GROUP BY 1, 2, 3, 4
+            ORDER BY 1, 2, 3, 4
+        """)]
+
+    with database() as db:
+        sample_data(db)
+        assert summary(db) == summary_from_scratch(db)
+        assert len(summary(db)) == 3
+
+        # update, insert, delete
+        sync.table_activity.upsert(db, [
+            activity(1, "2020-06-01T08:00:00Z", "2020-06-01T10:00:00Z", distance=30000.0),
+            activity(2, "2020-12-31T23:30:00Z", "2021-01-01T00:30:00Z", gear_id="b2"),
+            activity(4, "2020-06-02T08:00:00Z", "2020-06-02T10:00:00Z"),
+        ])
+        assert summary(db) == summary_from_scratch(db)
+        assert len(summary(db)) == 2
+
+        # rebuild from scratch after migration
+        db.execute("DELETE FROM activity_summary")
+        db.execute("PRAGMA user_version = 0")
+        sync.schema.initialize(db)
+        assert summary(db) == summary_from_scratch(db)
+
+
+def test_custom():
+    with database() as db:
+        sample_data(db)
+        metrics = [analytics.parse_metric(m) for m in ["count", "sum(distance)"]]
+        assert reports.custom(db, ["year", "gear"], metrics).splitlines() == [
+            "  year  gear      count    sum(distance)",
+            "------  ------  -------  ---------------",
+            "  2020  bike1         1             20.0",
+            "  2021                1              5.0",
+            "  2021  bike2         1             10.0",
+        ]
+
+
+def test_cache():
+    with database() as db:
+        sample_data(db)
+        report = reports.yearly(db, 2020)
+        generation = sqlite.generation(db)
+
+        # cached reports don't touch the data
+        def deny_activity(action, table, *args):
+            return sqlite3.SQLITE_DENY if table in ("activity", "activity_summary") else sqlite3.SQLITE_OK
+
+        db.set_authorizer(deny_activity)
+        assert reports.yearly(db, 2020) == report
+        with pytest.raises(sqlite3.DatabaseError):
+            reports.yearly(db, 2021)
+        db.set_authorizer(None)
+
+        # unchanged data doesn't invalidate the cache
+        sync.table_activity.upsert(db, [
+            activity(1, "2020-06-01T08:00:00Z", "2020-06-01T10:00:00Z", distance=20000.0),
+        ], incremental=True)
+        assert sqlite.generation(db) == generation
+        assert reports.yearly(db, 2020) == report
+
+        # changed data does
+        sync.table_activity.upsert(db, [
+            activity(1, "2020-06-01T08:00:00Z", "2020-06-01T10:00:00Z", distance=30000.0),
+        ], incremental=True)
+        assert sqlite.generation(db) > generation
+        assert reports.yearly(db, 2020) != report
+        assert db.execute("SELECT COUNT(*) FROM report_cache").fetchone()[0] == 1
+
+
+def test_cache_doesnt_block(tmp_path):
+    cfg = config.DatabaseConfig(strava_sqlite_database=tmp_path / "strava.sqlite", sqlite_busy_timeout=5000)
+    with sync.database(cfg) as db:
+        sample_data(db)
+
+    # a sync in progress holds the write lock
+    with sync.database(cfg) as writer, sync.database(cfg) as db:
+        writer.execute("BEGIN IMMEDIATE")
+        try:
+            start = time.monotonic()
+            report = reports.yearly(db, 2020)
+            assert time.monotonic() - start < 2
+        finally:
+            writer.execute("ROLLBACK")
+
+        # the report wasn't cached, the busy timeout is restored
+        assert db.execute("SELECT COUNT(*) FROM report_cache").fetchone()[0] == 0
+        assert db.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+        assert reports.yearly(db, 2020) == report
+        assert db.execute("SELECT COUNT(*) FROM report_cache").fetchone()[0] == 1
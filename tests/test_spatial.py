@@ -0,0 +1,75 @@
+from conftest import POLYLINE
+from conftest import activity
+from conftest import database
+
+from strava_offline.fit import TrackPoint
+from strava_offline import geometry
+from strava_offline import polyline
+from strava_offline import reports
+from strava_offline import spatial
+from strava_offline import sync
+from strava_offline import tracks
+
+
+def diagonal_track():
+    # from (50.0, 14.0) to (50.099, 14.099)
+    return tracks.encode_track(
+        TrackPoint(time=i, lat=50 + i / 1000, lon=14 + i / 1000, ele=None, hr=None)
+        for i in range(100)
+    )
+
+
+def test_polyline_decode():
+    assert polyline.decode(POLYLINE) == [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+    assert polyline.decode("") == []
+
+
+def test_segment_bboxes():
+    lat = [i / 1000 for i in range(100)]
+    segments = spatial.segment_bboxes(lat, lat)
+    assert len(segments) == 4
+    assert segments[0] == spatial.BBox(0, 0, 0.032, 0.032)
+    assert segments[-1] == spatial.BBox(0.096, 0.096, 0.099, 0.099)
+    assert spatial.segment_bboxes([1.0], [2.0]) == [spatial.BBox(1.0, 2.0, 1.0, 2.0)]
+
+
+def test_update_index():
+    with database() as db:
+        def find(*area, within=False):
+            geometry.update_geometry(db, batch_size=2)
+            spatial.update_index(db, batch_size=2)
+            return spatial.activities_in_area(db, spatial.BBox(*area), within)
+
+        sync.table_activity.upsert(db, [
+            activity(1, "2020-06-01T08:00:00Z", summary_polyline=POLYLINE),
+            activity(2, "2020-06-02T08:00:00Z", summary_polyline=POLYLINE),
+            activity(3, "2020-06-03T08:00:00Z"),
+        ])
+        db.execute("INSERT INTO track (activity_id, path, size, mtime, data) VALUES (2, '2.gpx', 1, 1.0, ?)",
+                   (diagonal_track(),))
+
+        assert find(39, -121, 41, -120) == [1]
+        assert find(38, -127, 44, -120, within=True) == [1]
+        assert find(39, -127, 44, -120, within=True) == []
+
+        # track takes precedence over the summary polyline, and segments are matched, not just the bbox
+        assert find(50.01, 14.01, 50.02, 14.02) == [2]
+        assert find(50.01, 14.07, 50.02, 14.08) == []
+        assert find(49, 13, 51, 15, within=True) == [2]
+        assert find(-90, -180, 90, 180) == [2, 1]
+        assert "activity 2" in reports.area(db, spatial.BBox(49, 13, 51, 15))
+
+        # unchanged activities aren't reindexed
+        db.execute("DELETE FROM activity_rtree WHERE id = 1")
+        assert find(38, -127, 44, -120, within=True) == []
+
+        # changed and deleted ones are
+        sync.table_activity.upsert(db, [
+            activity(1, "2020-06-01T08:00:00Z", summary_polyline="??"),
+            activity(2, "2020-06-02T08:00:00Z", summary_polyline=POLYLINE),
+        ])
+        db.execute("DELETE FROM track")
+        assert find(38, -127, 44, -120, within=True) == [2]
+        assert find(-1, -1, 1, 1) == [1]
+        assert find(49, 13, 51, 15) == []
+        assert [list(row) for row in db.execute("SELECT activity_id FROM activity_spatial")] == [[1], [2]]
@@ -1,18 +1,18 @@
+from dataclasses import replace
 from datetime import datetime
 from datetime import timezone
 import sqlite3
+import time
 
+from conftest import database
 import pytest
 
 from strava_offline import config
+from strava_offline import sqlite
 from strava_offline.strava import StravaAPI
 from strava_offline import sync
 
 
-def database():
-    return sync.database(config.DatabaseConfig(strava_sqlite_database=":memory:"))
-
-
 def strava(tmp_path):
     token = tmp_path / "token.json"
     token.write_text('{"access_token": "token"}')
@@ -136,6 +136,132 @@ def test_sync_activities(tmp_path):
         ]
 
 
+def test_get_activities_concurrent(tmp_path, monkeypatch):
+    # vcr isn't thread-safe (it temporarily unpatches http.client while creating connections),
+    # so fake the pages instead, with earlier pages taking longer to arrive
+    def get_activities_page(self, params):
+        page = params['page']
+        time.sleep(0.05 / page)
+        return [{'id': page * 10 + i} for i in range(3)] if page <= 3 else []
+
+    monkeypatch.setattr(StravaAPI, '_get_activities_page', get_activities_page)
+
+    # several pages requested at once, activities still come in order
+    activities = [a['id'] for a in strava(tmp_path).get_activities(concurrency=4)]
+    assert activities == [10, 11, 12, 20, 21, 22, 30, 31, 32]
+
+
+@pytest.mark.default_cassette("test_sync_activities.yaml")
+@pytest.mark.vcr
+def test_sync_activities_unchanged(tmp_path):
+    before = datetime.fromtimestamp(1610000000, tz=timezone.utc)
+
+    with database() as db:
+        # initial sync
+        sync.sync_activities(strava=strava(tmp_path), db=db, before=before)
+
+        # pretend one activity changed on the Strava side, and modify another one locally
+        db.execute("UPDATE activity SET json_hash = 0, name = 'xxx' WHERE id = 1234567900")
+        db.execute("UPDATE activity SET name = 'yyy' WHERE id = 1234567902")
+
+        # sync again, only the changed activity gets rewritten
+        sync.sync_activities(strava=strava(tmp_path), db=db, before=before)
+
+        names = [list(row) for row in db.execute(
+            "SELECT id, name FROM activity WHERE id IN (1234567900, 1234567902) ORDER BY id")]
+        assert names == [
+            [1234567900, 'name1'],
+            [1234567902, 'yyy'],
+        ]
+
+
+def test_upsert_consumes_lazily():
+    def bikes(ids, consumed):
+        for i in ids:
+            consumed.append(i)
+            yield {'id': f"b{i}", 'name': f"bike{i}"}
+
+    with database() as db:
+        sync.table_bike.upsert(db, bikes(range(100), []))
+
+        # incremental upsert stops after incremental_stop_after known rows without reading further
+        # (which would fetch more pages from Strava)
+        consumed = []
+        sync.table_bike.upsert(db, bikes(range(200, -1, -1), consumed), incremental=True, incremental_stop_after=3)
+        assert len(consumed) == 101 + 3 + 1
+        assert db.execute("SELECT COUNT(*) FROM bike").fetchone()[0] == 201
+
+
+def test_upsert_doesnt_hold_write_lock(tmp_path):
+    cfg = config.DatabaseConfig(strava_sqlite_database=tmp_path / "strava.sqlite")
+
+    with sync.database(cfg) as db:
+        sync.table_bike.upsert(db, [{'id': "old", 'name': "old"}])
+
+        # another command writing while the sync waits for Strava (e.g. rate limited)
+        def bikes():
+            for i in range(2500):
+                if i == 2000:
+                    with sqlite3.connect(cfg.strava_sqlite_database, timeout=0) as other:
+                        other.execute("UPDATE bike SET name = 'other' WHERE id = 'b1'")
+                yield {'id': f"b{i}", 'name': f"bike{i}"}
+
+        sync.table_bike.upsert(db, bikes())
+        assert db.execute("SELECT name FROM bike WHERE id = 'b1'").fetchone()[0] == 'other'
+        assert db.execute("SELECT COUNT(*) FROM bike").fetchone()[0] == 2500
+        assert not db.execute("SELECT * FROM sqlite_master WHERE name LIKE '%_seen'").fetchall()
+
+
+@pytest.mark.default_cassette("test_sync_activities.yaml")
+@pytest.mark.vcr
+def test_compress_json(tmp_path):
+    before = datetime.fromtimestamp(1610000000, tz=timezone.utc)
+    db_path = tmp_path / "test.sqlite"
+
+    with sync.database(config.DatabaseConfig(strava_sqlite_database=db_path, sqlite_compress_json=True)) as db:
+        sync.sync_activities(strava=strava(tmp_path), db=db, before=before)
+
+        names = [list(row) for row in db.execute(
+            "SELECT DISTINCT typeof(json), json_extract(json_text(json), '$.name') FROM activity")]
+        assert names == [['blob', 'name1']]
+
+        # migration decompresses and compresses again
+        db.execute("PRAGMA user_version = 0")
+
+    with sync.database(config.DatabaseConfig(strava_sqlite_database=db_path, sqlite_compress_json=True)) as db:
+        names = [list(row) for row in db.execute(
+            "SELECT DISTINCT typeof(json), json_extract(json_text(json), '$.name') FROM activity")]
+        assert names == [['blob', 'name1']]
+
+    with sync.database(config.DatabaseConfig(strava_sqlite_database=db_path)) as db:
+        sync.table_activity.convert_json(db)
+
+        names = [list(row) for row in db.execute(
+            "SELECT DISTINCT typeof(json), json_extract(json, '$.name') FROM activity")]
+        assert names == [['text', 'name1']]
+
+
+@pytest.mark.vcr
+def test_sync_incremental_after(tmp_path):
+    cfg = config.SyncConfig(strava_sqlite_database=tmp_path / "strava.sqlite")
+
+    with sync.database(cfg) as db:
+        # latest known activity: 2020-01-01T08:00:00Z
+        db.execute("INSERT INTO activity (id, start_time) VALUES (1, 1577865600)")
+
+    # sync only asks for activities since a week before the latest one
+    sync.sync(config=cfg, strava=strava(tmp_path))
+
+    with sync.database(cfg) as db:
+        activities = [list(row) for row in db.execute(
+            "SELECT id FROM activity ORDER BY id")]
+        assert activities == [
+            [1],
+            [1234567914],
+            [1234567916],
+        ]
+
+
 @pytest.mark.vcr
 def test_migration_bikes(tmp_path):
     db_uri = "file:test_migration_bikes?mode=memory&cache=shared"
@@ -176,3 +302,43 @@ def test_migration_activities(tmp_path):
         assert activities == ['name1']
 
     db_keep_in_memory.close()
+
+
+def test_migration_fingerprint(tmp_path):
+    db_path = tmp_path / "test.sqlite"
+    data = [{'id': 1, 'name': 'a', 'x': 10}, {'id': 2, 'name': 'b', 'x': 20}]
+
+    table_v1 = sqlite.Table(
+        name='test',
+        columns={'id': "INTEGER PRIMARY KEY", 'name': "TEXT"},
+        from_dict=lambda d: {'id': d['id'], 'name': d['name']},
+    )
+    with sqlite.database(db_path, sqlite.Schema(version=1, tables=[table_v1])) as db:
+        table_v1.upsert(db, data)
+        db.execute("UPDATE test SET name = 'xxx' WHERE id = 1")
+
+    # added column is backfilled in place, the table isn't recreated
+    table_v2 = sqlite.Table(
+        name='test',
+        columns={'id': "INTEGER PRIMARY KEY", 'name': "TEXT", 'x': "INTEGER"},
+        from_dict=lambda d: {'id': d['id'], 'name': d['name'], 'x': d['x']},
+    )
+    with sqlite.database(db_path, sqlite.Schema(version=1, tables=[table_v2])) as db:
+        rows = [list(row) for row in db.execute("SELECT id, name, x FROM test ORDER BY id")]
+        assert rows == [[1, 'xxx', 10], [2, 'b', 20]]
+
+    # bumped table version recreates the table
+    table_v3 = replace(table_v2, version=2)
+    with sqlite.database(db_path, sqlite.Schema(version=1, tables=[table_v3])) as db:
+        rows = [list(row) for row in db.execute("SELECT id, name, x FROM test ORDER BY id")]
+        assert rows == [[1, 'a', 10], [2, 'b', 20]]
+
+
+def test_database_pragmas(tmp_path):
+    cfg = config.DatabaseConfig(strava_sqlite_database=tmp_path / "strava.sqlite")
+
+    with sync.database(cfg) as db:
+        assert db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        assert db.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert db.execute("PRAGMA temp_store").fetchone()[0] == 2  # MEMORY
+        assert db.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
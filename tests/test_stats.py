@@ -0,0 +1,120 @@
+import pytest
+
+from strava_offline import config
+from strava_offline.fit import TrackPoint
+from strava_offline import sync
+from strava_offline import tracks
+
+stats = pytest.importorskip("strava_offline.stats")
+
+# 0.0001° of latitude is ~11.1 m
+LAT_STEP = 0.0001
+METRES_PER_STEP = 11.119
+
+
+def synthetic_track():
+    points = []
+    for i in range(11):
+        points.append(TrackPoint(
+            time=1603699200 + i * 2 + (60 if i > 5 else 0),  # pause of 60 s after 5th point
+            lat=49.0 + i * LAT_STEP if i <= 5 else 49.0 + 5 * LAT_STEP + (i - 5) * LAT_STEP * 2,
+            lon=16.0,
+            ele=200.0 + (i % 2) * 10,  # noisy elevation
+            hr=110 + i * 10,
+        ))
+    return points
+
+
+def test_track_stats():
+    s = stats.track_stats(tracks.encode_track(synthetic_track()), hr_zones=[123, 153, 169, 184])
+
+    assert s['points'] == 11
+    assert (s['min_lat'], s['max_lat'], s['min_lon'], s['max_lon']) == pytest.approx((49.0, 49.0015, 16.0, 16.0))
+    assert (s['start_lat'], s['start_lon']) == pytest.approx((49.0, 16.0))
+    assert (s['end_lat'], s['end_lon']) == pytest.approx((49.0015, 16.0))
+    assert s['distance'] == pytest.approx(15 * METRES_PER_STEP, rel=1e-3)
+    assert s['elapsed_time'] == 80
+    # the 62 s segment over the pause is slower than MOVING_SPEED
+    assert s['moving_time'] == 18
+    # 1 step per 2 seconds before the pause (windows after the pause all include it)
+    assert s['max_speed'] == pytest.approx(METRES_PER_STEP / 2, rel=1e-3)
+    # moving average smooths the 10 m zig-zag out almost entirely
+    assert s['elevation_gain'] < 10
+    # zones by hr at segment start: 110, 120 | 130, 140, 150 | 160 | 170, 180 | 190, 200
+    # the 62 s segment starting at 160 bpm exceeds MAX_GAP
+    assert [s[f'hr_zone{i}'] for i in range(1, 6)] == [4, 6, 0, 4, 4]
+
+
+def test_track_stats_antimeridian():
+    points = [TrackPoint(time=None, lat=0.0, lon=lon, ele=None, hr=None) for lon in (179.9999, -179.9999)]
+    s = stats.track_stats(tracks.encode_track(points), hr_zones=[123, 153, 169, 184])
+    assert (s['start_lon'], s['end_lon']) == pytest.approx((179.9999, -179.9999))
+    assert s['distance'] == pytest.approx(2 * METRES_PER_STEP, rel=1e-3)
+
+
+def test_compute_stats():
+    with sync.database(config.DatabaseConfig(strava_sqlite_database=":memory:")) as db:
+        db.executemany("INSERT INTO track (activity_id, path, size, mtime, data) VALUES (?, ?, ?, ?, ?)", [
+            [1, "1.gpx.gz", 100, 1.0, tracks.encode_track(synthetic_track())],
+            [2, "2.gpx.gz", 100, 1.0, tracks.encode_track([])],
+            [3, "3.gpx", 100, 1.0, None],
+        ])
+
+        stats.compute_stats(db, hr_zones="123,153,169,184", processes=2)
+        rows = {r['activity_id']: r for r in db.execute("SELECT * FROM activity_track_stats")}
+        assert list(rows) == [1, 2]
+        assert rows[1]['points'] == 11 and rows[1]['moving_time'] == 18
+        assert rows[2]['points'] == 0 and rows[2]['distance'] is None
+
+        # only changed tracks (or all of them if zones change) are recomputed
+        db.execute("UPDATE activity_track_stats SET points = NULL")
+        db.execute("UPDATE track SET mtime = 2.0 WHERE activity_id = 2")
+        db.execute("DELETE FROM track WHERE activity_id = 1")
+        db.execute("INSERT INTO track (activity_id, path, size, mtime, data) VALUES (4, '4.gpx', 1, 1.0, ?)",
+                   (tracks.encode_track(synthetic_track()),))
+        stats.compute_stats(db, hr_zones="123,153,169,184", processes=2)
+        rows = {r['activity_id']: r for r in db.execute("SELECT * FROM activity_track_stats")}
+        assert {k: r['points'] for k, r in rows.items()} == {2: 0, 4: 11}
+
+        stats.compute_stats(db, hr_zones="100,153,169,184", processes=2)
+        rows = {r['activity_id']: r for r in db.execute("SELECT * FROM activity_track_stats")}
+        assert rows[4]['hr_zone1'] == 0
+
+
+def test_compute_stats_error(monkeypatch):
+    def track_stats(blob, hr_zones):
+        if blob == b"broken":
+            raise ValueError("invalid track")
+        return {'points': 1}
+
+    monkeypatch.setattr(stats, 'track_stats', track_stats)
+
+    with sync.database(config.DatabaseConfig(strava_sqlite_database=":memory:")) as db:
+        db.executemany("INSERT INTO track (activity_id, path, size, mtime, data) VALUES (?, ?, ?, ?, ?)", [
+            [1, "1.gpx", 100, 1.0, b"ok"],
+            [2, "2.gpx", 100, 1.0, b"broken"],
+        ])
+
+        # failed tracks are recorded, and not retried until they change
+        stats.compute_stats(db, hr_zones="123,153,169,184", processes=1)
+        assert [list(r) for r in db.execute("SELECT activity_id, error FROM activity_track_stats_error")] == [
+            [2, "invalid track"],
+        ]
+        db.execute("UPDATE activity_track_stats_error SET error = 'not retried'")
+        stats.compute_stats(db, hr_zones="123,153,169,184", processes=1)
+        assert db.execute("SELECT error FROM activity_track_stats_error").fetchone()[0] == "not retried"
+
+        # a fixed track replaces the error, a broken one replaces stale stats
+        db.execute("UPDATE track SET data = ?, mtime = 2.0", (b"broken",))
+        db.execute("UPDATE track SET data = ? WHERE activity_id = 2", (b"ok",))
+        stats.compute_stats(db, hr_zones="123,153,169,184", processes=1)
+        assert [r[0] for r in db.execute("SELECT activity_id FROM activity_track_stats")] == [2]
+        assert [r[0] for r in db.execute("SELECT activity_id FROM activity_track_stats_error")] == [1]
+
+
+def test_parse_hr_zones():
+    assert stats.parse_hr_zones("1,2,3,4") == [1, 2, 3, 4]
+    with pytest.raises(ValueError):
+        stats.parse_hr_zones("1,2,3")
+    with pytest.raises(ValueError):
+        stats.parse_hr_zones("4,3,2,1")
@@ -1,3 +1,7 @@
+import json
+import threading
+import time
+
 import pytest
 
 from strava_offline import config
@@ -30,3 +34,35 @@ def test_fetch_token(tmp_path, monkeypatch):
     athlete = api.get_athlete()
     assert api._session.access_token == 'NEW_ACCESS_TOKEN'
     assert athlete['id']
+
+
+def test_refresh_token_concurrent(tmp_path, monkeypatch):
+    token = tmp_path / "token.json"
+    token.write_text(json.dumps({
+        'token_type': "Bearer", 'access_token': "ACCESS_TOKEN", 'refresh_token': "REFRESH_TOKEN",
+        'expires_at': 1600000000,
+    }))
+    cfg = config.StravaApiConfig(strava_token_filename=token, strava_client_id='12345', strava_client_secret='SECRET')
+    api = strava.StravaAPI(config=cfg)
+
+    refreshes = []
+
+    def refresh_token(token_url):
+        refreshes.append(token_url)
+        time.sleep(0.05)
+        api._session.token = {
+            **api._session.token, 'access_token': "NEW_ACCESS_TOKEN", 'expires_at': time.time() + 3600}
+        return api._session.token
+
+    monkeypatch.setattr(api._session, 'refresh_token', refresh_token)
+
+    # threads fetching activity pages all find the token expired, only one refreshes it
+    threads = [threading.Thread(target=api._refresh_token) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(refreshes) == 1
+    assert json.loads(token.read_text())['access_token'] == "NEW_ACCESS_TOKEN"
+    assert list(tmp_path.iterdir()) == [token]
@@ -0,0 +1,87 @@
+import gzip
+import io
+import os
+
+from strava_offline import config
+from strava_offline.fit import TrackPoint
+from strava_offline import gpx
+from strava_offline import sync
+from strava_offline import tracks
+
+GPX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx creator="StravaGPX" version="1.1" xmlns="http://www.topografix.com/GPX/1/1"
+     xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">
+ <trk>
+  <name>Morning Ride</name>
+  <trkseg>
+   <trkpt lat="49.1234567" lon="16.1234567">
+    <ele>200.0</ele>
+    <time>2020-10-26T08:00:00Z</time>
+    <extensions><gpxtpx:TrackPointExtension><gpxtpx:hr>120</gpxtpx:hr></gpxtpx:TrackPointExtension></extensions>
+   </trkpt>
+   <trkpt lat="49.1235" lon="16.1236">
+    <ele>201.3</ele>
+    <time>2020-10-26T08:00:01Z</time>
+   </trkpt>
+  </trkseg>
+ </trk>
+</gpx>
+"""
+
+
+def test_parse_gpx():
+    # small chunks to exercise incremental parsing
+    points = list(tracks.parse_gpx(io.BytesIO(GPX), chunk_size=16))
+    assert points == [
+        TrackPoint(time=1603699200, lat=49.1234567, lon=16.1234567, ele=200.0, hr=120),
+        TrackPoint(time=1603699201, lat=49.1235, lon=16.1236, ele=201.3, hr=None),
+    ]
+
+
+def test_encode_track():
+    points = [
+        TrackPoint(time=1603699200, lat=49.1234567, lon=16.1234567, ele=None, hr=None),
+        TrackPoint(time=None, lat=None, lon=None, ele=None, hr=None),
+        TrackPoint(time=1603699201, lat=-49.1235, lon=-16.1236, ele=None, hr=130),
+        TrackPoint(time=1603699203, lat=-49.1236, lon=-16.1237, ele=None, hr=None),
+    ]
+    track = tracks.decode_track(tracks.encode_track(points))
+    assert len(track) == 3
+    assert track.time == [1603699200, 1603699201, 1603699203]
+    assert track.lat == [49.1234567, -49.1235, -49.1236]
+    assert track.lon == [16.1234567, -16.1236, -16.1237]
+    assert track.ele is None
+    assert track.hr == [130, 130, 130]  # gaps filled
+
+    assert len(tracks.decode_track(tracks.encode_track([]))) == 0
+
+    # longitude deltas across the antimeridian are stored the short way round
+    points = [TrackPoint(time=None, lat=0, lon=lon, ele=None, hr=None) for lon in (179.9999999, -179.9999999, 180)]
+    assert tracks.decode_track(tracks.encode_track(points)).lon == [179.9999999, -179.9999999, -180]
+
+
+def test_load_tracks(tmp_path):
+    (tmp_path / "1.gpx.gz").write_bytes(gzip.compress(GPX))
+    (tmp_path / "2.gpx").write_bytes(GPX)
+    (tmp_path / "3.gpx").write_bytes(b"not xml")
+    (tmp_path / "4.gpx").write_bytes(GPX)
+
+    def load_tracks():
+        gpx.index_gpx_files(db=db, dir_activities=tmp_path, stat_all=True)
+        tracks.load_tracks(db=db, dir_activities=tmp_path, processes=2)
+        return {row['activity_id']: row['data'] for row in db.execute("SELECT * FROM track WHERE path != '3.gpx'")}
+
+    with sync.database(config.DatabaseConfig(strava_sqlite_database=":memory:")) as db:
+        loaded = load_tracks()
+        assert list(loaded) == [1, 2, 4]
+        assert tracks.decode_track(loaded[1]).ele == [200.0, 201.3]
+        assert list(db.execute("SELECT points, data FROM track WHERE activity_id = 3").fetchone()) == [None, None]
+
+        # unchanged files aren't parsed again, changed are
+        db.execute("UPDATE track SET data = NULL")
+        os.utime(tmp_path / "2.gpx", (0, 0))
+        (tmp_path / "1.gpx.gz").unlink()
+        loaded = load_tracks()
+        assert list(loaded) == [2, 4]
+        assert loaded[2] is not None
+        assert loaded[4] is None